@@ -0,0 +1,90 @@
+import argparse
+import random
+import re
+import time
+from src.db import bechdel_db
+from src.db.swen344_db_utils import connect, execute_prepared, statement_sql
+
+# Measures what preparing the hot statements saves. Each statement is run
+# three ways on one connection:
+#   literal  - values formatted into the SQL text, as the old queries did
+#   bound    - psycopg2 parameters; psycopg2 binds on the client, so the
+#              server still parses and plans a new text every time
+#   prepared - PREPARE once, then EXECUTE by name (execute_prepared)
+# and the server's own planning time is read from EXPLAIN (ANALYZE).
+#
+#   python -m bench.prepared --iterations 5000
+
+PLANNING_TIME = re.compile(r'Planning Time: ([\d.]+) ms')
+
+
+def hot_statements(cur):
+    """(name, argument generator) for each hot statement, with arguments drawn from the loaded data"""
+    cur.execute('SELECT id FROM movies')
+    ids = [row[0] for row in cur.fetchall()]
+    cur.execute("""SELECT session_key FROM system_users WHERE session_key <> 'None'""")
+    keys = [row[0] for row in cur.fetchall()] or ['missing']
+    login = ('blorg', bechdel_db.hash_password('saltfatacidheat'))
+    return [
+        (bechdel_db.SHOW_MOVIE, lambda: (random.choice(ids),)),
+        (bechdel_db.SESSION_EXISTS, lambda: (random.choice(keys),)),
+        (bechdel_db.LOGIN_USER, lambda: login),
+        (bechdel_db.MOVIES_VERSION, lambda: ()),
+    ]
+
+def literal_sql(cur, sql, args):
+    """The statement with its arguments written into the text"""
+    return cur.mogrify(sql, args).decode()
+
+def run(cur, name, make_args, mode, iterations):
+    """Runs one statement iterations times; returns the mean seconds per call"""
+    sql = statement_sql(name)
+    started = time.perf_counter()
+    for _ in range(iterations):
+        args = make_args()
+        if mode == 'literal':
+            cur.execute(literal_sql(cur, sql, args))
+        elif mode == 'bound':
+            cur.execute(sql, args)
+        else:
+            execute_prepared(cur, name, args)
+        cur.fetchall()
+    return (time.perf_counter() - started) / iterations
+
+def planning_ms(cur, name, make_args, mode, samples=50):
+    """Mean planning time the server reports for the statement"""
+    sql = statement_sql(name)
+    total = 0.0
+    for _ in range(samples):
+        args = make_args()
+        if mode == 'prepared':
+            execute_prepared(cur, name, args)  # make sure it is prepared on this connection
+            cur.fetchall()
+            execute = 'EXECUTE %s' % name + (' (%s)' % ', '.join(['%s'] * len(args)) if args else '')
+            cur.execute(cur.mogrify('EXPLAIN (ANALYZE) ' + execute, args))
+        else:
+            cur.execute('EXPLAIN (ANALYZE) ' + literal_sql(cur, sql, args))
+        plan = '\n'.join(row[0] for row in cur.fetchall())
+        total += float(PLANNING_TIME.search(plan).group(1))
+    return total / samples
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compare ad-hoc and prepared execution of the hot statements')
+    parser.add_argument('--iterations', type=int, default=5000, help='calls per statement and mode')
+    parser.add_argument('--seed', type=int, default=344, help='random seed for the arguments')
+    args = parser.parse_args(argv)
+    random.seed(args.seed)
+
+    conn = connect()
+    conn.autocommit = True
+    cur = conn.cursor()
+    print('%-16s %-9s %12s %14s' % ('statement', 'mode', 'us/call', 'planning ms'))
+    for name, make_args in hot_statements(cur):
+        for mode in ('literal', 'bound', 'prepared'):
+            run(cur, name, make_args, mode, min(args.iterations, 100))  # warm up
+            seconds = run(cur, name, make_args, mode, args.iterations)
+            print('%-16s %-9s %12.1f %14.4f' % (name, mode, seconds * 1e6, planning_ms(cur, name, make_args, mode)))
+    conn.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+import argparse
+import json
+import math
+import os
+import subprocess
+import sys
+import time
+
+# Summaries and JSON results of bench.run, and a diff of two result files
+# so a change can be compared with the commit before it:
+#
+#   python -m bench.report bench/results/before.json bench/results/after.json
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), 'results')
+PERCENTILES = (50, 95, 99)
+
+
+def percentile(sorted_values, p):
+    """Nearest-rank percentile of an already sorted list (None when it is empty)"""
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(p / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+def summarize(samples, seconds):
+    """
+    Reduces the samples of one endpoint (or of all of them) to the reported figures
+    Params:
+        samples : list of (latency seconds, status code, round trips or None)
+        seconds : length of the measured run
+    Returns:
+        Dictionary of counts, throughput, latency percentiles in ms and round trips per request
+    """
+    latencies = sorted(sample[0] for sample in samples)
+    trips = [sample[2] for sample in samples if sample[2] is not None]
+    summary = {
+        'requests': len(samples),
+        'errors': sum(1 for sample in samples if sample[1] >= 500 or sample[1] == 0),
+        'throughput': round(len(samples) / seconds, 2) if seconds > 0 else 0.0,
+        'mean_ms': round(sum(latencies) / len(latencies) * 1000, 3) if latencies else None,
+    }
+    for p in PERCENTILES:
+        value = percentile(latencies, p)
+        summary['p%d_ms' % p] = round(value * 1000, 3) if value is not None else None
+    summary['max_ms'] = round(latencies[-1] * 1000, 3) if latencies else None
+    summary['db_round_trips'] = round(sum(trips) / len(trips), 2) if trips else None
+    return summary
+
+def git_commit():
+    """The commit being measured, marked -dirty when the tree has local changes"""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ('-dirty' if dirty else '')
+
+def build_report(samples_by_endpoint, seconds, options):
+    """
+    Params:
+        samples_by_endpoint : {endpoint name: list of samples} (see summarize)
+        seconds : length of the measured run
+        options : the run's settings (scale, concurrency, profile, ...), stored as given
+    Returns:
+        The result document saved by save_report
+    """
+    everything = [sample for samples in samples_by_endpoint.values() for sample in samples]
+    return {
+        'commit': git_commit(),
+        'started_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'seconds': round(seconds, 3),
+        'options': options,
+        'total': summarize(everything, seconds),
+        'endpoints': {name: summarize(samples, seconds) for name, samples in sorted(samples_by_endpoint.items())},
+    }
+
+def default_path(report):
+    name = '%s-%s-%s-c%s.json' % (report['commit'] or 'unknown', report['options'].get('profile'),
+                                  report['options'].get('scale'), report['options'].get('concurrency'))
+    return os.path.join(RESULTS_DIR, name)
+
+def save_report(report, path=None):
+    """Writes the report as JSON (to bench/results/<commit>-<profile>-<scale>-c<clients>.json by default); returns the path"""
+    path = path or default_path(report)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w') as out:
+        json.dump(report, out, indent=2, sort_keys=True)
+        out.write('\n')
+    return path
+
+def format_report(report):
+    """The report as a table, one line per endpoint"""
+    columns = ['requests', 'errors', 'throughput'] + ['p%d_ms' % p for p in PERCENTILES] + ['db_round_trips']
+    lines = ['%-22s' % 'endpoint' + ''.join('%15s' % column for column in columns)]
+    rows = list(report['endpoints'].items()) + [('TOTAL', report['total'])]
+    for name, summary in rows:
+        lines.append('%-22s' % name + ''.join('%15s' % ('-' if summary[column] is None else summary[column])
+                                              for column in columns))
+    return '\n'.join(lines)
+
+def change(before, after):
+    if before is None or after is None:
+        return '-'
+    if before == 0:
+        return '%+g' % (after - before)
+    return '%+.1f%%' % ((after - before) / before * 100)
+
+def compare(before, after):
+    """
+    Lines showing how each endpoint's throughput, p50/p95/p99 and round trips moved between two reports
+    """
+    columns = ['throughput'] + ['p%d_ms' % p for p in PERCENTILES] + ['db_round_trips']
+    lines = ['%s -> %s' % (before.get('commit'), after.get('commit')),
+             '%-22s' % 'endpoint' + ''.join('%16s' % column for column in columns)]
+    names = sorted(set(before['endpoints']) | set(after['endpoints'])) + ['TOTAL']
+    for name in names:
+        old = before['total'] if name == 'TOTAL' else before['endpoints'].get(name, {})
+        new = after['total'] if name == 'TOTAL' else after['endpoints'].get(name, {})
+        lines.append('%-22s' % name + ''.join('%16s' % change(old.get(column), new.get(column)) for column in columns))
+    return '\n'.join(lines)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Show one benchmark result, or how a second one differs from the first')
+    parser.add_argument('before', help='result JSON written by bench.run')
+    parser.add_argument('after', nargs='?', help='later result JSON to compare against it')
+    args = parser.parse_args(argv)
+
+    with open(args.before) as before_file:
+        before = json.load(before_file)
+    if args.after is None:
+        print(format_report(before))
+        return
+    with open(args.after) as after_file:
+        after = json.load(after_file)
+    if before.get('options') != after.get('options'):
+        print('warning: the runs used different options', file=sys.stderr)
+    print(compare(before, after))
+
+if __name__ == '__main__':
+    main()
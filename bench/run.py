@@ -0,0 +1,291 @@
+import argparse
+import os
+import random
+import signal
+import subprocess
+import sys
+import threading
+import time
+import requests
+from bench import report
+from bench.seed import BENCH_PASSWORD, bench_username
+
+# Drives every endpoint of src/server.py with a weighted mix of reads and
+# writes from a number of concurrent clients, then reports throughput,
+# p50/p95/p99 latency and database round trips per request and saves them
+# as JSON (see bench/report.py to compare two runs):
+#
+#   python -m bench.seed --scale 100k --users 32
+#   python -m bench.run --concurrency 32 --duration 30 --profile mixed
+#
+# By default the production launcher (src/serve.py) is started on a spare
+# port with BECHDEL_ROUND_TRIP_HEADER=1, so every answer carries the number
+# of round trips it took; --url measures a server that is already running
+# instead (round trips are then only reported if it has the header on).
+# Each client logs in as its own bench user, so seed at least as many
+# users as clients. Writes change the data: seed again before a run that is
+# to be compared with an earlier one.
+
+ROUND_TRIP_HEADER = 'X-DB-Round-Trips'
+DEFAULT_PORT = 5099
+BATCH_SIZE = 20
+
+# Relative weights of the operations in each profile
+PROFILES = {
+    'read': {
+        'show': 30, 'search': 20, 'list_details_page': 15, 'stats': 10,
+        'list_all_keys': 2, 'list_details': 1, 'list_details_stream': 1,
+    },
+    'mixed': {
+        'show': 25, 'search': 15, 'list_details_page': 10, 'stats': 8,
+        'list_all_keys': 2, 'list_details': 1, 'list_details_stream': 1,
+        'create': 8, 'delete': 6, 'update_rating': 8,
+        'create_batch': 2, 'delete_batch': 2, 'update_rating_batch': 2,
+        'login': 2, 'logout': 1, 'register': 1,
+    },
+    'write': {
+        'show': 5, 'search': 5, 'stats': 5,
+        'create': 20, 'delete': 15, 'update_rating': 20,
+        'create_batch': 8, 'delete_batch': 8, 'update_rating_batch': 8,
+        'login': 3, 'logout': 2, 'register': 1,
+    },
+}
+
+SEARCH_PREFIXES = ('the', 'a', 'star', 'love', 'man', 'in', 'my', 'night', 'b', 'god')
+
+
+class Workload:
+    """
+    What the clients draw their requests from: ids and titles sampled from
+    the server before the clock starts
+    """
+    def __init__(self, url, session):
+        keys = session.get(url + '/list_all_keys')
+        keys.raise_for_status()
+        self.ids = [int(movie_id) for movie_id in keys.json()]
+        self.max_id = max(self.ids) if self.ids else 0
+        titles = session.get(url + '/list_details', params={'limit': 1000, 'fields': 'title'})
+        titles.raise_for_status()
+        self.titles = [row[0] if isinstance(row, list) else row['title'] for row in titles.json()]
+
+
+class Client(threading.Thread):
+    """
+    One benchmark client: a keep-alive session logged in as its own user,
+    issuing operations drawn from the profile until the deadline
+    """
+    def __init__(self, number, url, workload, weights, seed, measure_from, deadline):
+        super().__init__(daemon=True)
+        self.number = number
+        self.url = url
+        self.workload = workload
+        self.operations = list(weights)
+        self.weights = [weights[name] for name in self.operations]
+        self.rng = random.Random('%s-%d' % (seed, number))
+        self.measure_from = measure_from
+        self.deadline = deadline
+        self.session = requests.Session()
+        self.created = []
+        self.serial = 0
+        self.samples = {}
+        self.error = None
+
+    def run(self):
+        try:
+            self.login()
+            while time.monotonic() < self.deadline:
+                name = self.rng.choices(self.operations, self.weights)[0]
+                getattr(self, 'op_' + name)()
+        except Exception as error:
+            self.error = error
+
+    def call(self, name, method, path, **kwargs):
+        """Issues one request and records (latency, status, round trips) under name"""
+        started = time.monotonic()
+        try:
+            response = self.session.request(method, self.url + path, **kwargs)
+            response.content
+            status = response.status_code
+        except requests.RequestException:
+            response, status = None, 0
+        finished = time.monotonic()
+        if started >= self.measure_from and finished <= self.deadline:
+            trips = response.headers.get(ROUND_TRIP_HEADER) if response is not None else None
+            self.samples.setdefault(name, []).append((finished - started, status, int(trips) if trips else None))
+        return response
+
+    def new_title(self):
+        self.serial += 1
+        return 'bench %d-%d' % (self.number, self.serial)
+
+    def login(self):
+        return self.call('login', 'POST', '/login',
+                         data={'username': bench_username(self.number), 'passw': BENCH_PASSWORD})
+
+    def op_list_all_keys(self):
+        self.call('list_all_keys', 'GET', '/list_all_keys')
+
+    def op_list_details(self):
+        self.call('list_details', 'GET', '/list_details')
+
+    def op_list_details_page(self):
+        after_id = self.rng.randint(0, self.workload.max_id)
+        self.call('list_details_page', 'GET', '/list_details', params={'limit': 100, 'after_id': after_id})
+
+    def op_list_details_stream(self):
+        self.call('list_details_stream', 'GET', '/list_details', params={'stream': 'ndjson'})
+
+    def op_search(self):
+        params = {'q': self.rng.choice(SEARCH_PREFIXES), 'limit': 50}
+        if self.rng.random() < 0.5:
+            params['year_min'] = self.rng.randint(1950, 2010)
+            params['sort'] = '-year'
+        self.call('search', 'GET', '/movies/search', params=params)
+
+    def op_show(self):
+        self.call('show', 'GET', '/show', params={'id': self.rng.choice(self.workload.ids)})
+
+    def op_stats(self):
+        self.call('stats', 'GET', '/stats')
+
+    def op_create(self):
+        title = self.new_title()
+        response = self.call('create', 'POST', '/user',
+                             data={'title': title, 'rating': self.rng.randint(0, 3), 'year': self.rng.randint(1900, 2021)})
+        if response is not None and response.status_code == 200:
+            self.created.append(title)
+
+    def op_delete(self):
+        if not self.created:
+            return self.op_create()
+        self.call('delete', 'DELETE', '/user', params={'title': self.created.pop()})
+
+    def op_update_rating(self):
+        self.call('update_rating', 'POST', '/update_rating',
+                  data={'title': self.rng.choice(self.workload.titles), 'rating': self.rng.randint(0, 3)})
+
+    def op_create_batch(self):
+        items = [{'title': self.new_title(), 'rating': self.rng.randint(0, 3), 'year': self.rng.randint(1900, 2021)}
+                 for _ in range(BATCH_SIZE)]
+        response = self.call('create_batch', 'POST', '/user/batch', json=items)
+        if response is not None and response.status_code == 200:
+            self.created.extend(item['title'] for item in items)
+
+    def op_delete_batch(self):
+        if len(self.created) < BATCH_SIZE:
+            return self.op_create_batch()
+        titles, self.created = self.created[-BATCH_SIZE:], self.created[:-BATCH_SIZE]
+        self.call('delete_batch', 'DELETE', '/user/batch', json=[{'title': title} for title in titles])
+
+    def op_update_rating_batch(self):
+        items = [{'title': self.rng.choice(self.workload.titles), 'rating': self.rng.randint(0, 3)}
+                 for _ in range(BATCH_SIZE)]
+        self.call('update_rating_batch', 'POST', '/update_rating/batch', json=items)
+
+    def op_login(self):
+        self.login()
+
+    def op_logout(self):
+        self.call('logout', 'POST', '/logout')
+        self.login()
+
+    def op_register(self):
+        self.call('register', 'POST', '/register',
+                  data={'username': 'bench%d-%d-%d' % (self.number, os.getpid(), self.serial), 'passw': BENCH_PASSWORD})
+        self.serial += 1
+
+
+def start_server(port, workers, threads):
+    """Starts src/serve.py with the round trip header on and waits until it answers"""
+    env = dict(os.environ, BECHDEL_ROUND_TRIP_HEADER='1')
+    server = subprocess.Popen([sys.executable, 'src/serve.py', '--bind', '127.0.0.1:%d' % port,
+                               '--workers', str(workers), '--threads', str(threads)],
+                              env=env, stderr=subprocess.DEVNULL, start_new_session=True)
+    url = 'http://127.0.0.1:%d' % port
+    deadline = time.monotonic() + 30
+    while True:
+        try:
+            requests.get(url + '/stats', timeout=1)
+            return server, url
+        except requests.ConnectionError:
+            if time.monotonic() > deadline or server.poll() is not None:
+                stop_server(server)
+                raise RuntimeError('server did not start')
+            time.sleep(0.2)
+
+def stop_server(server):
+    try:
+        os.killpg(server.pid, signal.SIGTERM)
+    except ProcessLookupError:
+        pass
+    server.wait()
+
+def run(url, profile, concurrency, duration, warmup=2.0, seed=344, endpoints=None):
+    """
+    Runs one benchmark against url
+    Params:
+        profile : name of the operation mix in PROFILES
+        concurrency : number of clients
+        duration : seconds measured, after warmup seconds that are not
+        endpoints : optional subset of the profile's operations to keep
+    Returns:
+        ({operation: list of samples}, workload)
+    """
+    weights = dict(PROFILES[profile])
+    if endpoints:
+        weights = {name: weight for name, weight in weights.items() if name in endpoints}
+        if not weights:
+            raise ValueError('none of %s is in the %s profile' % (', '.join(endpoints), profile))
+    workload = Workload(url, requests.Session())
+    measure_from = time.monotonic() + warmup
+    deadline = measure_from + duration
+    clients = [Client(number, url, workload, weights, seed, measure_from, deadline) for number in range(concurrency)]
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    failed = [client.error for client in clients if client.error is not None]
+    if failed:
+        raise failed[0]
+
+    samples = {}
+    for client in clients:
+        for name, values in client.samples.items():
+            samples.setdefault(name, []).extend(values)
+    return samples, workload
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark every endpoint of the API with a mix of reads and writes')
+    parser.add_argument('--profile', choices=sorted(PROFILES), default='mixed', help='operation mix (default mixed)')
+    parser.add_argument('--concurrency', type=int, default=8, help='concurrent clients (default 8)')
+    parser.add_argument('--duration', type=float, default=20.0, help='seconds measured (default 20)')
+    parser.add_argument('--warmup', type=float, default=2.0, help='seconds run before measuring (default 2)')
+    parser.add_argument('--seed', type=int, default=344, help='random seed of the clients')
+    parser.add_argument('--endpoints', help='comma separated operations to keep from the profile')
+    parser.add_argument('--url', help='measure a server already running here instead of starting one')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help='port for the server started by the run')
+    parser.add_argument('--workers', type=int, default=1, help='worker processes of the started server')
+    parser.add_argument('--threads', type=int, default=8, help='threads per worker of the started server')
+    parser.add_argument('--output', help='result file (default bench/results/<commit>-<profile>-<scale>-c<clients>.json)')
+    args = parser.parse_args(argv)
+    endpoints = [name.strip() for name in args.endpoints.split(',')] if args.endpoints else None
+
+    server = None
+    url = args.url
+    if url is None:
+        server, url = start_server(args.port, args.workers, args.threads)
+    try:
+        samples, workload = run(url, args.profile, args.concurrency, args.duration, args.warmup, args.seed, endpoints)
+    finally:
+        if server is not None:
+            stop_server(server)
+
+    options = {'profile': args.profile, 'concurrency': args.concurrency, 'duration': args.duration,
+               'warmup': args.warmup, 'seed': args.seed, 'endpoints': endpoints, 'scale': len(workload.ids),
+               'server': 'external' if args.url else {'workers': args.workers, 'threads': args.threads}}
+    result = report.build_report(samples, args.duration, options)
+    print(report.format_report(result))
+    print('saved %s' % report.save_report(result, args.output))
+
+if __name__ == '__main__':
+    main()
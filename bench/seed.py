@@ -0,0 +1,100 @@
+import argparse
+import random
+import time
+from src.db import bechdel_db
+from src.db.bulk_import import iter_json_array
+from src.db.swen344_db_utils import exec_commit
+
+# Loads a deterministic, scaled-up copy of the Bechdel data for the
+# benchmarks. The real movies are kept as they are; every further copy
+# shifts the ids and imdbids past the real ones, tags the title and draws
+# a new rating and year from a seeded generator, so the same scale and
+# seed always produce the same table.
+#
+#   python -m bench.seed --scale 100k
+#
+# This REPLACES everything in the configured database.
+
+SEED_FILE = 'src/db/bechdel_test_movies.json'
+SCALES = {'8k': 8000, '100k': 100000, '1m': 1000000}
+ID_STRIDE = 10000           # larger than the biggest real id
+IMDBID_STRIDE = 11000000    # larger than the biggest real imdbid
+BENCH_PASSWORD = 'benchmark'
+
+
+def parse_scale(value):
+    """Accepts one of SCALES or a plain movie count"""
+    value = value.lower()
+    if value in SCALES:
+        return SCALES[value]
+    try:
+        return int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected one of %s or a number, got %r' % (', '.join(SCALES), value))
+
+def seed_movies():
+    """The real movies, ordered by id"""
+    with open(SEED_FILE, 'r') as json_file:
+        return sorted(iter_json_array(json_file), key=lambda movie: int(movie['id']))
+
+def synthetic_movies(count, seed=344):
+    """
+    Generates count movies from the real ones
+    Params:
+        count : movies to produce; the real ones come first
+        seed : random seed for the ratings and years of the copies
+    Returns:
+        Iterator of movie dicts in the form import_movies expects
+    """
+    originals = seed_movies()
+    rng = random.Random(seed)
+    for n in range(count):
+        copy, movie = divmod(n, len(originals))
+        movie = originals[movie]
+        if copy == 0:
+            yield movie
+            continue
+        yield {
+            'id': int(movie['id']) + copy * ID_STRIDE,
+            'imdbid': int(movie['imdbid']) + copy * IMDBID_STRIDE,
+            'rating': rng.randint(0, 3),
+            'title': '%s (%d)' % (movie['title'], copy),
+            'year': rng.randint(1900, 2021),
+        }
+
+def bench_username(n):
+    return 'bench%d' % n
+
+def create_bench_users(count):
+    """Registers bench0..bench<count-1>, one per benchmark client, all with BENCH_PASSWORD"""
+    hashed = bechdel_db.hash_password(BENCH_PASSWORD)
+    for n in range(count):
+        exec_commit("""INSERT INTO system_users (username, passw) VALUES (%s, %s)
+                       ON CONFLICT (username) DO NOTHING""", (bench_username(n), hashed))
+
+def seed(count, users=64, seed=344, progress=None):
+    """
+    Rebuilds the schema and loads count synthetic movies and the bench users
+    Returns:
+        ImportStats of the load
+    """
+    bechdel_db.rebuild_tables()
+    stats = bechdel_db.import_movies(synthetic_movies(count, seed), progress=progress)
+    exec_commit('ANALYZE')
+    create_bench_users(users)
+    return stats
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Load a scaled-up copy of the Bechdel movies for benchmarking')
+    parser.add_argument('--scale', type=parse_scale, default=SCALES['8k'],
+                        help='movies to load: %s or a number (default 8k)' % ', '.join(SCALES))
+    parser.add_argument('--users', type=int, default=64, help='benchmark users to register (one per client)')
+    parser.add_argument('--seed', type=int, default=344, help='random seed for the synthetic movies')
+    args = parser.parse_args(argv)
+
+    started = time.perf_counter()
+    stats = seed(args.scale, args.users, args.seed)
+    print('loaded %d movies and %d users in %.1fs' % (stats.rows, args.users, time.perf_counter() - started))
+
+if __name__ == '__main__':
+    main()
@@ -1,25 +1,258 @@
-from flask_restful import Resource, reqparse
-from flask import json, request, redirect, url_for
-from db import bechdel_db
+import time
+from flask_restful import Resource, reqparse, abort
+from flask import g, json, request, url_for, Response, stream_with_context
+from db import bechdel_db, metrics, slow_queries
+from db.config import get_settings
+from db.swen344_db_utils import round_trips
+from api.common import SESSION_COOKIE, STREAM_BATCH_SIZE
+from api import common, compress, profiling, serialize
 
+# Arguments are declared once, up front: a RequestParser is only safe to
+# share between threads as long as nobody adds arguments to it per request
 parser = reqparse.RequestParser()
-session_k = 0
+parser.add_argument('title', type = str, location = ('args', 'form'))
+
+def request_session_key():
+    """Finds the caller's session key on the current request (see common.session_key_from)"""
+    return common.session_key_from(request.headers, request.cookies)
+
+def start_request_timer():
+    """before_request hook: notes when the request started (see record_request)"""
+    g.request_started = time.perf_counter()
+
+def record_request(response):
+    """after_request hook recording the request's latency under its route, method and status"""
+    started = g.get('request_started')
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        metrics.REQUEST_SECONDS.observe(time.perf_counter() - started, route, request.method, str(response.status_code))
+    return response
+
+def report_round_trips(response):
+    """
+    after_request hook (see round_trip_header in config.py) that tells the
+    benchmark how many database round trips the request needed. A streamed
+    body is still being produced at this point, so its later fetches are not
+    included.
+    """
+    response.headers['X-DB-Round-Trips'] = str(round_trips())
+    return response
+
+def encoded_response(body, media_type=common.JSON):
+    """Wraps an already encoded body (JSON unless media_type says otherwise)"""
+    return Response(body, content_type=common.content_type(media_type))
+
+def conditional_get(build_response, media_type=common.JSON, negotiated=False):
+    """
+    Answers a read of the movies table with a strong ETag and Last-Modified taken
+    from the table version. When the client's copy is still current the answer is
+    304 Not Modified and build_response is never called, so nothing is queried or
+    serialized. Otherwise build_response is given the version, which keys the
+    prebuilt bodies in serialize.bodies().
+    Params:
+        media_type : the representation being sent, which the ETag identifies
+        negotiated : media_type was chosen from the Accept header (adds Vary: Accept)
+    """
+    version = bechdel_db.movies_version()
+    etag, last_modified = common.movies_validators(version, media_type)
+    if common.not_modified(etag, last_modified,
+                           request.headers.get('If-None-Match'), request.headers.get('If-Modified-Since'),
+                           compress.etag_variants(etag)):
+        response = Response(status=304)
+    else:
+        response = build_response(version)
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.cache_control.no_cache = True
+    if negotiated:
+        response.vary.add('Accept')
+    return response
 
 class List_All_Keys(Resource):
-    """Lists all keys of movies table"""
+    """
+    Lists all keys of movies table: an {id: imdbid} object, or an (id, imdbid)
+    table when the Accept header asks for CSV, NDJSON or the columnar layout
+    """
     def get(self):
-        return dict(bechdel_db.list_all_keys())
+        media_type = common.negotiate_format(request.headers.get('Accept'))
+        return conditional_get(lambda version: self.build_response(version, media_type), media_type, negotiated=True)
+
+    def build_response(self, version, media_type):
+        body = serialize.bodies().get_or_build(
+            version, ('keys', media_type), lambda: common.keys_body(bechdel_db.list_all_keys(), media_type))
+        return encoded_response(body, media_type)
 
 class List_Details(Resource):
-    """Lists all details of movies table"""
+    """
+    Lists all details of movies table
+    Query params:
+        limit, after_id : keyset pagination over movie ids; a Link rel="next" header
+                          points at the following page while there is one
+        fields : comma separated columns to return, in order (e.g. fields=id,title);
+                 only those columns are read from the database
+        stream : 'json' or 'ndjson' to stream the whole table in chunks
+    The Accept header picks the representation: JSON rows (the default), text/csv,
+    application/x-ndjson or application/vnd.bechdel.columns+json (one array per column).
+    """
     def get(self):
-        return json.jsonify(bechdel_db.list_details())
+        try:
+            limit, after_id, stream, fields = common.list_details_args(request.args)
+        except ValueError as error:
+            abort(400, message=str(error))
+        if stream is not None:
+            return conditional_get(lambda version: stream_details(stream, after_id, fields))
+
+        media_type = common.negotiate_format(request.headers.get('Accept'))
+        return conditional_get(lambda version: self.build_response(version, limit, after_id, fields, media_type),
+                               media_type, negotiated=True)
+
+    def build_response(self, version, limit, after_id, fields, media_type):
+        bodies = serialize.bodies()
+        if limit is None and after_id is None:
+            return encoded_response(bodies.get_or_build(
+                version, ('details', fields, media_type),
+                lambda: common.encode_table(bechdel_db.list_details(fields=fields), fields, media_type)),
+                media_type)
+
+        limit = common.page_size(limit)
+        path = url_for(request.endpoint)
+
+        def build_page():
+            rows = bechdel_db.list_details(limit, after_id, common.page_fields(fields))
+            return common.encode_page(rows, path, limit, fields, media_type)
+
+        body, link = bodies.get_or_build(version, ('details', limit, after_id, fields, media_type), build_page)
+        response = encoded_response(body, media_type)
+        if link is not None:
+            response.headers['Link'] = link
+        return response
+
+def stream_details(fmt, after_id=None, fields=None):
+    """Streams the movie table as a chunked JSON array or as NDJSON, one batch at a time"""
+    batches = bechdel_db.iter_details(after_id, STREAM_BATCH_SIZE, fields)
+
+    if fmt == 'ndjson':
+        body = (common.ndjson_chunk(rows) for rows in batches)
+        return Response(stream_with_context(body), mimetype='application/x-ndjson')
+
+    def json_array():
+        yield b'['
+        first = True
+        for rows in batches:
+            yield common.json_array_chunk(rows, first)
+            first = False
+        yield b']'
+    return Response(stream_with_context(json_array()), mimetype='application/json')
+
+class Search(Resource):
+    """
+    Searches movies, one keyset page at a time
+    Query params:
+        q, match : title text; match is 'prefix' (the default), 'words' or 'substring'
+        year_min, year_max, rating_min, rating_max : inclusive bounds
+        sort : id, title, year or rating, with a '-' prefix for descending order
+        limit, after : page size, and the cursor from the Link rel="next" header
+        fields : comma separated columns to return, as for /list_details
+    The Accept header picks the representation, as for /list_details.
+    """
+    def get(self):
+        try:
+            query, limit = common.search_args(request.args)
+        except ValueError as error:
+            abort(400, message=str(error))
+        media_type = common.negotiate_format(request.headers.get('Accept'))
+        return conditional_get(lambda version: self.build_response(version, query, limit, media_type),
+                               media_type, negotiated=True)
+
+    def build_response(self, version, query, limit, media_type):
+        path = url_for(request.endpoint)
+
+        def build_page():
+            rows, after = bechdel_db.search(limit, **query)
+            return (common.encode_table(rows, query['fields'], media_type),
+                    common.search_link(path, request.args, after))
+
+        body, link = serialize.bodies().get_or_build(version, common.search_key(query, limit) + (media_type,), build_page)
+        response = encoded_response(body, media_type)
+        if link is not None:
+            response.headers['Link'] = link
+        return response
 
 class Show(Resource):
     """Shows all details of a specific row of movies table given an ID"""
     def get(self):
-        id_data = request.args.get('id')
-        return json.jsonify(bechdel_db.show(id_data))
+        try:
+            id_data = common.show_id(request.args.get('id'))
+        except ValueError as error:
+            abort(400, message=str(error))
+        return conditional_get(lambda version: encoded_response(serialize.bodies().get_or_build(
+            version, ('show', id_data), lambda: serialize.encode_rows(bechdel_db.show(id_data)))))
+
+class Stats(Resource):
+    """Movie counts, rating histograms and Bechdel pass rates, overall and per year (see common.stats_body)"""
+    def get(self):
+        return conditional_get(lambda version: encoded_response(serialize.bodies().get_or_build(
+            version, ('stats',), lambda: common.stats_body(bechdel_db.movie_stats()))))
+
+def all_cache_stats():
+    """Statistics of every cache in the process: the database layer's, the prebuilt bodies and the compressed bodies"""
+    return dict(bechdel_db.cache_stats(), bodies=serialize.bodies().stats(),
+                compressed=compress.compressed_cache().stats())
+
+metrics.add_collector(lambda: metrics.cache_metrics(all_cache_stats()))
+
+class Cache_Stats(Resource):
+    """Reports hit/miss/eviction counters of the movie read caches and the prebuilt response bodies"""
+    def get(self):
+        return all_cache_stats()
+
+def require_admin():
+    """Answers 401 without a valid session and 403 unless its user is one of the admin_users"""
+    username = bechdel_db.session_user(request_session_key())
+    if username is None:
+        abort(401, message='log in as an admin user')
+    if username not in get_settings().admins:
+        abort(403, message='admin users only')
+
+class Slow_Queries(Resource):
+    """
+    Admin only: the statements that took longer than slow_query_ms, newest first,
+    with redacted parameters and, for the sampled ones, their EXPLAIN (ANALYZE, BUFFERS)
+    plan (see db/slow_queries.py). DELETE empties the log.
+    """
+    def get(self):
+        require_admin()
+        return {'threshold_ms': get_settings().slow_query_ms, 'entries': slow_queries.recent()}
+
+    def delete(self):
+        require_admin()
+        slow_queries.clear()
+        return {'entries': []}
+
+class Profiles(Resource):
+    """
+    Admin only: the request profiles kept (see api/profiling.py), newest first. A
+    request is profiled when an admin sends X-Profile: 1, or by 1-in-N sampling.
+    """
+    def get(self):
+        require_admin()
+        return {'profiles': profiling.list_profiles()}
+
+class Profile(Resource):
+    """Admin only: downloads one profile in the pstats format"""
+    def get(self, profile_id):
+        require_admin()
+        data = profiling.read_profile(profile_id)
+        if data is None:
+            abort(404, message='no profile %s' % profile_id)
+        response = Response(data, mimetype='application/octet-stream')
+        response.headers['Content-Disposition'] = 'attachment; filename="%s.prof"' % profile_id
+        return response
+
+class Metrics(Resource):
+    """Request latency, query timings, pool waits and cache counters in the Prometheus text format (see db/metrics.py)"""
+    def get(self):
+        return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
 
 class Register(Resource):
     """Registers a new user"""
@@ -29,56 +262,79 @@ class Register(Resource):
         return json.jsonify(bechdel_db.create_user(usern, password))
 
 class Login_User(Resource):
-    """Logs a user in given username and password"""
+    """
+    Logs a user in given username and password. The session key is returned in
+    the body and also set as the session_key cookie.
+    """
     def post(self):
-
-        global session_k
-
         usern = request.form['username']
         password = request.form['passw']
 
         results = bechdel_db.generate_session_key(usern, password)
-        session_k = results[0]
 
-        return json.jsonify(results)
+        response = json.jsonify(results)
+        if results[0]:
+            response.set_cookie(SESSION_COOKIE, results[0], httponly = True, samesite = 'Lax')
+        else:
+            response.delete_cookie(SESSION_COOKIE)
+        return response
 
 class Logout_User(Resource):
-    """Logs a user out given a session key"""
+    """Logs out the session the request carries"""
     def post(self):
-        global session_k
-
-        cur_session_k = session_k
-        session_k = 0
-
-        return json.jsonify(bechdel_db.logout(cur_session_k))
+        response = json.jsonify(bechdel_db.logout(request_session_key()))
+        response.delete_cookie(SESSION_COOKIE)
+        return response
 
 class UserAPI(Resource):
     """UserAPI for create and delete CRUD methods"""
     def post(self):
         """Creates a movie"""
-        global session_k
-
         title_data = request.form['title']
         rating_data = request.form['rating']
         year_data = request.form['year']
 
-        return json.jsonify(bechdel_db.create(rating_data, title_data, year_data, session_k))
+        return json.jsonify(bechdel_db.create(rating_data, title_data, year_data, request_session_key()))
 
     def delete(self):
         """Deletes a movie"""
-        global session_k
-
-        parser.add_argument('title', type = str)
         args = parser.parse_args()
 
-        return json.jsonify(bechdel_db.delete(args['title'], session_k))
+        return json.jsonify(bechdel_db.delete(args['title'], request_session_key()))
 
 class UpdateRating(Resource):
-    """Updates a movie rating given a session key"""
+    """Updates a movie rating for the session the request carries"""
     def post(self):
-        global session_k
-
         new_rating = request.form['rating']
         title_data = request.form['title']
 
-        return json.jsonify(bechdel_db.update_movie_rating(new_rating, title_data, session_k))
+        return json.jsonify(bechdel_db.update_movie_rating(new_rating, title_data, request_session_key()))
+
+def batch_request():
+    """Reads a batch write's items and mode, answering 400 if they are malformed"""
+    try:
+        return common.batch_args(request.args, request.get_json(force=True, silent=True))
+    except ValueError as error:
+        abort(400, message=str(error))
+
+class UserBatch(Resource):
+    """
+    Creates or deletes many movies in one transaction. The body is a JSON array
+    of items; ?mode=partial commits the items that succeed instead of all or none.
+    The answer is {"committed": bool, "results": [...]}, one result per item.
+    """
+    def post(self):
+        """Creates movies from [{"title", "rating", "year"}, ...]"""
+        items, atomic = batch_request()
+        return json.jsonify(bechdel_db.create_batch(items, request_session_key(), atomic))
+
+    def delete(self):
+        """Deletes movies named by [{"title"}, ...]"""
+        items, atomic = batch_request()
+        return json.jsonify(bechdel_db.delete_batch(items, request_session_key(), atomic))
+
+class UpdateRatingBatch(Resource):
+    """Updates many movie ratings in one transaction, from [{"title", "rating"}, ...] (see UserBatch)"""
+    def post(self):
+        items, atomic = batch_request()
+        return json.jsonify(bechdel_db.update_rating_batch(items, request_session_key(), atomic))
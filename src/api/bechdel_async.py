@@ -0,0 +1,236 @@
+from aiohttp import web
+from db import bechdel_db_async
+from api.common import SESSION_COOKIE, STREAM_BATCH_SIZE
+from api import common, serialize
+
+# aiohttp handlers for the same endpoints as the Flask resources in bechdel.py.
+# Validation and encoding come from common.py and serialize.py so both servers
+# behave alike.
+
+def bad_request(message):
+    """Builds the 400 answer Flask-RESTful's abort() gives, {"message": ...}"""
+    return web.HTTPBadRequest(body=common.error_body(message), content_type='application/json')
+
+def json_response(body, media_type=common.JSON):
+    """Wraps an already encoded body (JSON unless media_type says otherwise)"""
+    return web.Response(body=body, headers={'Content-Type': common.content_type(media_type)})
+
+async def cached_body(version, key, build):
+    """Async counterpart of BodyCache.get_or_build, for a coroutine build()"""
+    bodies = serialize.bodies()
+    body = bodies.get(version, key)
+    if body is serialize.MISSING:
+        body = await build()
+        bodies.set(version, key, body)
+    return body
+
+async def form_fields(request, *names):
+    """Reads required form fields, answering 400 if one is missing"""
+    form = await request.post()
+    try:
+        return [form[name] for name in names]
+    except KeyError as error:
+        raise bad_request('missing form field %s' % error.args[0])
+
+def request_session_key(request):
+    """Finds the caller's session key on the request (see common.session_key_from)"""
+    return common.session_key_from(request.headers, request.cookies)
+
+async def conditional_get(request, build_response, media_type=common.JSON, negotiated=False):
+    """
+    Async counterpart of bechdel.conditional_get. build_response is given the
+    version and a function that stamps the validators on a response, so
+    streaming responses can carry them before their headers are sent.
+    """
+    version = await bechdel_db_async.movies_version()
+    etag, last_modified = common.movies_validators(version, media_type)
+
+    def with_validators(response):
+        response.etag = etag
+        response.last_modified = last_modified
+        response.headers['Cache-Control'] = 'no-cache'
+        if negotiated:
+            response.headers['Vary'] = 'Accept'
+        return response
+
+    if common.not_modified(etag, last_modified,
+                           request.headers.get('If-None-Match'), request.headers.get('If-Modified-Since')):
+        return with_validators(web.Response(status=304))
+    return await build_response(version, with_validators)
+
+async def list_all_keys(request):
+    """Lists all keys of movies table (see bechdel.List_All_Keys)"""
+    media_type = common.negotiate_format(request.headers.get('Accept'))
+
+    async def build_keys():
+        return common.keys_body(await bechdel_db_async.list_all_keys(), media_type)
+
+    async def build_response(version, with_validators):
+        body = await cached_body(version, ('keys', media_type), build_keys)
+        return with_validators(json_response(body, media_type))
+    return await conditional_get(request, build_response, media_type, negotiated=True)
+
+async def list_details(request):
+    """Lists all details of movies table (same query params and formats as bechdel.List_Details)"""
+    try:
+        limit, after_id, stream, fields = common.list_details_args(request.query)
+    except ValueError as error:
+        raise bad_request(str(error))
+
+    if stream is not None:
+        async def build_stream(version, with_validators):
+            return await stream_details(request, with_validators, stream, after_id, fields)
+        return await conditional_get(request, build_stream)
+
+    media_type = common.negotiate_format(request.headers.get('Accept'))
+    page = common.page_size(limit)
+
+    async def build_all():
+        return common.encode_table(await bechdel_db_async.list_details(fields=fields), fields, media_type)
+
+    async def build_page():
+        rows = await bechdel_db_async.list_details(page, after_id, common.page_fields(fields))
+        return common.encode_page(rows, request.path, page, fields, media_type)
+
+    async def build_response(version, with_validators):
+        if limit is None and after_id is None:
+            body = await cached_body(version, ('details', fields, media_type), build_all)
+            return with_validators(json_response(body, media_type))
+
+        body, link = await cached_body(version, ('details', page, after_id, fields, media_type), build_page)
+        response = with_validators(json_response(body, media_type))
+        if link is not None:
+            response.headers['Link'] = link
+        return response
+    return await conditional_get(request, build_response, media_type, negotiated=True)
+
+async def stream_details(request, with_validators, fmt, after_id=None, fields=None):
+    """Streams the movie table as a chunked JSON array or as NDJSON, one batch at a time"""
+    response = with_validators(web.StreamResponse())
+    response.content_type = 'application/x-ndjson' if fmt == 'ndjson' else 'application/json'
+    await response.prepare(request)
+
+    if fmt == 'json':
+        await response.write(b'[')
+    first = True
+    async for rows in bechdel_db_async.iter_details(after_id, STREAM_BATCH_SIZE, fields):
+        chunk = common.ndjson_chunk(rows) if fmt == 'ndjson' else common.json_array_chunk(rows, first)
+        await response.write(chunk)
+        first = False
+    if fmt == 'json':
+        await response.write(b']')
+    await response.write_eof()
+    return response
+
+async def search(request):
+    """Searches movies, one keyset page at a time (same query params and formats as bechdel.Search)"""
+    try:
+        query, limit = common.search_args(request.query)
+    except ValueError as error:
+        raise bad_request(str(error))
+    media_type = common.negotiate_format(request.headers.get('Accept'))
+
+    async def build_page():
+        rows, after = await bechdel_db_async.search(limit, **query)
+        return (common.encode_table(rows, query['fields'], media_type),
+                common.search_link(request.path, request.query, after))
+
+    async def build_response(version, with_validators):
+        body, link = await cached_body(version, common.search_key(query, limit) + (media_type,), build_page)
+        response = with_validators(json_response(body, media_type))
+        if link is not None:
+            response.headers['Link'] = link
+        return response
+    return await conditional_get(request, build_response, media_type, negotiated=True)
+
+async def show(request):
+    """Shows all details of a specific row of movies table given an ID"""
+    try:
+        id_data = common.show_id(request.query.get('id'))
+    except ValueError as error:
+        raise bad_request(str(error))
+    async def build_show():
+        return serialize.encode_rows(await bechdel_db_async.show(id_data))
+
+    async def build_response(version, with_validators):
+        return with_validators(json_response(await cached_body(version, ('show', id_data), build_show)))
+    return await conditional_get(request, build_response)
+
+async def stats(request):
+    """Movie counts, rating histograms and pass rates (see bechdel.Stats)"""
+    async def build_stats():
+        return common.stats_body(await bechdel_db_async.movie_stats())
+
+    async def build_response(version, with_validators):
+        return with_validators(json_response(await cached_body(version, ('stats',), build_stats)))
+    return await conditional_get(request, build_response)
+
+async def register(request):
+    """Registers a new user"""
+    usern, password = await form_fields(request, 'username', 'passw')
+    return json_response(serialize.encode(await bechdel_db_async.create_user(usern, password)))
+
+async def login(request):
+    """Logs a user in; the session key is returned in the body and set as the session_key cookie"""
+    usern, password = await form_fields(request, 'username', 'passw')
+    results = await bechdel_db_async.generate_session_key(usern, password)
+
+    response = json_response(serialize.encode(results))
+    if results[0]:
+        response.set_cookie(SESSION_COOKIE, results[0], httponly=True, samesite='Lax')
+    else:
+        response.del_cookie(SESSION_COOKIE)
+    return response
+
+async def logout(request):
+    """Logs out the session the request carries"""
+    response = json_response(serialize.encode(await bechdel_db_async.logout(request_session_key(request))))
+    response.del_cookie(SESSION_COOKIE)
+    return response
+
+async def create_movie(request):
+    """Creates a movie"""
+    title_data, rating_data, year_data = await form_fields(request, 'title', 'rating', 'year')
+    new_movie = await bechdel_db_async.create(rating_data, title_data, year_data, request_session_key(request))
+    return json_response(serialize.encode(new_movie))
+
+async def delete_movie(request):
+    """Deletes a movie, named by the title query parameter or form field"""
+    form = await request.post()
+    title = form.get('title', request.query.get('title'))
+    return json_response(serialize.encode(await bechdel_db_async.delete(title, request_session_key(request))))
+
+async def update_rating(request):
+    """Updates a movie rating for the session the request carries"""
+    new_rating, title_data = await form_fields(request, 'rating', 'title')
+    return json_response(serialize.encode(
+        await bechdel_db_async.update_movie_rating(new_rating, title_data, request_session_key(request))))
+
+async def batch_request(request):
+    """Reads a batch write's items and mode, answering 400 if they are malformed"""
+    try:
+        document = await request.json()
+    except ValueError:
+        document = None
+    try:
+        return common.batch_args(request.query, document)
+    except ValueError as error:
+        raise bad_request(str(error))
+
+async def create_movies(request):
+    """Creates many movies in one transaction (see bechdel.UserBatch)"""
+    items, atomic = await batch_request(request)
+    return json_response(serialize.encode(
+        await bechdel_db_async.create_batch(items, request_session_key(request), atomic)))
+
+async def delete_movies(request):
+    """Deletes many movies in one transaction (see bechdel.UserBatch)"""
+    items, atomic = await batch_request(request)
+    return json_response(serialize.encode(
+        await bechdel_db_async.delete_batch(items, request_session_key(request), atomic)))
+
+async def update_ratings(request):
+    """Updates many movie ratings in one transaction (see bechdel.UpdateRatingBatch)"""
+    items, atomic = await batch_request(request)
+    return json_response(serialize.encode(
+        await bechdel_db_async.update_rating_batch(items, request_session_key(request), atomic)))
@@ -0,0 +1,343 @@
+import base64
+import binascii
+import json
+from datetime import timezone
+from urllib.parse import urlencode
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header, parse_date, parse_etags
+from api.serialize import encode, encode_columns, encode_csv, encode_ndjson, encode_row, encode_rows
+from db.batch import MODES as BATCH_MODES
+from db.bechdel_db import MOVIE_COLUMNS, movie_fields, search_sql
+
+# Request validation and response encoding shared by the Flask resources
+# (bechdel.py) and the asyncio handlers (bechdel_async.py), so both servers
+# accept the same input and produce the same bytes. Nothing in here touches a
+# framework's request object; callers pass in plain header and query values.
+
+SESSION_HEADER = 'X-Session-Key'
+SESSION_COOKIE = 'session_key'
+
+MAX_PAGE_SIZE = 1000
+STREAM_BATCH_SIZE = 1000
+STREAM_FORMATS = ('json', 'ndjson')
+MAX_BATCH_ITEMS = 10000
+SEARCH_PAGE_SIZE = 100
+# A movie passes the Bechdel test with the top rating
+PASS_RATING = 3
+
+# Representations of a movie listing, chosen with the Accept header. JSON
+# (first, so */* picks it) is the list of row arrays the API always returned.
+JSON = 'application/json'
+CSV = 'text/csv'
+NDJSON = 'application/x-ndjson'
+COLUMNS = 'application/vnd.bechdel.columns+json'
+TABLE_FORMATS = (JSON, CSV, NDJSON, COLUMNS)
+# Appended to the ETag, which must differ between representations of one URL
+_ETAG_SUFFIXES = {JSON: '', CSV: '.csv', NDJSON: '.ndjson', COLUMNS: '.columns'}
+
+
+def parse_int(name, value):
+    """
+    Reads an optional integer parameter
+    Params:
+        name : parameter name, used in the error message
+        value : raw string from the request, or None when it was not sent
+    Returns:
+        The integer, or None
+    Raises:
+        ValueError with a message fit for a 400 response
+    """
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError('%s must be an integer' % name)
+
+def show_id(value):
+    """
+    Validates the id query parameter of /show
+    Returns:
+        The movie id as an integer
+    Raises:
+        ValueError with a message fit for a 400 response
+    """
+    movie_id = parse_int('id', value)
+    if movie_id is None:
+        raise ValueError('id is required')
+    return movie_id
+
+def parse_fields(value):
+    """
+    Reads a fields=title,year projection
+    Returns:
+        Tuple of movie column names, or None for every column
+    Raises:
+        ValueError with a message fit for a 400 response
+    """
+    if value is None:
+        return None
+    return movie_fields(field.strip() for field in value.split(',') if field.strip())
+
+def list_details_args(args):
+    """
+    Validates the query parameters of /list_details
+    Params:
+        args : mapping of query parameters
+    Returns:
+        (limit, after_id, stream, fields) tuple
+    Raises:
+        ValueError with a message fit for a 400 response
+    """
+    limit = parse_int('limit', args.get('limit'))
+    after_id = parse_int('after_id', args.get('after_id'))
+    stream = args.get('stream')
+    if stream is not None and stream not in STREAM_FORMATS:
+        raise ValueError("stream must be 'json' or 'ndjson'")
+    if limit is not None and limit < 1:
+        raise ValueError('limit must be positive')
+    return limit, after_id, stream, parse_fields(args.get('fields'))
+
+def batch_args(args, document):
+    """
+    Validates a batch write: the mode query parameter and the JSON body
+    Params:
+        args : mapping of query parameters; mode is 'atomic' (the default) or 'partial'
+        document : the decoded JSON body, which must be an array of item objects
+    Returns:
+        (items, atomic) tuple
+    Raises:
+        ValueError with a message fit for a 400 response
+    """
+    mode = args.get('mode', 'atomic')
+    if mode not in BATCH_MODES:
+        raise ValueError("mode must be 'atomic' or 'partial'")
+    if not isinstance(document, list):
+        raise ValueError('the body must be a JSON array of items')
+    if len(document) > MAX_BATCH_ITEMS:
+        raise ValueError('a batch holds at most %d items' % MAX_BATCH_ITEMS)
+    return document, mode == 'atomic'
+
+def encode_cursor(after):
+    """Turns a search page's (sort value, id) cursor into the opaque after= parameter"""
+    return base64.urlsafe_b64encode(encode(list(after))).rstrip(b'=').decode('ascii')
+
+def decode_cursor(token):
+    """
+    Reads an after= parameter made by encode_cursor()
+    Raises:
+        ValueError with a message fit for a 400 response
+    """
+    try:
+        after = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        after = None
+    if not isinstance(after, list) or len(after) != 2:
+        raise ValueError('after must be the cursor from a next link')
+    return tuple(after)
+
+def search_args(args):
+    """
+    Validates the query parameters of /movies/search
+    Params:
+        args : mapping of query parameters: q, match, year_min, year_max,
+               rating_min, rating_max, sort (prefix '-' for descending), limit,
+               after and fields
+    Returns:
+        (query, limit): query holds the keyword arguments of bechdel_db.search
+        other than limit
+    Raises:
+        ValueError with a message fit for a 400 response
+    """
+    limit = parse_int('limit', args.get('limit'))
+    if limit is not None and limit < 1:
+        raise ValueError('limit must be positive')
+    sort = args.get('sort', 'id')
+    query = {'q': args.get('q') or None,
+             'match': args.get('match', 'prefix'),
+             'sort': sort.lstrip('-'),
+             'descending': sort.startswith('-'),
+             'after': decode_cursor(args['after']) if args.get('after') else None,
+             'fields': parse_fields(args.get('fields'))}
+    for name in ('year_min', 'year_max', 'rating_min', 'rating_max'):
+        query[name] = parse_int(name, args.get(name))
+    limit = min(limit or SEARCH_PAGE_SIZE, MAX_PAGE_SIZE)
+    search_sql(limit=limit, **query)  # rejects bad sorts, matches and cursors
+    return query, limit
+
+def search_link(path, args, after):
+    """
+    Builds the Link header pointing at the next page of a search
+    Params:
+        args : the query parameters of the current page
+        after : the cursor from bechdel_db.search, None on the last page
+    Returns:
+        The header value, or None
+    """
+    if after is None:
+        return None
+    query = [(name, value) for name, value in args.items() if name != 'after']
+    query.append(('after', encode_cursor(after)))
+    return '<%s?%s>; rel="next"' % (path, urlencode(query, safe=','))
+
+def search_key(query, limit):
+    """A hashable key naming one page of search results, for the body cache"""
+    return ('search', limit) + tuple(sorted(query.items()))
+
+def negotiate_format(accept):
+    """
+    Picks the representation of a movie listing from the raw Accept header;
+    anything the API does not offer gets JSON
+    """
+    if not accept:
+        return JSON
+    return parse_accept_header(accept, MIMEAccept).best_match(TABLE_FORMATS, default=JSON)
+
+def content_type(media_type):
+    """The Content-Type header value for a representation"""
+    return media_type + '; charset=utf-8' if media_type == CSV else media_type
+
+def page_size(limit):
+    """Caps a requested page size at MAX_PAGE_SIZE"""
+    return min(limit or MAX_PAGE_SIZE, MAX_PAGE_SIZE)
+
+def next_page_link(path, rows, limit, id_index=0, fields=None):
+    """
+    Builds the Link header pointing at the page after rows
+    Params:
+        id_index : position of the id column in each row
+        fields : the page's projection, carried over to the next page
+    Returns:
+        The header value, or None if rows was the last page
+    """
+    if len(rows) < limit:
+        return None
+    query = {'limit': limit, 'after_id': rows[-1][id_index]}
+    if fields is not None:
+        query['fields'] = ','.join(fields)
+    return '<%s?%s>; rel="next"' % (path, urlencode(query, safe=','))
+
+def page_fields(fields):
+    """Columns to load for a keyset page: the projection, plus the id the next link needs"""
+    if fields is None or 'id' in fields:
+        return fields
+    return ('id',) + fields
+
+def encode_page(rows, path, limit, fields, media_type):
+    """
+    Encodes one keyset page of a movie listing
+    Params:
+        rows : the page, loaded with the columns page_fields(fields) names
+        path, limit, fields : the page being built
+        media_type : one of TABLE_FORMATS
+    Returns:
+        (body, link) with link None on the last page
+    """
+    if fields is None or 'id' in fields:
+        id_index = 0 if fields is None else fields.index('id')
+        return encode_table(rows, fields, media_type), next_page_link(path, rows, limit, id_index, fields)
+    link = next_page_link(path, rows, limit, 0, fields)
+    return encode_table([row[1:] for row in rows], fields, media_type), link
+
+def encode_table(rows, fields, media_type):
+    """
+    Encodes movie rows in one of TABLE_FORMATS
+    Params:
+        rows : the rows, holding the columns named by fields
+        fields : column names (None for every column)
+    """
+    columns = MOVIE_COLUMNS if fields is None else fields
+    if media_type == CSV:
+        return encode_csv(rows, columns)
+    if media_type == NDJSON:
+        return encode_ndjson(rows)
+    if media_type == COLUMNS:
+        return encode_columns(rows, columns)
+    return encode_rows(rows)
+
+def session_key_from(headers, cookies):
+    """
+    Finds the caller's session key, so every request is authenticated on its own.
+    Looked for, in order, in an "Authorization: Bearer" header, an X-Session-Key
+    header and the session_key cookie set by /login.
+    Params:
+        headers : mapping of request headers
+        cookies : mapping of request cookies
+    Returns:
+        The session key, or None if the request carries none
+    """
+    authorization = headers.get('Authorization', '')
+    if authorization[:7].lower() == 'bearer ':
+        return authorization[7:].strip()
+    return headers.get(SESSION_HEADER) or cookies.get(SESSION_COOKIE)
+
+def movies_validators(version, media_type=JSON):
+    """
+    Turns a movies table version into the validators sent with every read
+    Params:
+        version : (version, modified_at) from movies_version()
+        media_type : the representation being sent (one of TABLE_FORMATS)
+    Returns:
+        (etag, last_modified) with last_modified truncated to whole seconds in UTC
+    """
+    number, modified_at = version
+    etag = 'movies-%d%s' % (number, _ETAG_SUFFIXES[media_type])
+    return etag, modified_at.astimezone(timezone.utc).replace(microsecond=0)
+
+def not_modified(etag, last_modified, if_none_match, if_modified_since, variants=()):
+    """
+    Decides whether a conditional GET can be answered with 304 Not Modified
+    Params:
+        etag, last_modified : validators of the current representation
+        if_none_match, if_modified_since : the raw request headers (or None)
+        variants : other ETags of the same content (e.g. compressed copies)
+    Returns:
+        True if the client's copy is still current
+    """
+    if if_none_match:
+        etags = parse_etags(if_none_match)
+        return any(etags.contains(tag) for tag in [etag, *variants])
+    since = parse_date(if_modified_since) if if_modified_since else None
+    if since is not None and since.tzinfo is None:
+        since = since.replace(tzinfo=timezone.utc)
+    return since is not None and last_modified <= since
+
+def keys_body(rows, media_type=JSON):
+    """
+    Encodes list_all_keys() rows: as the {id: imdbid} object the API has always
+    returned for JSON, or as an (id, imdbid) table in the other formats
+    """
+    if media_type == JSON:
+        return encode(dict(rows))
+    return encode_table(rows, ('id', 'imdbid'), media_type)
+
+def stats_body(rows):
+    """
+    Encodes movie_stats() rows as totals, a rating histogram and the pass rate
+    (share of movies rated PASS_RATING), overall and for each year:
+    {"movies": n, "ratings": {"0": n, ...}, "pass_rate": r, "years": {"1999": {...}, ...}}
+    """
+    def summary(counts):
+        movies = sum(counts.values())
+        return {'movies': movies,
+                'ratings': {str(rating): count for rating, count in sorted(counts.items())},
+                'pass_rate': round(counts.get(PASS_RATING, 0) / movies, 4) if movies else None}
+
+    overall = {}
+    years = {}
+    for year, rating, movies in rows:
+        overall[rating] = overall.get(rating, 0) + movies
+        years.setdefault(year, {})[rating] = movies
+    return encode(dict(summary(overall), years={str(year): summary(counts) for year, counts in years.items()}))
+
+def error_body(message):
+    """Encodes the {"message": ...} body Flask-RESTful's abort() answers with"""
+    return encode({'message': message})
+
+def ndjson_chunk(rows):
+    """Encodes one batch of a streamed table as NDJSON"""
+    return encode_ndjson(rows)
+
+def json_array_chunk(rows, first):
+    """Encodes one batch of a streamed JSON array, without the brackets"""
+    return (b'' if first else b',') + b','.join(encode_row(row) for row in rows)
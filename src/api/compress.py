@@ -0,0 +1,99 @@
+import gzip
+from flask import request
+from werkzeug.http import parse_accept_header
+from db.cache import LRUCache
+from db.config import get_settings, on_reload
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Encodings offered, best first; brotli only when the module is installed
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+def negotiate(accept_encoding):
+    """
+    Picks the content coding for a response
+    Params:
+        accept_encoding : the raw Accept-Encoding request header (or None)
+    Returns:
+        'br', 'gzip' or None for an uncompressed response
+    """
+    if not accept_encoding:
+        return None
+    return parse_accept_header(accept_encoding).best_match(ENCODINGS)
+
+def compress(body, encoding):
+    """Compresses bytes with the given content coding; gzip output has no timestamp, so it is reproducible"""
+    settings = get_settings()
+    if encoding == 'br':
+        return brotli.compress(body, quality=settings.compress_level)
+    return gzip.compress(body, compresslevel=settings.compress_level, mtime=0)
+
+def encoded_etag(etag, encoding):
+    """The ETag of a compressed representation; it must differ from the identity one"""
+    return '%s-%s' % (etag, encoding)
+
+def etag_variants(etag):
+    """Every ETag a client may hold for one representation, compressed or not"""
+    return [etag] + [encoded_etag(etag, encoding) for encoding in ENCODINGS]
+
+
+_compressed = None
+
+def compressed_cache():
+    """Returns the cache of compressed bodies, sized from the settings on first use"""
+    global _compressed
+    if _compressed is None:
+        _compressed = LRUCache(get_settings().compressed_cache_size)
+    return _compressed
+
+def _reset(settings=None):
+    global _compressed
+    _compressed = None
+
+on_reload(_reset)
+
+def compress_response(response):
+    """
+    Flask after_request hook that gzip/brotli encodes responses the client accepts.
+    Bodies under compress_min_size bytes are sent as they are. Responses with a
+    strong ETag (the movies reads) are compressed once per ETag, request path and
+    encoding and then served from memory; they get an encoding-specific ETag.
+    Streamed responses are left alone.
+    """
+    if request.method not in ('GET', 'HEAD') or 'Content-Encoding' in response.headers:
+        return response
+    if response.status_code not in (200, 304) or response.is_streamed or response.direct_passthrough:
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = negotiate(request.headers.get('Accept-Encoding'))
+    if encoding is None:
+        return response
+    etag, weak = response.get_etag()
+    cacheable = etag is not None and not weak
+
+    if response.status_code == 304:
+        # Confirm the compressed copy the client holds, not the identity one
+        if cacheable and request.if_none_match.contains(encoded_etag(etag, encoding)):
+            response.set_etag(encoded_etag(etag, encoding))
+        return response
+
+    cache = compressed_cache()
+    key = (etag, request.full_path, encoding)
+    body = cache.get(key, None) if cacheable else None
+    if body is None:
+        original = response.get_data()
+        if len(original) < get_settings().compress_min_size:
+            return response
+        body = compress(original, encoding)
+        if cacheable:
+            cache.set(key, body)
+
+    response.set_data(body)
+    response.headers['Content-Encoding'] = encoding
+    if cacheable:
+        response.set_etag(encoded_etag(etag, encoding))
+    return response
@@ -0,0 +1,147 @@
+import cProfile
+import itertools
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from werkzeug.wrappers import Request
+from api import common
+from db import bechdel_db
+from db.config import get_settings
+
+# Profiles single live requests with cProfile. A request is profiled when an
+# admin sends "X-Profile: 1", or when it is the Nth since the last sampled
+# one (profile_sample_every; 0 turns sampling off). The profiler wraps the
+# whole WSGI call, body included, so it covers Flask-RESTful dispatch, the
+# bechdel_db calls, JSON encoding, compression and streamed bodies.
+#
+# Profiles are written in the pstats format (open them with
+# pstats.Stats(path) or snakeviz) to profile_dir, where every worker of
+# serve.py can serve them, keeping the newest profile_keep. The profiled
+# response names its profile in the X-Profile-Id header.
+
+PROFILE_HEADER = 'X-Profile'
+PROFILE_ID_HEADER = 'X-Profile-Id'
+PROFILE_ID = re.compile(r'^\d+-\d+-\d+$')
+
+# cProfile cannot always run in two threads at once, so one request is profiled at a time
+_busy = threading.Lock()
+_requests = itertools.count(1)
+_serial = itertools.count(1)
+
+
+def profile_dir():
+    """The directory profiles are written to, created on first use"""
+    path = get_settings().profile_dir or os.path.join(tempfile.gettempdir(), 'bechdel-profiles')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def _paths(profile_id):
+    base = os.path.join(profile_dir(), profile_id)
+    return base + '.prof', base + '.json'
+
+def list_profiles():
+    """Metadata of the kept profiles, newest first"""
+    profiles = []
+    for name in sorted(os.listdir(profile_dir()), reverse=True):
+        if name.endswith('.json'):
+            try:
+                with open(os.path.join(profile_dir(), name)) as file:
+                    profiles.append(json.load(file))
+            except (OSError, ValueError):
+                pass  # pruned or still being written by another worker
+    return profiles
+
+def read_profile(profile_id):
+    """The pstats data of a profile, or None if there is no such profile"""
+    if not PROFILE_ID.match(profile_id or ''):
+        return None
+    try:
+        with open(_paths(profile_id)[0], 'rb') as file:
+            return file.read()
+    except FileNotFoundError:
+        return None
+
+def _prune(keep):
+    names = sorted(name[:-len('.json')] for name in os.listdir(profile_dir()) if name.endswith('.json'))
+    for profile_id in names[:max(0, len(names) - keep)]:
+        for path in _paths(profile_id):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+def _save(profiler, environ, status, seconds):
+    settings = get_settings()
+    profile_id = '%d-%d-%d' % (time.time() * 1000, os.getpid(), next(_serial))
+    prof_path, meta_path = _paths(profile_id)
+    profiler.dump_stats(prof_path)
+    meta = {
+        'id': profile_id,
+        'at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'method': environ.get('REQUEST_METHOD'),
+        'path': environ.get('PATH_INFO'),
+        'status': status,
+        'ms': round(seconds * 1000, 3),
+        'pid': os.getpid(),
+    }
+    # The metadata is written last: a profile is listed only once its stats are complete
+    with open(meta_path + '.tmp', 'w') as file:
+        json.dump(meta, file)
+    os.replace(meta_path + '.tmp', meta_path)
+    _prune(settings.profile_keep)
+    return profile_id
+
+
+class ProfilingMiddleware:
+    """
+    WSGI middleware around the Flask app that profiles the requests picked by
+    wants_profile() and passes every other request straight through
+    """
+    def __init__(self, app):
+        self.app = app
+
+    def wants_profile(self, environ):
+        every = get_settings().profile_sample_every
+        if every > 0 and next(_requests) % every == 0:
+            return True
+        if environ.get('HTTP_' + PROFILE_HEADER.upper().replace('-', '_')) != '1':
+            return False
+        request = Request(environ)
+        admins = get_settings().admins
+        return bool(admins) and bechdel_db.session_user(common.session_key_from(request.headers, request.cookies)) in admins
+
+    def __call__(self, environ, start_response):
+        if not self.wants_profile(environ) or not _busy.acquire(blocking=False):
+            return self.app(environ, start_response)
+        try:
+            return self._profiled(environ, start_response)
+        finally:
+            _busy.release()
+
+    def _profiled(self, environ, start_response):
+        captured = {}
+        def capture(status, headers, exc_info=None):
+            captured.update(status=status, headers=headers, exc_info=exc_info)
+            return lambda data: captured.setdefault('written', []).append(data)
+
+        def run():
+            iterable = self.app(environ, capture)
+            try:
+                body = list(iterable)
+                return captured.get('written', []) + body
+            finally:
+                if hasattr(iterable, 'close'):
+                    iterable.close()
+
+        profiler = cProfile.Profile()
+        started = time.perf_counter()
+        body = profiler.runcall(run)
+        seconds = time.perf_counter() - started
+        status = int(captured['status'].split(None, 1)[0])
+        profile_id = _save(profiler, environ, status, seconds)
+        start_response(captured['status'], list(captured['headers']) + [(PROFILE_ID_HEADER, profile_id)],
+                       captured['exc_info'])
+        return body
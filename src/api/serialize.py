@@ -0,0 +1,129 @@
+import csv
+import io
+import json
+import threading
+from db.cache import LRUCache, MISSING
+from db.config import get_settings, on_reload
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - the stdlib encoder produces the same bytes
+    orjson = None
+
+# Response bodies are built as bytes once and reused. Both encoders produce
+# compact JSON, so the bytes (and the Content-Length) do not depend on which
+# one is installed.
+
+def encode(value):
+    """Encodes a value as compact UTF-8 JSON, with orjson when it is installed"""
+    if orjson is not None:
+        return orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(value, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+_rows = {}
+_rows_lock = threading.Lock()
+
+def encode_row(row):
+    """
+    Encodes one movie row. Without orjson the encoding is remembered, keyed by
+    the row's own contents, so an unchanged row is never encoded twice and a
+    changed row can never be served stale.
+    """
+    if orjson is not None:
+        return orjson.dumps(row)
+    encoded = _rows.get(row)
+    if encoded is None:
+        encoded = encode(row)
+        limit = get_settings().row_cache_size
+        if limit > 0:
+            with _rows_lock:
+                if len(_rows) >= limit:
+                    _rows.clear()
+                _rows[row] = encoded
+    return encoded
+
+def encode_rows(rows):
+    """Encodes a list of movie rows as a JSON array"""
+    if orjson is not None:
+        return orjson.dumps(rows)
+    return b'[' + b','.join(encode_row(row) for row in rows) + b']'
+
+def encode_ndjson(rows):
+    """Encodes rows as NDJSON, one JSON array per line"""
+    return b''.join(encode_row(row) + b'\n' for row in rows)
+
+def encode_csv(rows, columns, header=True):
+    """Encodes rows as CSV, with a header line naming the columns"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    if header:
+        writer.writerow(columns)
+    writer.writerows(rows)
+    return buffer.getvalue().encode('utf-8')
+
+def encode_columns(rows, columns):
+    """Encodes rows column by column: {"id": [...], "title": [...], ...}"""
+    return encode({column: [row[index] for row in rows] for index, column in enumerate(columns)})
+
+
+class BodyCache:
+    """
+    Prebuilt response bodies keyed by movies table version. A body is only
+    ever looked up under the version that was current when it was built, so
+    no invalidation is needed: the first request to see a newer version
+    drops everything built for older ones.
+    Params:
+        maxsize : bodies kept for the current version (0 disables the cache)
+    """
+    def __init__(self, maxsize):
+        self._cache = LRUCache(maxsize)
+        self._version = None
+        self._lock = threading.Lock()
+
+    def _advance(self, version):
+        with self._lock:
+            if self._version is None or version > self._version:
+                self._version = version
+                self._cache.clear()
+            return version == self._version
+
+    def get(self, version, key):
+        """Returns the body built for key at this table version, or MISSING"""
+        if not self._advance(version[0]):
+            return MISSING
+        return self._cache.get(key)
+
+    def set(self, version, key, body):
+        """Keeps a body built for key at this table version"""
+        if self._advance(version[0]):
+            self._cache.set(key, body)
+
+    def get_or_build(self, version, key, build):
+        """Returns the cached body for key, calling build() and keeping its result on a miss"""
+        body = self.get(version, key)
+        if body is MISSING:
+            body = build()
+            self.set(version, key, body)
+        return body
+
+    def stats(self):
+        return dict(self._cache.stats(), version=self._version)
+
+
+_bodies = None
+
+def bodies():
+    """Returns the process-wide BodyCache, sized from the settings on first use"""
+    global _bodies
+    if _bodies is None:
+        _bodies = BodyCache(get_settings().body_cache_size)
+    return _bodies
+
+def _reset(settings=None):
+    global _bodies
+    _bodies = None
+    with _rows_lock:
+        _rows.clear()
+
+on_reload(_reset)
@@ -0,0 +1,171 @@
+# Batch writes to the movies table. Every item of a batch is validated up
+# front, then the whole batch is applied with one statement that receives its
+# columns as arrays (unnest ... WITH ORDINALITY), so a batch costs the same
+# number of round trips whatever its size. The SQL and the per-item results
+# are shared by bechdel_db (psycopg2) and bechdel_db_async (psycopg 3); the
+# callers own the connection, the transaction and the savepoints.
+
+MODES = ('atomic', 'partial')
+
+# When the batch statement fails, the items are replayed one at a time, each
+# in this savepoint, to find the ones at fault
+SAVEPOINT = 'SAVEPOINT batch'
+ROLLBACK_TO_SAVEPOINT = 'ROLLBACK TO SAVEPOINT batch'
+NEXT_SAVEPOINT = 'RELEASE SAVEPOINT batch; SAVEPOINT batch'
+
+# Per-item statuses in a batch report
+CREATED = 'created'
+DELETED = 'deleted'
+UPDATED = 'updated'
+NOT_FOUND = 'not_found'
+INVALID = 'invalid'
+FAILED = 'failed'
+NOT_APPLIED = 'not_applied'
+
+
+def _int_field(item, name):
+    value = item.get(name)
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        raise ValueError('%s must be an integer' % name)
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError('%s must be an integer' % name)
+
+def _title_field(item):
+    title = item.get('title')
+    if not isinstance(title, str) or not title:
+        raise ValueError('title must be a non-empty string')
+    return title
+
+def error_message(error):
+    """The primary message of a database error, from either driver"""
+    diag = getattr(error, 'diag', None)
+    return getattr(diag, 'message_primary', None) or str(error)
+
+
+class Batch:
+    """
+    One batch of writes: the items still to apply and a result for each item,
+    reported in the order the items were given
+    Params:
+        items : list of JSON objects, one per write
+    """
+    SQL = None
+
+    def __init__(self, items):
+        self.results = [None] * len(items)
+        self.pending = []
+        self.changed_ids = []
+        for index, item in enumerate(items):
+            try:
+                if not isinstance(item, dict):
+                    raise ValueError('each item must be an object')
+                self.pending.append((index, self.validate(item)))
+            except ValueError as error:
+                self.results[index] = {'status': INVALID, 'error': str(error)}
+
+    @property
+    def has_errors(self):
+        """True once any item was found invalid or failed in the database"""
+        return any(result is not None and result['status'] in (INVALID, FAILED) for result in self.results)
+
+    def args(self, entries):
+        """The statement arguments for some of the pending entries: one list per column"""
+        return [list(column) for column in zip(*(values for _, values in entries))]
+
+    def fail(self, entries, error):
+        for index, _ in entries:
+            self.results[index] = {'status': FAILED, 'error': error_message(error)}
+
+    def report(self, committed):
+        """
+        Returns:
+            {"committed": bool, "results": [...]}; items of a batch that was not
+            committed are reported as not_applied unless they were at fault
+        """
+        results = []
+        for result in self.results:
+            if result is None or (not committed and result['status'] not in (INVALID, FAILED)):
+                result = {'status': NOT_APPLIED}
+            results.append(result)
+        return {'committed': committed, 'results': results}
+
+    def record(self, entries, rows):
+        """Fills in the results of entries from the rows the statement returned"""
+        raise NotImplementedError
+
+
+class CreateBatch(Batch):
+    """Items are {"title", "rating", "year"}; each result carries the new row"""
+    # Identity values are drawn in the order the rows are inserted, which the
+    # ORDER BY fixes, so sorting the returned rows by id restores item order
+    SQL = """INSERT INTO movies(rating, title, year)
+             SELECT rating, title, year
+             FROM unnest(%s::INTEGER[], %s::TEXT[], %s::INTEGER[]) WITH ORDINALITY AS item(rating, title, year, ord)
+             ORDER BY ord
+             RETURNING id, imdbid, rating, title, year"""
+
+    def validate(self, item):
+        return _int_field(item, 'rating'), _title_field(item), _int_field(item, 'year')
+
+    def record(self, entries, rows):
+        for (index, _), row in zip(entries, sorted(rows)):
+            self.results[index] = {'status': CREATED, 'movie': list(row)}
+            self.changed_ids.append(row[0])
+
+
+class DeleteBatch(Batch):
+    """
+    Items are {"title"}; each deletes the most recently added movie with that
+    title, so a title repeated n times deletes its n newest movies
+    """
+    SQL = """WITH item AS (
+               SELECT ord, title, row_number() OVER (PARTITION BY title ORDER BY ord) AS n
+               FROM unnest(%s::TEXT[]) WITH ORDINALITY AS item(title, ord)),
+             target AS (
+               SELECT id, title, row_number() OVER (PARTITION BY title ORDER BY id DESC) AS n
+               FROM movies WHERE title IN (SELECT title FROM item))
+             DELETE FROM movies USING item JOIN target USING (title, n)
+             WHERE movies.id = target.id
+             RETURNING item.ord, movies.id"""
+
+    def validate(self, item):
+        return (_title_field(item),)
+
+    def record(self, entries, rows):
+        deleted = {ord: movie_id for ord, movie_id in rows}
+        for position, (index, _) in enumerate(entries, 1):
+            if position in deleted:
+                self.results[index] = {'status': DELETED, 'id': deleted[position]}
+                self.changed_ids.append(deleted[position])
+            else:
+                self.results[index] = {'status': NOT_FOUND}
+
+
+class RatingBatch(Batch):
+    """
+    Items are {"title", "rating"}; like /update_rating each one re-rates every
+    movie with the title. When a title is repeated the last rating wins.
+    """
+    SQL = """WITH item AS (
+               SELECT DISTINCT ON (title) title, rating
+               FROM unnest(%s::TEXT[], %s::INTEGER[]) WITH ORDINALITY AS item(title, rating, ord)
+               ORDER BY title, ord DESC)
+             UPDATE movies SET rating = item.rating FROM item
+             WHERE movies.title = item.title
+             RETURNING movies.title, movies.id"""
+
+    def validate(self, item):
+        return _title_field(item), _int_field(item, 'rating')
+
+    def record(self, entries, rows):
+        updated = {}
+        for title, movie_id in rows:
+            updated.setdefault(title, []).append(movie_id)
+            self.changed_ids.append(movie_id)
+        for index, (title, _) in entries:
+            if title in updated:
+                self.results[index] = {'status': UPDATED, 'ids': sorted(updated[title])}
+            else:
+                self.results[index] = {'status': NOT_FOUND}
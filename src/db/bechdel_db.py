@@ -1,68 +1,652 @@
 import os
-import json
-from psycopg2.extras import execute_values
+import re
+import psycopg2
 import hashlib
 import secrets
+import threading
+import time
+from datetime import datetime
 from .swen344_db_utils import *
+from .batch import CreateBatch, DeleteBatch, RatingBatch, SAVEPOINT, ROLLBACK_TO_SAVEPOINT, NEXT_SAVEPOINT
+from .cache import LRUCache
+from .notify import ChangeListener, MOVIES_CHANNEL, SESSIONS_CHANNEL, notify_movies_changed, notify_sessions_revoked, notify_tokens_revoked
+from .tokens import Denylist, is_token, issue_token, verify_token
+from .migrate import migrate
+from .bulk_import import COLUMNS as MOVIE_COLUMNS, DEFAULT_CHUNK_ROWS, copy_movies, iter_json_array
+
+_show_cache = None
+_list_cache = None
+_session_cache = None
+_listener = None
+_listener_lock = threading.Lock()
+_movies_version = None  # newest (version, modified_at) of the movies table seen by this worker
+_version_lock = threading.Lock()
+_denylist = Denylist()
+
+# The statements every request runs, prepared once per pooled connection
+MOVIES_VERSION = prepared_statement('movies_version', """SELECT version, modified_at FROM table_versions
+                                                         WHERE table_name = 'movies'""")
+SHOW_MOVIE = prepared_statement('show_movie', """SELECT * FROM movies WHERE id = %s""")
+# movies.id is an INTEGER, so an id outside this range cannot match (and cannot be sent as one)
+MOVIE_IDS = range(-2 ** 31, 2 ** 31)
+SESSION_USER = prepared_statement('session_username', """SELECT username FROM system_users WHERE session_key = %s""")
+SESSION_EXISTS = prepared_statement('session_exists', """SELECT 1 FROM system_users WHERE session_key = %s LIMIT 1""")
+TOKEN_REVOKED = prepared_statement('token_revoked', """SELECT 1 FROM revoked_tokens WHERE jti = %s""")
+LOGIN_USER = prepared_statement('login_user', """SELECT username FROM system_users WHERE username = %s AND passw = %s""")
+
+# The other statements of the request path, which bechdel_db_async runs as they
+# are through psycopg 3 (both drivers take %s placeholders)
+LIST_KEYS_SQL = """SELECT id, imdbid FROM movies"""
+MOVIE_STATS_SQL = """SELECT year, rating, movies FROM movie_stats ORDER BY year, rating"""
+CREATE_USER_SQL = """INSERT INTO system_users (username, passw) VALUES (%s, %s)"""
+INSERT_MOVIE_SQL = """INSERT INTO movies(rating, title, year) VALUES (%s, %s, %s)
+                      RETURNING id, imdbid, rating, title, year"""
+# When several movies share the title, the most recently added one goes
+DELETE_MOVIE_SQL = """DELETE FROM movies
+                      WHERE id = (SELECT id FROM movies WHERE title = %s ORDER BY id DESC LIMIT 1)
+                      RETURNING id"""
+UPDATE_RATING_SQL = """UPDATE movies SET rating = %s WHERE title = %s RETURNING id"""
+BUMP_MOVIES_VERSION_SQL = """UPDATE table_versions SET version = version + 1, modified_at = clock_timestamp()
+                             WHERE table_name = 'movies' RETURNING version, modified_at"""
+# Logging in again replaces the previous key, which must stop working everywhere
+START_SESSION_SQL = """UPDATE system_users AS u SET session_key = %s
+                       FROM (SELECT username, session_key FROM system_users WHERE username = %s FOR UPDATE) AS old
+                       WHERE u.username = old.username
+                       RETURNING old.session_key"""
+END_SESSION_SQL = """UPDATE system_users SET session_key = 'None' WHERE session_key = %s"""
+REVOKE_TOKEN_SQL = """INSERT INTO revoked_tokens(jti, expires_at) VALUES (%s, %s) ON CONFLICT (jti) DO NOTHING"""
+PURGE_REVOKED_TOKENS_SQL = """DELETE FROM revoked_tokens WHERE expires_at <= %s"""
+
+LOGIN_OK = 'Login was successful'
+LOGIN_INVALID = (0, 'Login invalid')
+
+# The caches, the table version, the denylist and the session and token
+# checks below are public because bechdel_db_async shares them
+
+def movie_caches():
+    """Returns the (show, list) caches, sized from the settings on first use"""
+    global _show_cache, _list_cache
+    if _show_cache is None or _list_cache is None:
+        settings = get_settings()
+        enabled = settings.cache_enabled
+        ttl = settings.cache_ttl if settings.cache_ttl > 0 else None
+        _show_cache = LRUCache(settings.cache_show_size if enabled else 0, ttl)
+        _list_cache = LRUCache(settings.cache_list_size if enabled else 0, ttl)
+        if enabled:
+            start_cache_listener()
+    return _show_cache, _list_cache
+
+def session_cache():
+    """Returns the cache of session keys known to be valid (keyed by digest), sized from the settings on first use"""
+    global _session_cache
+    if _session_cache is None:
+        settings = get_settings()
+        enabled = settings.cache_enabled
+        ttl = settings.session_cache_ttl if settings.session_cache_ttl > 0 else None
+        _session_cache = LRUCache(settings.session_cache_size if enabled else 0, ttl)
+        if enabled:
+            start_cache_listener()
+    return _session_cache
+
+def cache_usable(cache):
+    """
+    Caches are only trusted while the change listener is connected; without it
+    this worker would not hear about other workers' writes
+    """
+    listener = _listener  # read once, stop_cache_listener() may clear it meanwhile
+    return cache.maxsize > 0 and listener is not None and listener.healthy.is_set()
+
+def _cached(cache, key, loader):
+    """Reads through the cache when it is usable, straight from the loader otherwise"""
+    if cache.maxsize > 0 and not cache_usable(cache):
+        return loader()
+    return cache.get_or_load(key, loader)
+
+def _on_movies_message(message):
+    if message is None:
+        apply_movie_change(None, None)
+    else:
+        apply_movie_change(message.get('ids'), message.get('version'))
+
+def _on_sessions_message(message):
+    if message is None:
+        forget_sessions()
+        _load_denylist()
+        return
+    if 'digests' in message:
+        forget_sessions(message['digests'])
+    if 'tokens' in message:
+        if message['tokens'] is None:
+            _load_denylist()
+        else:
+            for jti, exp in message['tokens']:
+                _denylist.add(jti, exp)
+
+def start_cache_listener():
+    """
+    Starts the background thread that applies other workers' movie changes and
+    logouts to this worker's caches (see notify.py). Safe to call more than once.
+    Returns:
+        The running ChangeListener
+    """
+    global _listener
+    with _listener_lock:
+        if _listener is None or not _listener.is_alive():
+            _listener = ChangeListener({MOVIES_CHANNEL: _on_movies_message,
+                                        SESSIONS_CHANNEL: _on_sessions_message})
+            _listener.start()
+        return _listener
+
+def stop_cache_listener():
+    """Stops the change listener; cached reads are bypassed until it is started again"""
+    global _listener
+    with _listener_lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
+
+def _reset_caches(settings=None):
+    global _show_cache, _list_cache, _session_cache
+    _show_cache = None
+    _list_cache = None
+    _session_cache = None
+
+on_reload(_reset_caches)
+
+_inherited_listeners = []
+
+def _reset_after_fork():
+    """
+    Forked workers start with no listener thread (threads do not survive fork)
+    and empty caches; the parent's listener object is kept referenced so its
+    connection, whose socket the parent still owns, is never closed from here.
+    """
+    global _listener, _listener_lock, _version_lock, _denylist
+    if _listener is not None:
+        _inherited_listeners.append(_listener)
+    _listener = None
+    _listener_lock = threading.Lock()
+    _version_lock = threading.Lock()
+    _denylist = Denylist()
+    note_movies_version(None)
+    _reset_caches()
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+def invalidate_movies(ids=None):
+    """
+    Drops cached reads that a change to the given movies could have made stale
+    Params:
+        ids : ids of the movies that were inserted, deleted or updated (None for all movies)
+    Returns:
+        None
+    """
+    show_cache, list_cache = movie_caches()
+    list_cache.clear()
+    if ids is None:
+        show_cache.clear()
+    else:
+        for movie_id in ids:
+            show_cache.invalidate(str(movie_id))
+
+def note_movies_version(version):
+    """Remembers a movies table version if it is newer than the one already known"""
+    global _movies_version
+    with _version_lock:
+        if version is None:
+            _movies_version = None
+        elif _movies_version is None or version[0] > _movies_version[0]:
+            _movies_version = tuple(version)
+
+def _movies_changed(cur, ids=None):
+    """
+    Records a change to the movies table inside the caller's transaction:
+    bumps the table version and queues the NOTIFY for the other workers
+    Returns:
+        The new (version, modified_at), to be passed to apply_movie_change() after commit
+    """
+    cur.execute(BUMP_MOVIES_VERSION_SQL)
+    version = cur.fetchone()
+    notify_movies_changed(cur, ids, version)
+    return version
+
+def apply_movie_change(ids, version):
+    """Brings this worker's caches and table version up to date with a committed change"""
+    invalidate_movies(ids)
+    if version is not None:
+        version = (version[0], datetime.fromisoformat(version[1]) if isinstance(version[1], str) else version[1])
+    note_movies_version(version)
+
+def known_movies_version():
+    """Returns the movies table version held in memory, or None unless the change listener keeps it current"""
+    listener = _listener  # read once, stop_cache_listener() may clear it meanwhile
+    if listener is not None and listener.healthy.is_set():
+        return _movies_version
+    return None
+
+def movies_version():
+    """
+    Returns the current version of the movies table. Served from memory while
+    the change listener keeps it current, otherwise read from table_versions.
+    Returns:
+        (version, modified_at) tuple
+    """
+    version = known_movies_version()
+    if version is not None:
+        return version
+    version = exec_prepared_one(MOVIES_VERSION)
+    note_movies_version(version)
+    return version
+
+def hash_password(password):
+    """Hashes a password the way system_users.passw stores it"""
+    return hashlib.sha512(password.encode('utf-8')).hexdigest()
+
+def session_digest(session_key):
+    """Cache key for a session key, so caches and notifications never hold the key itself"""
+    return hashlib.sha256(str(session_key).encode('utf-8')).hexdigest()
+
+def forget_sessions(digests=None):
+    """
+    Drops session keys from this worker's validation cache
+    Params:
+        digests : digests of the revoked keys (None for every session)
+    Returns:
+        None
+    """
+    cache = session_cache()
+    if digests is None:
+        cache.clear()
+    else:
+        for digest in digests:
+            cache.invalidate(digest)
 
-def rebuild_tables():
-    """Rebuilds tables"""
+def denylist():
+    """Returns this worker's in-memory Denylist of signed tokens revoked before they expired"""
+    return _denylist
+
+def _load_denylist():
+    """Reads the revoked signed tokens that have not expired yet into memory"""
+    if get_settings().token_secret:
+        _denylist.replace(exec_get_all("""SELECT jti, expires_at FROM revoked_tokens WHERE expires_at > %s""",
+                                       (int(time.time()),)))
+
+def is_session_key(value):
+    """False for a missing key and for the 'None' logout leaves behind, which is not a key anyone was given"""
+    return value is not None and str(value) != 'None'
+
+def token_claims(token):
+    """
+    Checks a signed token in the CPU: signature, expiry and the in-memory denylist
+    Returns:
+        The token's claims, or None if it is not valid
+    """
+    claims = verify_token(token, get_settings().token_secret)
+    if claims is None or claims.get('jti') in _denylist:
+        return None
+    return claims
+
+def revocations_known():
+    """
+    True while the change listener keeps the denylist current; otherwise a
+    token that passes token_claims() must still be looked up in revoked_tokens
+    """
+    # Read once: stop_cache_listener() on another thread may clear _listener meanwhile
+    listener = _listener
+    if listener is None:
+        listener = start_cache_listener()
+    return listener.healthy.is_set()
+
+def _token_claims(token):
+    """
+    Checks a signed token (see token_claims). The database is only asked about
+    revocations while the change listener is down.
+    Returns:
+        The token's claims, or None if it is not valid
+    """
+    claims = token_claims(token)
+    if claims is not None and not revocations_known():
+        if exec_prepared_one(TOKEN_REVOKED, (claims['jti'],)) is not None:
+            return None
+    return claims
+
+def known_session(session_key):
+    """True if this worker's cache vouches for a session key, sparing the database lookup"""
+    cache = session_cache()
+    return cache_usable(cache) and cache.get(session_digest(session_key)) is True
+
+def remember_session(session_key, generation):
+    """
+    Caches a session key the database just found valid
+    Params:
+        generation : session_cache().generation read before the lookup, so a
+                     logout that raced with it is not undone
+    """
+    cache = session_cache()
+    if cache_usable(cache):
+        cache.set(session_digest(session_key), True, generation)
+
+def revoked_digests(rows):
+    """Digests of the session keys in rows of (session_key,), skipping users who had none"""
+    return [session_digest(row[0]) for row in rows if is_session_key(row[0])]
+
+def token_login(username):
+    """
+    Logs a user whose password checked out in without writing anything, when auth_mode is token
+    Returns:
+        (token, message), or None when session keys are stored in system_users instead
+    """
+    settings = get_settings()
+    if settings.auth_mode != 'token':
+        return None
+    # Stateless mode: nothing is written, the token vouches for itself
+    return issue_token(username, settings.token_secret, settings.token_ttl), LOGIN_OK
+
+def new_session_key():
+    """A fresh random session key"""
+    return secrets.token_hex(512)
+
+def session_started(session_key, revoked):
+    """
+    Brings this worker's session cache up to date with a committed login
+    Params:
+        session_key : the new key
+        revoked : digests of the keys it replaced (see revoked_digests)
+    Returns:
+        (session_key, message), as generate_session_key returns them
+    """
+    forget_sessions(revoked)
+    session_cache().set(session_digest(session_key), True)
+    return session_key, LOGIN_OK
+
+def cache_stats():
+    """
+    Reports hit, miss and eviction counters for the movie read and session caches
+    Returns:
+        Dictionary with one entry per cache
+    """
+    show_cache, list_cache = movie_caches()
+    return {'show': show_cache.stats(), 'lists': list_cache.stats(), 'sessions': session_cache().stats()}
+
+def _recreate_schema():
+    """Drops every table and recreates them by running all migrations"""
     exec_sql_file('src/db/schema.sql')
+    migrate()
+    with pooled_connection() as conn:
+        cur = conn.cursor()
+        notify_movies_changed(cur)
+        notify_sessions_revoked(cur)
+        conn.commit()
+    apply_movie_change(None, None)
+    forget_sessions()
+    _denylist.replace(())
+
+def rebuild_tables():
+    """Rebuilds tables from scratch (use migrate.migrate() to upgrade a live database)"""
+    _recreate_schema()
 
 def build_movie_table():
     """Builds the movie table and all other tables as well"""
-    exec_sql_file('src/db/schema.sql')
+    _recreate_schema()
 
     with open("src/db/bechdel_test_movies.json", "r") as json_file:
-        data = json.load(json_file)
-    list_of_tuples = []
-    for movie in data:
-        list_of_tuples.append((
-            movie['id'],
-            movie['imdbid'],
-            movie['rating'],
-            movie['title'],
-            movie['year']))
-    conn = connect()
-    cur = conn.cursor()
-    sql = "INSERT INTO movies(id, imdbid, rating, title, year) VALUES %s"
-    execute_values(cur, sql, list_of_tuples)
+        import_movies(iter_json_array(json_file))
 
     #Create the user blorg
     hashed_password = hashlib.sha512(b'saltfatacidheat').hexdigest()
-    cur.execute("INSERT INTO system_users (username, passw) VALUES (%s, %s);", ('blorg', hashed_password))
+    exec_commit("INSERT INTO system_users (username, passw) VALUES (%s, %s);", ('blorg', hashed_password))
 
+def import_movies(records, upsert=False, chunk_rows=DEFAULT_CHUNK_ROWS, progress=None):
+    """
+    Bulk loads movies through COPY in a single transaction (see bulk_import.py)
+    Params:
+        records : iterable of dicts with id, imdbid, rating, title and year
+        upsert : replace existing movies with the same id instead of failing
+        chunk_rows : rows sent per COPY, which bounds memory use
+        progress : optional callable given the running ImportStats after every chunk
+    Returns:
+        ImportStats with the row count and rows/sec
+    """
+    with pooled_connection() as conn:
+        cur = conn.cursor()
+        stats = copy_movies(cur, records, upsert, chunk_rows, progress)
+        reset_movie_sequences(cur)
+        version = _movies_changed(cur)
+        conn.commit()
+    apply_movie_change(None, version)
+    return stats
 
-    conn.commit()
-    conn.close()
+def reset_movie_sequences(cur):
+    """
+    Moves the id and imdbid sequences past the largest values in the table so
+    inserts after a bulk load with explicit ids do not collide
+    Params:
+        cur : cursor of the transaction that loaded the rows
+    Returns:
+        None
+    """
+    cur.execute("""SELECT setval(pg_get_serial_sequence('movies', 'id'), coalesce(max(id), 0) + 1, false),
+                          setval('movies_imdbid_seq', coalesce(max(imdbid), 0) + 1, false)
+                   FROM movies""")
 
 def list_all_keys():
     """
     Lists all keys from movies table
     Params:
     Returns:
-        All keys from movies table
+        All keys from movies table (shared with the cache, do not modify)
+    """
+    _, list_cache = movie_caches()
+    return _cached(list_cache, 'keys', lambda: exec_get_all(LIST_KEYS_SQL))
+
+def movie_fields(fields=None):
+    """
+    Checks a column projection against the movies table
+    Params:
+        fields : sequence of column names, or None for every column
+    Returns:
+        Tuple of the column names, in the order given (MOVIE_COLUMNS for None)
+    Raises:
+        ValueError if a name is not a movies column or is repeated
+    """
+    if fields is None:
+        return MOVIE_COLUMNS
+    fields = tuple(fields)
+    unknown = [field for field in fields if field not in MOVIE_COLUMNS]
+    if unknown:
+        raise ValueError('unknown fields %s (expected some of %s)' % (', '.join(unknown), ', '.join(MOVIE_COLUMNS)))
+    if not fields or len(set(fields)) != len(fields):
+        raise ValueError('fields must name each column at most once')
+    return fields
+
+def details_sql(fields=None, limit=None, after_id=None, ordered=False):
+    """
+    Builds the movie listing query. Column names come from movie_fields(), never
+    from the caller directly, so they are safe to put in the SQL text.
+    Returns:
+        (sql, args) tuple
+    """
+    sql = 'SELECT %s FROM movies' % ('*' if fields is None else ', '.join(movie_fields(fields)))
+    args = []
+    if after_id is not None:
+        sql += ' WHERE id > %s'
+        args.append(after_id)
+    if ordered or limit is not None or after_id is not None:
+        sql += ' ORDER BY id'
+    if limit is not None:
+        sql += ' LIMIT %s'
+        args.append(limit)
+    return sql, args
+
+def list_details(limit=None, after_id=None, fields=None):
     """
-    return exec_get_all('SELECT id, imdbid FROM movies')
+    Lists all details about the movie table, optionally one keyset page at a time
+    Params:
+        limit : maximum number of rows to return (None for all of them)
+        after_id : only return movies whose id is greater than this one
+        fields : columns to return, in order (None for all of them); see movie_fields()
+    Returns:
+        All details from movie table, ordered by id when paginated
+        (shared with the cache, do not modify)
+    """
+    fields = None if fields is None else movie_fields(fields)
+    _, list_cache = movie_caches()
+    return _cached(list_cache, ('details', limit, after_id, fields),
+                   lambda: exec_get_all(*details_sql(fields, limit, after_id)))
 
-def list_details():
+def iter_details(after_id=None, batch_size=1000, fields=None):
     """
-    Lists all details about the entire movie table
+    Streams the movie table in id order through a server-side cursor so only
+    one batch of rows is held in memory at a time
     Params:
+        after_id : only yield movies whose id is greater than this one
+        batch_size : rows fetched from the server per round trip
+        fields : columns to return, in order (None for all of them)
     Returns:
-        All details from movie table
+        Generator of lists of rows, each at most batch_size long
+    """
+    sql, args = details_sql(fields, after_id=after_id, ordered=True)
+    with pooled_connection() as conn:
+        cur = conn.cursor(name='iter_details')
+        cur.itersize = batch_size
+        cur.execute(sql, args)
+        while True:
+            rows = cur.fetchmany(batch_size)
+            if not rows:
+                break
+            yield rows
+        cur.close()
+
+SEARCH_MATCHES = ('prefix', 'words', 'substring')
+SEARCH_SORTS = ('id', 'title', 'year', 'rating')
+_WORD = re.compile(r'\w+')
+
+def _like_pattern(text):
+    """Escapes LIKE wildcards so the text only ever matches itself"""
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def _search_columns(fields, sort):
+    """The requested columns, and those plus the sort column and id that keyset paging needs"""
+    columns = movie_fields(fields)
+    return columns, columns + tuple(column for column in dict.fromkeys((sort, 'id')) if column not in columns)
+
+def search_sql(q=None, match='prefix', year_min=None, year_max=None, rating_min=None, rating_max=None,
+               sort='id', descending=False, limit=100, after=None, fields=None):
     """
-    return exec_get_all('SELECT * FROM movies')
+    Builds the query behind /movies/search. Each title match has an index
+    (migration 0004): prefix uses lower(title), words the full-text index and
+    substring the trigram index where pg_trgm is installed.
+    Params:
+        q : title text to look for (None for every title)
+        match : 'prefix' (title starts with q, ignoring case), 'words' (every word
+                of q starts a word of the title) or 'substring' (q anywhere in the title)
+        year_min, year_max, rating_min, rating_max : inclusive bounds, None for open
+        sort, descending : order of the results; ties are broken by id
+        limit : page size
+        after : (sort value, id) of the last row of the previous page
+        fields : columns to return, in order (None for all of them)
+    Returns:
+        (sql, args) tuple; the rows hold the requested columns, then the sort
+        column and id if the projection lacks them (see search_page)
+    Raises:
+        ValueError with a message fit for a 400 response
+    """
+    if sort not in SEARCH_SORTS:
+        raise ValueError('sort must be one of %s' % ', '.join(SEARCH_SORTS))
+    if match not in SEARCH_MATCHES:
+        raise ValueError('match must be one of %s' % ', '.join(SEARCH_MATCHES))
+    _, selected = _search_columns(fields, sort)
+
+    conditions = []
+    args = []
+    if q is not None:
+        if match == 'prefix':
+            conditions.append('lower(title) LIKE lower(%s)')
+            args.append(_like_pattern(q) + '%')
+        elif match == 'substring':
+            conditions.append('title ILIKE %s')
+            args.append('%' + _like_pattern(q) + '%')
+        else:
+            words = _WORD.findall(q)
+            if not words:
+                raise ValueError('q must contain a word to search for')
+            conditions.append("to_tsvector('simple', title) @@ to_tsquery('simple', %s)")
+            args.append(' & '.join(word + ':*' for word in words))
+    for column, operator, bound in (('year', '>=', year_min), ('year', '<=', year_max),
+                                    ('rating', '>=', rating_min), ('rating', '<=', rating_max)):
+        if bound is not None:
+            conditions.append('%s %s %%s' % (column, operator))
+            args.append(bound)
+    if after is not None:
+        value, after_id = after
+        # type() rather than isinstance(): a cursor decoded from JSON may hold true/false, which are ints
+        if type(after_id) is not int or type(value) is not (str if sort == 'title' else int):
+            raise ValueError('after does not belong to a search sorted by %s' % sort)
+        if sort == 'id':
+            conditions.append('id %s %%s' % ('<' if descending else '>'))
+            args.append(after_id)
+        else:
+            conditions.append('(%s, id) %s (%%s, %%s)' % (sort, '<' if descending else '>'))
+            args.extend((value, after_id))
+
+    direction = ' DESC' if descending else ''
+    order = ['id' + direction] if sort == 'id' else [sort + direction, 'id' + direction]
+    sql = 'SELECT %s FROM movies' % ', '.join(selected)
+    if conditions:
+        sql += ' WHERE ' + ' AND '.join(conditions)
+    sql += ' ORDER BY %s LIMIT %%s' % ', '.join(order)
+    args.append(limit)
+    return sql, args
+
+def search_page(rows, limit, sort='id', fields=None):
+    """
+    Splits the rows of a search_sql() query into the page and the cursor of the next one
+    Returns:
+        (rows holding only the requested columns, (sort value, id) after the page or None)
+    """
+    columns, selected = _search_columns(fields, sort)
+    after = None
+    if len(rows) == limit:
+        after = (rows[-1][selected.index(sort)], rows[-1][selected.index('id')])
+    if len(selected) > len(columns):
+        rows = [row[:len(columns)] for row in rows]
+    return rows, after
+
+def search(limit=100, **query):
+    """
+    Searches movies by title, year and rating, one keyset page at a time (see search_sql)
+    Returns:
+        (rows, after): the page, and the after cursor for the next page or None on the last one
+    """
+    rows = exec_get_all(*search_sql(limit=limit, **query))
+    return search_page(rows, limit, query.get('sort', 'id'), query.get('fields'))
+
+def movie_stats():
+    """
+    Counts movies by year and rating from the movie_stats summary table, which
+    triggers keep current (migration 0005), so movies itself is never scanned
+    Returns:
+        List of (year, rating, movies) rows ordered by year and rating
+        (shared with the cache, do not modify)
+    """
+    _, list_cache = movie_caches()
+    return _cached(list_cache, 'stats', lambda: exec_get_all(MOVIE_STATS_SQL))
 
 def show(id_of_entry):
     """
     Shows all details from a row in the movies table
     Params: 
-        id_of_entry : id of movie to look for
+        id_of_entry : id of movie to look for (an int, or a string holding one)
     Returns:
-        Details of specific id
+        Details of specific id (shared with the cache, do not modify)
     """
-    return exec_get_all("""SELECT * FROM movies WHERE id = %s""" % (id_of_entry))
+    # Every spelling of an id ('08892', ' 8892') shares the key invalidate_movies drops
+    movie_id = int(id_of_entry)
+    if movie_id not in MOVIE_IDS:
+        return []
+    show_cache, _ = movie_caches()
+    return _cached(show_cache, str(movie_id),
+                   lambda: exec_prepared_all(SHOW_MOVIE, (movie_id,)))
 
 
 def create_user(username, password):
@@ -74,15 +658,7 @@ def create_user(username, password):
     Returns:
         None
     """
-    conn = connect()
-    cur = conn.cursor()
-
-    enc_passw = password.encode('utf-8')
-    hashed_password = hashlib.sha512(enc_passw).hexdigest()
-    cur.execute("INSERT INTO system_users (username, passw) VALUES (%s, %s);", (username, hashed_password))
-
-    conn.commit()
-    conn.close()
+    exec_commit(CREATE_USER_SQL, (username, hash_password(password)))
 
 def delete_user(username):
     """
@@ -92,31 +668,60 @@ def delete_user(username):
     Returns:
         None
     """
-    conn = connect()
-    cur = conn.cursor()
-
-    cur.execute("""DELETE FROM system_users WHERE username = '%s'""" % (username))
-
-    conn.commit()
-    conn.close()
+    with pooled_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("""DELETE FROM system_users WHERE username = %s RETURNING session_key""", (username,))
+        revoked = revoked_digests(cur.fetchall())
+        if revoked:
+            notify_sessions_revoked(cur, revoked)
+        conn.commit()
+    forget_sessions(revoked)
 
 
 def validate_session_key(given_session_key):
     """
-    Given a session key, determines if session is valid
+    Given a session key, determines if session is valid. Keys seen to be valid
+    are remembered for session_cache_ttl seconds (until logout) so most calls
+    skip the database entirely.
     Args:
         given_session_key : the key given with the user
     Returns:
         True if session key is valid
         False if session key is invalid
     """
-    result = exec_get_all("""SELECT * FROM system_users WHERE session_key = '%s'""" % (given_session_key))
-
-    if len(result) > 0:
+    if not is_session_key(given_session_key):
+        return False
+    if is_token(given_session_key):
+        return _token_claims(given_session_key) is not None
+    if known_session(given_session_key):
         return True
-    else:
+
+    generation = session_cache().generation
+    if exec_prepared_one(SESSION_EXISTS, (str(given_session_key),)) is None:
         return False
+    remember_session(given_session_key, generation)
+    return True
+
+def session_user(session_key):
+    """
+    Finds whose session a key (or signed token) is
+    Args:
+        session_key : the key given with the request
+    Returns:
+        The username, or None if the key is not valid
+    """
+    if not is_session_key(session_key):
+        return None
+    if is_token(session_key):
+        claims = _token_claims(session_key)
+        return claims['u'] if claims is not None else None
+    row = exec_prepared_one(SESSION_USER, (str(session_key),))
+    return row[0] if row is not None else None
 
+def is_admin(session_key):
+    """True if the key belongs to one of the admin_users in the settings"""
+    admins = get_settings().admins
+    return bool(admins) and session_user(session_key) in admins
 
 
 def create(rating, title, year, session_k):
@@ -128,36 +733,28 @@ def create(rating, title, year, session_k):
         year : The year for the the movie to be created
         session_k : The session key to verify the user is valid
     Returns:
-        None
+        The new row (id, imdbid, rating, title, year), with id and imdbid
+        allocated by the database, or None if the session key is invalid
     """
 
     if validate_session_key(session_k) is False:
         return None
 
-    """First we must get new unique identifiers for the ID section"""
-    id_list = exec_get_all("""SELECT id, imdbid FROM movies""")
-    highest_id = 0
-    highest_imdbid = 0
-
-    for row in id_list:
-        if row[0] > highest_id:
-            highest_id = row[0]
-        if row[1] > highest_imdbid:
-            highest_imdbid = row[1]
-    new_imdbid = highest_imdbid + 1
-    new_id = highest_id + 1
-
-    conn = connect()
-    cur = conn.cursor()
-    cur.execute("INSERT INTO movies(id, imdbid, rating, title, year) VALUES (%s, %s, %s, %s, %s);", (new_id, new_imdbid, rating, title, year))
-    conn.commit()
-    conn.close()
+    with pooled_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(INSERT_MOVIE_SQL, (rating, title, year))
+        new_movie = cur.fetchone()
+        version = _movies_changed(cur, [new_movie[0]])
+        conn.commit()
+    apply_movie_change([new_movie[0]], version)
+    return new_movie
 
 def delete(movie_name, session_k):
     """
     Deletes the given movie from the database
     Args:
-        movie_name : The movie to be deleted
+        movie_name : The movie to be deleted; when several movies share the
+                     title, the most recently added one goes
         session_k : The session key to verify the user is valid
     Returns:
         None
@@ -166,15 +763,15 @@ def delete(movie_name, session_k):
     if validate_session_key(session_k) is False:
         return None
 
-    movie_id_tuple = exec_get_all("""SELECT id FROM movies WHERE title = '%s'""" % (movie_name))
-    for row in movie_id_tuple:
-        movie_id = row[0]
-
-    conn = connect()
-    cur = conn.cursor()
-    cur.execute("""DELETE FROM movies WHERE id = '%s'""" % (movie_id))
-    conn.commit()
-    conn.close()
+    with pooled_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(DELETE_MOVIE_SQL, (movie_name,))
+        deleted = cur.fetchone()
+        if deleted is None:
+            return None
+        version = _movies_changed(cur, [deleted[0]])
+        conn.commit()
+    apply_movie_change([deleted[0]], version)
 
 def update_movie_rating(rating, movie_title, session_k):
     """
@@ -189,12 +786,90 @@ def update_movie_rating(rating, movie_title, session_k):
     if validate_session_key(session_k) is False:
         return None
 
-    conn = connect()
-    cur = conn.cursor()
-    cur.execute("""UPDATE movies SET rating = '%s' WHERE title = '%s'""" % (rating, movie_title))
-    conn.commit()
-    conn.close()
-    
+    with pooled_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(UPDATE_RATING_SQL, (rating, movie_title))
+        updated_ids = [row[0] for row in cur.fetchall()]
+        if not updated_ids:
+            return None  # no such title: the table, and every ETag, stay as they were
+        version = _movies_changed(cur, updated_ids)
+        conn.commit()
+    apply_movie_change(updated_ids, version)
+
+def _run_batch(batch, session_k, atomic=True):
+    """
+    Applies a batch of writes (see batch.py) in one transaction. The whole batch
+    goes to the database as one statement; only if that fails is it replayed
+    item by item, each in a savepoint, to find the items at fault.
+    Params:
+        batch : CreateBatch, DeleteBatch or RatingBatch
+        session_k : The session key to verify the user is valid
+        atomic : commit only if every item succeeds; otherwise commit the items that did
+    Returns:
+        The batch report, or None if the session key is invalid
+    """
+    if validate_session_key(session_k) is False:
+        return None
+    if atomic and batch.has_errors:
+        return batch.report(False)
+
+    with pooled_connection() as conn:
+        cur = conn.cursor()
+        if batch.pending:
+            cur.execute(SAVEPOINT)
+            try:
+                cur.execute(batch.SQL, batch.args(batch.pending))
+                batch.record(batch.pending, cur.fetchall())
+            except psycopg2.DatabaseError:
+                cur.execute(ROLLBACK_TO_SAVEPOINT)
+                for entry in batch.pending:
+                    try:
+                        cur.execute(batch.SQL, batch.args([entry]))
+                    except psycopg2.DatabaseError as error:
+                        batch.fail([entry], error)
+                        cur.execute(ROLLBACK_TO_SAVEPOINT)
+                    else:
+                        batch.record([entry], cur.fetchall())
+                        cur.execute(NEXT_SAVEPOINT)
+                if atomic and batch.has_errors:
+                    conn.rollback()
+                    return batch.report(False)
+
+        version = _movies_changed(cur, batch.changed_ids) if batch.changed_ids else None
+        conn.commit()
+    if version is not None:
+        apply_movie_change(batch.changed_ids, version)
+    return batch.report(True)
+
+def create_batch(items, session_k, atomic=True):
+    """
+    Creates many movies in one transaction
+    Params:
+        items : list of {"title", "rating", "year"} objects
+        session_k : The session key to verify the user is valid
+        atomic : all or nothing (True) or keep the items that succeed (False)
+    Returns:
+        {"committed": bool, "results": [...]} with one result per item, or None if
+        the session key is invalid
+    """
+    return _run_batch(CreateBatch(items), session_k, atomic)
+
+def delete_batch(items, session_k, atomic=True):
+    """
+    Deletes many movies in one transaction (see create_batch)
+    Params:
+        items : list of {"title"} objects
+    """
+    return _run_batch(DeleteBatch(items), session_k, atomic)
+
+def update_rating_batch(items, session_k, atomic=True):
+    """
+    Updates many movie ratings in one transaction (see create_batch)
+    Params:
+        items : list of {"title", "rating"} objects
+    """
+    return _run_batch(RatingBatch(items), session_k, atomic)
+
 
 def generate_session_key(username, passw):
     """
@@ -205,41 +880,53 @@ def generate_session_key(username, passw):
     Returns:
         session_key : the  session key of the logged in user
     """
-    enc_passw = passw.encode('utf-8')
-    hashed_password = hashlib.sha512(enc_passw).hexdigest()
-    results = exec_get_all("""SELECT username, passw FROM system_users WHERE username='%s' AND passw='%s'""" % (username, hashed_password))
+    hashed_password = hash_password(passw)
+    results = exec_prepared_all(LOGIN_USER, (username, hashed_password))
 
     """if results = 1 generate session key, add it to the user table, return the session key"""
-    if len(results) == 1:
-        session_key = secrets.token_hex(512)
-
-        conn = connect()
+    if len(results) != 1:
+        return LOGIN_INVALID
+    token = token_login(username)
+    if token is not None:
+        return token
+
+    session_key = new_session_key()
+    with pooled_connection() as conn:
         cur = conn.cursor()
-
-        cur.execute("""UPDATE system_users SET session_key='%s' WHERE username='%s'""" % (session_key, username))
-
+        cur.execute(START_SESSION_SQL, (session_key, username))
+        revoked = revoked_digests(cur.fetchall())
+        if revoked:
+            notify_sessions_revoked(cur, revoked)
         conn.commit()
-        conn.close()
-
-        return session_key, 'Login was successful'
-    else:
-        return 0, 'Login invalid'
+    return session_started(session_key, revoked)
 
 def logout(session_key):
     """
     Attempts to log a user out provided a session key
     Args:
-        session_key : The session_key of a user
+        session_key : The session_key of a user, or a signed token
     Returns:
         None
     """
-    results = exec_get_all("""SELECT * FROM system_users WHERE session_key = '%s'""" % (session_key))
-
-    if len(results) == 1:
-        conn = connect()
-        cur = conn.cursor()
+    if is_token(session_key):
+        claims = _token_claims(session_key)
+        if claims is not None:
+            with pooled_connection() as conn:
+                cur = conn.cursor()
+                cur.execute(REVOKE_TOKEN_SQL, (claims['jti'], claims['exp']))
+                cur.execute(PURGE_REVOKED_TOKENS_SQL, (int(time.time()),))
+                notify_tokens_revoked(cur, [(claims['jti'], claims['exp'])])
+                conn.commit()
+            _denylist.add(claims['jti'], claims['exp'])
+        return
+
+    digest = session_digest(session_key)
+    if is_session_key(session_key):
+        with pooled_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(END_SESSION_SQL, (str(session_key),))
+            if cur.rowcount:
+                notify_sessions_revoked(cur, [digest])
+            conn.commit()
+    forget_sessions([digest])
 
-        cur.execute("""UPDATE system_users SET session_key='None' WHERE session_key='%s'""" % (session_key))
-
-        conn.commit()
-        conn.close()
\ No newline at end of file
@@ -0,0 +1,403 @@
+import asyncio
+import time
+import psycopg
+from psycopg_pool import AsyncConnectionPool
+from .config import get_settings, on_reload
+from .swen344_db_utils import statement_sql
+from .batch import CreateBatch, DeleteBatch, RatingBatch, SAVEPOINT, ROLLBACK_TO_SAVEPOINT, NEXT_SAVEPOINT
+from .cache import MISSING
+from .notify import NOTIFY_SQL, movies_changed_args, sessions_revoked_args, tokens_revoked_args
+from .tokens import is_token
+from . import bechdel_db
+
+# asyncio counterparts of the request-path functions in bechdel_db, on a
+# psycopg 3 AsyncConnectionPool. They share bechdel_db's in-process caches,
+# table version, denylist and change listener (a thread, which coexists with
+# the event loop), so a change made through either module is seen by both.
+# The SQL and every decision about sessions, tokens and caches come from
+# bechdel_db too; only the driver calls live here.
+
+_pool = None
+_pool_lock = asyncio.Lock()
+_retired_pools = []
+
+async def get_pool():
+    """Returns the event loop's connection pool, opening it on first use"""
+    global _pool
+    while _retired_pools:
+        await _retired_pools.pop().close()
+    if _pool is None:
+        async with _pool_lock:
+            if _pool is None:
+                settings = get_settings()
+                pool = AsyncConnectionPool(kwargs={'dbname': settings.database,
+                                                   'user': settings.user,
+                                                   'password': settings.password,
+                                                   'host': settings.host,
+                                                   'port': settings.port},
+                                           min_size=settings.pool_min,
+                                           max_size=settings.pool_max,
+                                           timeout=settings.pool_timeout,
+                                           open=False)
+                await pool.open()
+                _pool = pool
+    return _pool
+
+async def close_pool():
+    """Closes the pool; the next query opens a fresh one"""
+    global _pool
+    pool, _pool = _pool, None
+    if pool is not None:
+        await pool.close()
+
+def _retire_pool(settings=None):
+    # Runs on the reload thread, which cannot await: the pool is closed by the
+    # next get_pool() call on the event loop
+    global _pool
+    pool, _pool = _pool, None
+    if pool is not None:
+        _retired_pools.append(pool)
+
+on_reload(_retire_pool)
+
+async def _fetch_all(sql, args=(), prepare=None):
+    pool = await get_pool()
+    async with pool.connection() as conn:
+        cur = await conn.execute(sql, args, prepare=prepare)
+        return await cur.fetchall()
+
+async def _fetch_one(sql, args=(), prepare=None):
+    pool = await get_pool()
+    async with pool.connection() as conn:
+        cur = await conn.execute(sql, args, prepare=prepare)
+        return await cur.fetchone()
+
+def _prepared(name):
+    """
+    The SQL and prepare flag of one of bechdel_db's hot statements. psycopg 3
+    prepares statements per connection itself; prepare=True makes it do so on
+    first use rather than after its usual five executions.
+    """
+    return {'sql': statement_sql(name), 'prepare': get_settings().prepare_statements}
+
+async def _cached(cache, key, load):
+    """Reads through one of bechdel_db's caches when it is usable, straight from load() otherwise"""
+    if cache.maxsize > 0 and not bechdel_db.cache_usable(cache):
+        return await load()
+    generation = cache.generation
+    value = cache.get(key)
+    if value is MISSING:
+        value = await load()
+        cache.set(key, value, generation)
+    return value
+
+async def _movies_changed(cur, ids=None):
+    """Bumps the movies table version and queues the NOTIFY inside the caller's transaction"""
+    await cur.execute(bechdel_db.BUMP_MOVIES_VERSION_SQL)
+    version = await cur.fetchone()
+    await cur.execute(NOTIFY_SQL, movies_changed_args(ids, version))
+    return version
+
+async def movies_version():
+    """
+    Returns the current version of the movies table (see bechdel_db.movies_version)
+    Returns:
+        (version, modified_at) tuple
+    """
+    version = bechdel_db.known_movies_version()
+    if version is not None:
+        return version
+    version = await _fetch_one(**_prepared(bechdel_db.MOVIES_VERSION))
+    bechdel_db.note_movies_version(version)
+    return version
+
+async def list_all_keys():
+    """
+    Lists all keys from movies table
+    Returns:
+        All keys from movies table (shared with the cache, do not modify)
+    """
+    _, list_cache = bechdel_db.movie_caches()
+    return await _cached(list_cache, 'keys', lambda: _fetch_all(bechdel_db.LIST_KEYS_SQL))
+
+async def list_details(limit=None, after_id=None, fields=None):
+    """
+    Lists all details about the movie table, optionally one keyset page at a time
+    Params:
+        limit : maximum number of rows to return (None for all of them)
+        after_id : only return movies whose id is greater than this one
+        fields : columns to return, in order (None for all of them)
+    Returns:
+        All details from movie table, ordered by id when paginated
+        (shared with the cache, do not modify)
+    """
+    fields = None if fields is None else bechdel_db.movie_fields(fields)
+    _, list_cache = bechdel_db.movie_caches()
+    return await _cached(list_cache, ('details', limit, after_id, fields),
+                         lambda: _fetch_all(*bechdel_db.details_sql(fields, limit, after_id)))
+
+async def iter_details(after_id=None, batch_size=1000, fields=None):
+    """
+    Streams the movie table in id order through a server-side cursor
+    Params:
+        after_id : only yield movies whose id is greater than this one
+        batch_size : rows fetched from the server per round trip
+        fields : columns to return, in order (None for all of them)
+    Returns:
+        Async generator of lists of rows, each at most batch_size long
+    """
+    sql, args = bechdel_db.details_sql(fields, after_id=after_id, ordered=True)
+    pool = await get_pool()
+    async with pool.connection() as conn:
+        async with conn.cursor(name='iter_details') as cur:
+            await cur.execute(sql, args)
+            while True:
+                rows = await cur.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield rows
+
+async def search(limit=100, **query):
+    """
+    Searches movies by title, year and rating (see bechdel_db.search)
+    Returns:
+        (rows, after): the page, and the after cursor for the next page or None on the last one
+    """
+    rows = await _fetch_all(*bechdel_db.search_sql(limit=limit, **query))
+    return bechdel_db.search_page(rows, limit, query.get('sort', 'id'), query.get('fields'))
+
+async def movie_stats():
+    """
+    Counts movies by year and rating (see bechdel_db.movie_stats)
+    Returns:
+        List of (year, rating, movies) rows (shared with the cache, do not modify)
+    """
+    _, list_cache = bechdel_db.movie_caches()
+    return await _cached(list_cache, 'stats', lambda: _fetch_all(bechdel_db.MOVIE_STATS_SQL))
+
+async def show(id_of_entry):
+    """
+    Shows all details from a row in the movies table
+    Params:
+        id_of_entry : id of movie to look for (an int, or a string holding one)
+    Returns:
+        Details of specific id (shared with the cache, do not modify)
+    """
+    movie_id = int(id_of_entry)  # one cache key per movie, whatever the spelling (see bechdel_db.show)
+    if movie_id not in bechdel_db.MOVIE_IDS:
+        return []
+    show_cache, _ = bechdel_db.movie_caches()
+    return await _cached(show_cache, str(movie_id),
+                         lambda: _fetch_all(args=(movie_id,), **_prepared(bechdel_db.SHOW_MOVIE)))
+
+async def create_user(username, password):
+    """
+    Creates a user account
+    Params:
+        username : The new username for the user
+        password : The new password for the user
+    Returns:
+        None
+    """
+    pool = await get_pool()
+    async with pool.connection() as conn:
+        await conn.execute(bechdel_db.CREATE_USER_SQL, (username, bechdel_db.hash_password(password)))
+
+async def _token_claims(token):
+    """Checks a signed token (see bechdel_db.token_claims), querying the database without blocking the loop"""
+    claims = bechdel_db.token_claims(token)
+    if claims is not None and not bechdel_db.revocations_known():
+        if await _fetch_one(args=(claims['jti'],), **_prepared(bechdel_db.TOKEN_REVOKED)) is not None:
+            return None
+    return claims
+
+async def validate_session_key(given_session_key):
+    """
+    Given a session key, determines if session is valid (see bechdel_db.validate_session_key)
+    Args:
+        given_session_key : the key given with the user
+    Returns:
+        True if session key is valid
+        False if session key is invalid
+    """
+    if not bechdel_db.is_session_key(given_session_key):
+        return False
+    if is_token(given_session_key):
+        return await _token_claims(given_session_key) is not None
+    if bechdel_db.known_session(given_session_key):
+        return True
+
+    generation = bechdel_db.session_cache().generation
+    if await _fetch_one(args=(str(given_session_key),), **_prepared(bechdel_db.SESSION_EXISTS)) is None:
+        return False
+    bechdel_db.remember_session(given_session_key, generation)
+    return True
+
+async def create(rating, title, year, session_k):
+    """
+    Creates a new movie and adds it to the database
+    Params:
+        rating, title, year : the new movie
+        session_k : The session key to verify the user is valid
+    Returns:
+        The new row (id, imdbid, rating, title, year), or None if the session key is invalid
+    """
+    if await validate_session_key(session_k) is False:
+        return None
+
+    pool = await get_pool()
+    async with pool.connection() as conn:
+        cur = await conn.execute(bechdel_db.INSERT_MOVIE_SQL, (rating, title, year))
+        new_movie = await cur.fetchone()
+        version = await _movies_changed(cur, [new_movie[0]])
+        await conn.commit()
+    bechdel_db.apply_movie_change([new_movie[0]], version)
+    return new_movie
+
+async def delete(movie_name, session_k):
+    """
+    Deletes the given movie from the database
+    Args:
+        movie_name : The movie to be deleted
+        session_k : The session key to verify the user is valid
+    Returns:
+        None
+    """
+    if await validate_session_key(session_k) is False:
+        return None
+
+    pool = await get_pool()
+    async with pool.connection() as conn:
+        cur = await conn.execute(bechdel_db.DELETE_MOVIE_SQL, (movie_name,))
+        deleted = await cur.fetchone()
+        if deleted is None:
+            return None
+        version = await _movies_changed(cur, [deleted[0]])
+        await conn.commit()
+    bechdel_db.apply_movie_change([deleted[0]], version)
+
+async def update_movie_rating(rating, movie_title, session_k):
+    """
+    Updates a movie rating
+    Args:
+        rating : The new rating for the movie
+        movie_title : Title of the movie for rating to be changed
+        session_k : The session key to verify user is logged in
+    Returns:
+        None
+    """
+    if await validate_session_key(session_k) is False:
+        return None
+
+    pool = await get_pool()
+    async with pool.connection() as conn:
+        cur = await conn.execute(bechdel_db.UPDATE_RATING_SQL, (rating, movie_title))
+        updated_ids = [row[0] for row in await cur.fetchall()]
+        if not updated_ids:
+            return None  # no such title: the table, and every ETag, stay as they were
+        version = await _movies_changed(cur, updated_ids)
+        await conn.commit()
+    bechdel_db.apply_movie_change(updated_ids, version)
+
+async def _run_batch(batch, session_k, atomic=True):
+    """Applies a batch of writes in one transaction (see bechdel_db.create_batch)"""
+    if await validate_session_key(session_k) is False:
+        return None
+    if atomic and batch.has_errors:
+        return batch.report(False)
+
+    pool = await get_pool()
+    async with pool.connection() as conn:
+        cur = conn.cursor()
+        if batch.pending:
+            await cur.execute(SAVEPOINT)
+            try:
+                await cur.execute(batch.SQL, batch.args(batch.pending))
+                batch.record(batch.pending, await cur.fetchall())
+            except psycopg.DatabaseError:
+                await cur.execute(ROLLBACK_TO_SAVEPOINT)
+                for entry in batch.pending:
+                    try:
+                        await cur.execute(batch.SQL, batch.args([entry]))
+                    except psycopg.DatabaseError as error:
+                        batch.fail([entry], error)
+                        await cur.execute(ROLLBACK_TO_SAVEPOINT)
+                    else:
+                        batch.record([entry], await cur.fetchall())
+                        await cur.execute(NEXT_SAVEPOINT)
+                if atomic and batch.has_errors:
+                    await conn.rollback()
+                    return batch.report(False)
+
+        version = await _movies_changed(cur, batch.changed_ids) if batch.changed_ids else None
+        await conn.commit()
+    if version is not None:
+        bechdel_db.apply_movie_change(batch.changed_ids, version)
+    return batch.report(True)
+
+async def create_batch(items, session_k, atomic=True):
+    """Creates many movies in one transaction (see bechdel_db.create_batch)"""
+    return await _run_batch(CreateBatch(items), session_k, atomic)
+
+async def delete_batch(items, session_k, atomic=True):
+    """Deletes many movies in one transaction (see bechdel_db.delete_batch)"""
+    return await _run_batch(DeleteBatch(items), session_k, atomic)
+
+async def update_rating_batch(items, session_k, atomic=True):
+    """Updates many movie ratings in one transaction (see bechdel_db.update_rating_batch)"""
+    return await _run_batch(RatingBatch(items), session_k, atomic)
+
+async def generate_session_key(username, passw):
+    """
+    Logs a user in (see bechdel_db.generate_session_key)
+    Args:
+        username : username of the user
+        passw : password of the user
+    Returns:
+        (session_key, message), with session_key 0 if the login was invalid
+    """
+    results = await _fetch_all(args=(username, bechdel_db.hash_password(passw)), **_prepared(bechdel_db.LOGIN_USER))
+    if len(results) != 1:
+        return bechdel_db.LOGIN_INVALID
+    token = bechdel_db.token_login(username)
+    if token is not None:
+        return token
+
+    session_key = bechdel_db.new_session_key()
+    pool = await get_pool()
+    async with pool.connection() as conn:
+        cur = await conn.execute(bechdel_db.START_SESSION_SQL, (session_key, username))
+        revoked = bechdel_db.revoked_digests(await cur.fetchall())
+        if revoked:
+            await cur.execute(NOTIFY_SQL, sessions_revoked_args(revoked))
+        await conn.commit()
+    return bechdel_db.session_started(session_key, revoked)
+
+async def logout(session_key):
+    """
+    Logs out a session key or revokes a signed token
+    Args:
+        session_key : The session_key of a user, or a signed token
+    Returns:
+        None
+    """
+    pool = await get_pool()
+    if is_token(session_key):
+        claims = await _token_claims(session_key)
+        if claims is not None:
+            async with pool.connection() as conn:
+                await conn.execute(bechdel_db.REVOKE_TOKEN_SQL, (claims['jti'], claims['exp']))
+                await conn.execute(bechdel_db.PURGE_REVOKED_TOKENS_SQL, (int(time.time()),))
+                await conn.execute(NOTIFY_SQL, tokens_revoked_args([(claims['jti'], claims['exp'])]))
+                await conn.commit()
+            bechdel_db.denylist().add(claims['jti'], claims['exp'])
+        return
+
+    digest = bechdel_db.session_digest(session_key)
+    if bechdel_db.is_session_key(session_key):
+        async with pool.connection() as conn:
+            cur = await conn.execute(bechdel_db.END_SESSION_SQL, (str(session_key),))
+            if cur.rowcount:
+                await cur.execute(NOTIFY_SQL, sessions_revoked_args([digest]))
+            await conn.commit()
+    bechdel_db.forget_sessions([digest])
@@ -0,0 +1,188 @@
+import argparse
+import csv
+import io
+import json
+import os
+import time
+
+COLUMNS = ('id', 'imdbid', 'rating', 'title', 'year')
+FORMATS = ('json', 'ndjson', 'csv')
+DEFAULT_CHUNK_ROWS = 10000
+
+
+class ImportStats:
+    """Running totals of an import, updated after every chunk"""
+    def __init__(self):
+        self.rows = 0
+        self.chunks = 0
+        self.started = time.monotonic()
+        self.seconds = 0.0
+
+    @property
+    def rows_per_second(self):
+        return self.rows / self.seconds if self.seconds > 0 else 0.0
+
+    def __repr__(self):
+        return '%d rows in %.2fs (%.0f rows/s)' % (self.rows, self.seconds, self.rows_per_second)
+
+
+def iter_json_array(file, read_size=65536):
+    """
+    Yields the elements of a top-level JSON array of objects without loading
+    the whole document, so memory stays around read_size plus one element
+    Params:
+        file : text file positioned at the start of the array
+        read_size : characters read from the file at a time
+    """
+    decoder = json.JSONDecoder()
+    buffer = ''
+    pos = 0
+    started = False
+    eof = False
+    while True:
+        while pos < len(buffer) and (buffer[pos].isspace() or (started and buffer[pos] == ',')):
+            pos += 1
+        if pos == len(buffer):
+            if eof:
+                raise ValueError('unexpected end of JSON array')
+            chunk = file.read(read_size)
+            eof = chunk == ''
+            buffer = buffer[pos:] + chunk
+            pos = 0
+            continue
+
+        if not started:
+            if buffer[pos] != '[':
+                raise ValueError('expected a JSON array')
+            started = True
+            pos += 1
+            continue
+        if buffer[pos] == ']':
+            return
+
+        try:
+            element, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            chunk = file.read(read_size)
+            eof = chunk == ''
+            buffer = buffer[pos:] + chunk
+            pos = 0
+            continue
+        yield element
+        pos = end
+        if pos > read_size:
+            buffer = buffer[pos:]
+            pos = 0
+
+def iter_ndjson(file):
+    """Yields one object per non-blank line"""
+    for line in file:
+        if line.strip():
+            yield json.loads(line)
+
+def iter_csv(file):
+    """Yields one dict per row of a CSV file with a header line"""
+    return csv.DictReader(file)
+
+def iter_records(file, fmt):
+    """Yields movie records from an open file in the given format"""
+    if fmt == 'json':
+        return iter_json_array(file)
+    if fmt == 'ndjson':
+        return iter_ndjson(file)
+    if fmt == 'csv':
+        return iter_csv(file)
+    raise ValueError('unknown import format %r (expected one of %s)' % (fmt, ', '.join(FORMATS)))
+
+def detect_format(path):
+    """Guesses the format of a dump from its file extension"""
+    extension = os.path.splitext(path)[1].lower()
+    if extension in ('.ndjson', '.jsonl'):
+        return 'ndjson'
+    if extension == '.csv':
+        return 'csv'
+    return 'json'
+
+def _chunks(records, chunk_rows):
+    """Encodes records as CSV text, chunk_rows rows per buffer"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    count = 0
+    for record in records:
+        writer.writerow([record.get(column) for column in COLUMNS])
+        count += 1
+        if count == chunk_rows:
+            buffer.seek(0)
+            yield buffer, count
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            count = 0
+    if count:
+        buffer.seek(0)
+        yield buffer, count
+
+def copy_movies(cur, records, upsert=False, chunk_rows=DEFAULT_CHUNK_ROWS, progress=None):
+    """
+    Feeds movie records to Postgres with COPY FROM STDIN, one bounded chunk at a time
+    Params:
+        cur : cursor of the transaction to load into (the caller commits)
+        records : iterable of dicts with id, imdbid, rating, title and year
+        upsert : replace existing movies with the same id instead of failing
+        chunk_rows : rows encoded and sent per COPY
+        progress : optional callable given the ImportStats after every chunk
+    Returns:
+        ImportStats
+    """
+    stats = ImportStats()
+    column_list = ', '.join(COLUMNS)
+    if upsert:
+        # ordinal numbers the rows in the order COPY reads them, which is the order of the records
+        cur.execute("""CREATE TEMP TABLE movies_import(
+                         id INTEGER, imdbid INTEGER, rating INTEGER, title TEXT, year INTEGER,
+                         ordinal BIGINT GENERATED ALWAYS AS IDENTITY
+                       ) ON COMMIT DROP""")
+        copy_sql = 'COPY movies_import(%s) FROM STDIN WITH (FORMAT csv)' % column_list
+    else:
+        copy_sql = 'COPY movies(%s) FROM STDIN WITH (FORMAT csv)' % column_list
+
+    for buffer, count in _chunks(records, chunk_rows):
+        cur.copy_expert(copy_sql, buffer)
+        if upsert:
+            # DISTINCT ON keeps one row per id when a chunk repeats a movie: the last
+            # one, as a later chunk would replace it through ON CONFLICT anyway
+            cur.execute("""INSERT INTO movies(%s)
+                           SELECT DISTINCT ON (id) %s FROM movies_import ORDER BY id, ordinal DESC
+                           ON CONFLICT (id) DO UPDATE SET imdbid = EXCLUDED.imdbid,
+                                                          rating = EXCLUDED.rating,
+                                                          title = EXCLUDED.title,
+                                                          year = EXCLUDED.year""" % (column_list, column_list))
+            cur.execute('TRUNCATE movies_import')
+        stats.rows += count
+        stats.chunks += 1
+        stats.seconds = time.monotonic() - stats.started
+        if progress is not None:
+            progress(stats)
+    stats.seconds = time.monotonic() - stats.started
+    return stats
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Bulk load movies into the database with COPY')
+    parser.add_argument('path', help='JSON array, NDJSON or CSV file of movies')
+    parser.add_argument('--format', choices=FORMATS, help='input format (guessed from the extension by default)')
+    parser.add_argument('--upsert', action='store_true', help='update movies whose id already exists')
+    parser.add_argument('--chunk-rows', type=int, default=DEFAULT_CHUNK_ROWS, help='rows sent per COPY')
+    args = parser.parse_args(argv)
+
+    # bechdel_db builds its seed loader on this module, so import it lazily
+    from .bechdel_db import import_movies
+
+    fmt = args.format or detect_format(args.path)
+    with open(args.path, 'r', newline='' if fmt == 'csv' else None) as file:
+        stats = import_movies(iter_records(file, fmt), upsert=args.upsert, chunk_rows=args.chunk_rows,
+                              progress=lambda stats: print('\r%r' % stats, end='', flush=True))
+    print('\rimported %r' % stats)
+
+if __name__ == '__main__':
+    main()
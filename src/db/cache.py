@@ -0,0 +1,108 @@
+import threading
+import time
+from collections import OrderedDict
+
+MISSING = object()
+
+
+class LRUCache:
+    """
+    Thread-safe least-recently-used cache with an optional time-to-live
+    Params:
+        maxsize : number of entries kept; 0 disables the cache (every get misses)
+        ttl : seconds an entry stays valid, or None to keep entries until evicted
+        clock : monotonic time source, replaceable in tests
+    """
+    def __init__(self, maxsize=1024, ttl=None, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._clock = clock
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    @property
+    def generation(self):
+        """Bumped by every invalidation; pass it to set() to avoid caching a stale read"""
+        return self._generation
+
+    def get(self, key, default=MISSING):
+        """Returns the cached value for key, or default if it is absent or expired"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at is None or expires_at > self._clock():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+                self.expirations += 1
+            self.misses += 1
+            return default
+
+    def set(self, key, value, generation=None):
+        """
+        Stores value under key, evicting the least recently used entry when full
+        Params:
+            generation : the generation observed before the value was read from the
+                         database; if anything was invalidated since, the value is dropped
+        """
+        if self.maxsize <= 0:
+            return
+        expires_at = None if self.ttl is None else self._clock() + self.ttl
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_load(self, key, loader):
+        """Returns the cached value for key, calling loader() and caching its result on a miss"""
+        generation = self._generation
+        value = self.get(key)
+        if value is MISSING:
+            value = loader()
+            self.set(key, value, generation)
+        return value
+
+    def invalidate(self, key):
+        """Drops a single entry"""
+        with self._lock:
+            self._generation += 1
+            if self._data.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        """Drops every entry"""
+        with self._lock:
+            self._generation += 1
+            self.invalidations += len(self._data)
+            self._data.clear()
+
+    def stats(self):
+        """Returns the counters used to tune size and ttl"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations,
+            }
@@ -0,0 +1,152 @@
+import dataclasses
+import os
+import signal
+import threading
+import yaml
+
+DEFAULT_PATH = os.path.join(os.path.dirname(__file__), '../../config/db.yml')
+ENV_PREFIX = 'BECHDEL_'
+AUTH_MODES = ('session', 'token')
+
+
+@dataclasses.dataclass(frozen=True)
+class Settings:
+    """
+    Immutable process settings, read from config/db.yml and overridden by
+    BECHDEL_<FIELD> environment variables (e.g. BECHDEL_HOST, BECHDEL_POOL_MAX)
+    """
+    database: str
+    user: str
+    password: str
+    host: str
+    port: int = 5432
+    pool_min: int = 1
+    pool_max: int = 10
+    pool_timeout: float = 30.0
+    pool_check_idle: float = 30.0
+    prepare_statements: bool = True
+    round_trip_header: bool = False
+    slow_query_ms: float = 250.0
+    slow_query_log_size: int = 100
+    slow_query_explain_sample: float = 0.1
+    slow_query_explain_timeout: float = 10.0
+    slow_query_explain_writes: bool = False
+    cache_enabled: bool = False
+    cache_show_size: int = 4096
+    cache_list_size: int = 64
+    cache_ttl: float = 300.0
+    session_cache_size: int = 10000
+    body_cache_size: int = 256
+    row_cache_size: int = 100000
+    compress_min_size: int = 1024
+    compress_level: int = 6
+    compressed_cache_size: int = 64
+    session_cache_ttl: float = 300.0
+    auth_mode: str = 'session'
+    token_secret: str = ''
+    token_ttl: float = 3600.0
+    bind_host: str = '127.0.0.1'
+    bind_port: int = 5000
+    workers: int = 0
+    threads: int = 8
+    graceful_timeout: float = 30.0
+    admin_users: str = ''
+    profile_sample_every: int = 0
+    profile_dir: str = ''
+    profile_keep: int = 50
+
+    @property
+    def admins(self):
+        """Usernames allowed on the /admin endpoints, from the comma separated admin_users"""
+        return frozenset(name.strip() for name in self.admin_users.split(',') if name.strip())
+
+
+_settings = None
+_lock = threading.Lock()
+_reload_callbacks = []
+
+def _coerce(field, value):
+    if field.type is int:
+        return int(value)
+    if field.type is float:
+        return float(value)
+    if field.type is bool:
+        return str(value).lower() in ('1', 'true', 'yes', 'on')
+    if isinstance(value, (list, tuple)):
+        return ','.join(str(item) for item in value)
+    return str(value)
+
+def load_settings(path=None, environ=None):
+    """
+    Reads settings from disk and the environment without touching the cached copy
+    Params:
+        path : yml file to read, defaults to $BECHDEL_CONFIG or config/db.yml
+        environ : mapping used for overrides, defaults to os.environ
+    Returns:
+        A Settings instance
+    """
+    environ = os.environ if environ is None else environ
+    path = path or environ.get(ENV_PREFIX + 'CONFIG') or DEFAULT_PATH
+
+    raw = {}
+    if os.path.exists(path):
+        with open(path, 'r') as file:
+            raw = yaml.load(file, Loader=yaml.FullLoader) or {}
+
+    values = {}
+    missing = []
+    for field in dataclasses.fields(Settings):
+        env_value = environ.get(ENV_PREFIX + field.name.upper())
+        if env_value is not None:
+            values[field.name] = _coerce(field, env_value)
+        elif raw.get(field.name) is not None:
+            values[field.name] = _coerce(field, raw[field.name])
+        elif field.default is dataclasses.MISSING:
+            missing.append(field.name)
+    if missing:
+        raise ValueError('missing database settings %s (set them in %s or as %s<NAME>)'
+                         % (', '.join(missing), path, ENV_PREFIX))
+    if values.get('auth_mode', 'session') not in AUTH_MODES:
+        raise ValueError('auth_mode must be one of %s' % ', '.join(AUTH_MODES))
+    if values.get('auth_mode') == 'token' and not values.get('token_secret'):
+        raise ValueError('auth_mode token needs a token_secret (set it in %s or as %sTOKEN_SECRET)'
+                         % (path, ENV_PREFIX))
+    return Settings(**values)
+
+def get_settings():
+    """Returns the settings for this process, loading them on first use"""
+    global _settings
+    if _settings is None:
+        with _lock:
+            if _settings is None:
+                _settings = load_settings()
+    return _settings
+
+def on_reload(callback):
+    """Registers callback(settings) to run after every reload()"""
+    _reload_callbacks.append(callback)
+    return callback
+
+def reload():
+    """
+    Re-reads the settings (e.g. after credentials were rotated) and notifies
+    everything registered with on_reload()
+    Returns:
+        The new Settings instance
+    """
+    global _settings
+    new_settings = load_settings()
+    with _lock:
+        _settings = new_settings
+    for callback in list(_reload_callbacks):
+        callback(new_settings)
+    return new_settings
+
+def install_reload_handler(signum=signal.SIGHUP):
+    """
+    Makes the given signal trigger reload(). The reload runs on a short-lived
+    thread so the handler never blocks on a lock the interrupted code holds.
+    """
+    def handler(received_signum, frame):
+        threading.Thread(target=reload, name='settings-reload', daemon=True).start()
+    signal.signal(signum, handler)
@@ -0,0 +1,205 @@
+import bisect
+import os
+import threading
+
+# Counters and histograms cheap enough to leave on in production. Every
+# thread records into its own shard, which no other thread writes, so
+# recording takes no lock; render() adds the shards up when /metrics is
+# scraped. Values that other code already keeps (cache and pool statistics)
+# are read at scrape time by collectors instead of being recorded twice.
+#
+# Each worker process of serve.py counts its own requests and starts from
+# zero when it is forked.
+
+# Seconds; wide enough for a cached show (well under 1ms) and a full /list_details
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_metrics = []
+_collectors = []
+_shards = []
+_shards_lock = threading.Lock()
+_local = threading.local()
+
+
+def _shard():
+    """This thread's {(metric, label values): value} dictionary, registered on first use"""
+    shard = getattr(_local, 'shard', None)
+    if shard is None:
+        shard = _local.shard = {}
+        with _shards_lock:
+            _shards.append(shard)
+    return shard
+
+
+class Counter:
+    """
+    Monotonic count, optionally split by labels
+    Params:
+        name : metric name, ending in _total by convention
+        help : one line description shown by /metrics
+        labels : names of the labels every inc() gives values for
+    """
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        _metrics.append(self)
+
+    def inc(self, *label_values, amount=1):
+        shard = _shard()
+        key = (self, label_values)
+        shard[key] = shard.get(key, 0) + amount
+
+    def samples(self, values):
+        for label_values, value in sorted(values.items()):
+            yield self.name, dict(zip(self.labels, label_values)), value
+
+    @staticmethod
+    def merge(total, value):
+        return (total or 0) + value
+
+
+class Histogram:
+    """
+    Distribution of observed values (seconds, rows...) over fixed buckets
+    Params:
+        name : metric name
+        help : one line description shown by /metrics
+        labels : names of the labels every observe() gives values for
+        buckets : ascending upper bounds; +Inf is implied
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        _metrics.append(self)
+
+    def observe(self, value, *label_values):
+        shard = _shard()
+        key = (self, label_values)
+        counts = shard.get(key)
+        if counts is None:
+            # One count per bucket and +Inf, then the sum of the observations
+            counts = shard[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def samples(self, values):
+        for label_values, counts in sorted(values.items()):
+            labels = dict(zip(self.labels, label_values))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                yield self.name + '_bucket', dict(labels, le=_format_value(bound)), cumulative
+            yield self.name + '_sum', labels, counts[-1]
+            yield self.name + '_count', labels, cumulative
+
+    @staticmethod
+    def merge(total, counts):
+        if total is None:
+            return list(counts)
+        return [a + b for a, b in zip(total, counts)]
+
+
+def add_collector(collect):
+    """
+    Registers a callable run on every scrape. It returns (name, kind, help,
+    samples) tuples, samples being (labels dict, value) pairs, for values that
+    are already kept elsewhere.
+    """
+    _collectors.append(collect)
+
+def reset():
+    """Forgets everything recorded so far (the metrics themselves stay registered)"""
+    with _shards_lock:
+        for shard in _shards:
+            shard.clear()
+
+def _after_fork():
+    # Only the forking thread survives; its shard is cleared and re-registered
+    global _shards_lock
+    _shards_lock = threading.Lock()
+    shard = getattr(_local, 'shard', None)
+    _shards[:] = [shard] if shard is not None else []
+    if shard is not None:
+        shard.clear()
+
+os.register_at_fork(after_in_child=_after_fork)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(value) if isinstance(value, float) else str(value)
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _sample_line(name, labels, value):
+    if labels:
+        name += '{%s}' % ','.join('%s="%s"' % (key, _escape(label)) for key, label in labels.items())
+    return '%s %s' % (name, _format_value(value))
+
+def _totals():
+    """{metric: {label values: merged value}} over every thread's shard"""
+    with _shards_lock:
+        shards = list(_shards)
+    totals = {}
+    for shard in shards:
+        # Copy first (dict.copy is atomic): the owning thread may add keys meanwhile
+        for (metric, label_values), value in shard.copy().items():
+            values = totals.setdefault(metric, {})
+            values[label_values] = metric.merge(values.get(label_values), value)
+    return totals
+
+def render():
+    """
+    Returns every metric in the Prometheus text exposition format (version 0.0.4)
+    """
+    totals = _totals()
+    lines = []
+    for metric in _metrics:
+        lines.append('# HELP %s %s' % (metric.name, metric.help))
+        lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+        lines.extend(_sample_line(*sample) for sample in metric.samples(totals.get(metric, {})))
+    for collect in _collectors:
+        for name, kind, help, samples in collect():
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+            lines.extend(_sample_line(name, labels, value) for labels, value in samples)
+    return '\n'.join(lines) + '\n'
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+def cache_metrics(stats):
+    """
+    Collector output for LRUCache statistics
+    Params:
+        stats : {cache name: LRUCache.stats() dictionary}
+    """
+    names = sorted(stats)
+    def per_cache(key):
+        return [({'cache': name}, stats[name][key]) for name in names]
+    return [('bechdel_cache_hits_total', 'counter', 'Cache lookups answered from the cache', per_cache('hits')),
+            ('bechdel_cache_misses_total', 'counter', 'Cache lookups that had to load the value', per_cache('misses')),
+            ('bechdel_cache_evictions_total', 'counter', 'Entries dropped to make room', per_cache('evictions')),
+            ('bechdel_cache_hit_ratio', 'gauge', 'Hits over lookups since the cache was created', per_cache('hit_ratio')),
+            ('bechdel_cache_entries', 'gauge', 'Entries held', per_cache('size'))]
+
+
+# Recorded by the database helpers (swen344_db_utils)
+QUERY_SECONDS = Histogram('bechdel_db_query_duration_seconds', 'Time to run one statement, by statement', ('query',))
+QUERY_ROWS = Counter('bechdel_db_query_rows_total', 'Rows returned or changed, by statement', ('query',))
+QUERY_ERRORS = Counter('bechdel_db_query_errors_total', 'Statements that raised, by statement', ('query',))
+POOL_WAIT_SECONDS = Histogram('bechdel_db_pool_wait_seconds', 'Time to check a connection out of the pool')
+POOL_TIMEOUTS = Counter('bechdel_db_pool_timeouts_total', 'Checkouts that gave up waiting for a connection')
+
+# Recorded by the Flask app (api/bechdel.py)
+REQUEST_SECONDS = Histogram('bechdel_http_request_duration_seconds',
+                            'Time to answer a request, by route, method and status (streamed bodies: until the first byte)',
+                            ('endpoint', 'method', 'status'))
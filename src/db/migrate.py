@@ -0,0 +1,99 @@
+import argparse
+import os
+import re
+from .swen344_db_utils import pooled_connection
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(__file__), 'migrations')
+MIGRATION_FILE = re.compile(r'^(\d+)_(\w+)\.sql$')
+# Key for pg_advisory_xact_lock so two workers starting at once take turns
+LOCK_KEY = 3440001
+
+def available_migrations(directory=MIGRATIONS_DIR):
+    """
+    Lists the migration files shipped with the code
+    Params:
+        directory : folder holding NNNN_name.sql files
+    Returns:
+        List of (version, name, path) tuples in version order
+    """
+    migrations = []
+    for filename in os.listdir(directory):
+        match = MIGRATION_FILE.match(filename)
+        if match:
+            migrations.append((int(match.group(1)), match.group(2), os.path.join(directory, filename)))
+    migrations.sort()
+    versions = [migration[0] for migration in migrations]
+    if len(versions) != len(set(versions)):
+        raise ValueError('two migrations in %s share a version number' % directory)
+    return migrations
+
+def _ensure_migrations_table(conn):
+    cur = conn.cursor()
+    cur.execute("""CREATE TABLE IF NOT EXISTS schema_migrations(
+                     version    INTEGER PRIMARY KEY,
+                     name       TEXT NOT NULL,
+                     applied_at TIMESTAMPTZ NOT NULL DEFAULT now())""")
+    conn.commit()
+
+def applied_migrations():
+    """
+    Lists the migrations already applied to the database
+    Returns:
+        List of (version, name, applied_at) tuples in version order
+    """
+    with pooled_connection() as conn:
+        _ensure_migrations_table(conn)
+        cur = conn.cursor()
+        cur.execute('SELECT version, name, applied_at FROM schema_migrations ORDER BY version')
+        return cur.fetchall()
+
+def migrate(target=None, directory=MIGRATIONS_DIR):
+    """
+    Applies every pending migration up to target, each in its own transaction,
+    so a live database picks up new tables and indexes without being rebuilt
+    Params:
+        target : highest version to apply (None for all of them)
+        directory : folder holding the migration files
+    Returns:
+        List of (version, name) of the migrations applied by this call
+    """
+    applied_now = []
+    with pooled_connection() as conn:
+        _ensure_migrations_table(conn)
+        cur = conn.cursor()
+        for version, name, path in available_migrations(directory):
+            if target is not None and version > target:
+                break
+            cur.execute('SELECT pg_advisory_xact_lock(%s)', (LOCK_KEY,))
+            cur.execute('SELECT 1 FROM schema_migrations WHERE version = %s', (version,))
+            if cur.fetchone() is not None:
+                conn.commit()
+                continue
+            with open(path, 'r') as file:
+                cur.execute(file.read())
+            cur.execute('INSERT INTO schema_migrations(version, name) VALUES (%s, %s)', (version, name))
+            conn.commit()
+            applied_now.append((version, name))
+    return applied_now
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Apply pending database migrations')
+    parser.add_argument('--target', type=int, help='highest migration version to apply')
+    parser.add_argument('--list', action='store_true', help='show applied and pending migrations and exit')
+    args = parser.parse_args(argv)
+
+    if args.list:
+        applied = {row[0]: row[2] for row in applied_migrations()}
+        for version, name, _ in available_migrations():
+            status = 'applied %s' % applied[version] if version in applied else 'pending'
+            print('%04d %-30s %s' % (version, name, status))
+        return
+
+    applied_now = migrate(args.target)
+    for version, name in applied_now:
+        print('applied %04d %s' % (version, name))
+    if not applied_now:
+        print('database is up to date')
+
+if __name__ == '__main__':
+    main()
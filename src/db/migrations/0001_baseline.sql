@@ -0,0 +1,36 @@
+-- The schema as it stood before migrations existed. IF NOT EXISTS leaves
+-- the tables of a database built from the old schema.sql in place; 0006
+-- gives its movies table the id identity and imdbid default it lacks.
+
+-- New movies get their id and imdbid from the database; the seed loader
+-- moves both sequences past the loaded rows (see reset_movie_sequences)
+CREATE SEQUENCE IF NOT EXISTS movies_imdbid_seq;
+
+CREATE TABLE IF NOT EXISTS movies(
+  id      INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+  imdbid  INTEGER NOT NULL DEFAULT nextval('movies_imdbid_seq'),
+  rating  INTEGER NOT NULL,
+  title   TEXT NOT NULL,
+  year    INTEGER NOT NULL
+);
+
+ALTER SEQUENCE movies_imdbid_seq OWNED BY movies.imdbid;
+
+CREATE TABLE IF NOT EXISTS system_users(
+  username    TEXT NOT NULL PRIMARY KEY,
+  passw       VARCHAR(550) NOT NULL,
+  session_key TEXT
+);
+
+-- Bumped in the same transaction as every change to the table. The version
+-- starts from the current time in ms so a rebuilt table never reuses a
+-- version (and therefore an ETag) handed out before the rebuild.
+CREATE TABLE IF NOT EXISTS table_versions(
+  table_name  TEXT NOT NULL PRIMARY KEY,
+  version     BIGINT NOT NULL,
+  modified_at TIMESTAMPTZ NOT NULL DEFAULT clock_timestamp()
+);
+
+INSERT INTO table_versions(table_name, version)
+  VALUES ('movies', (extract(epoch FROM clock_timestamp()) * 1000)::BIGINT)
+  ON CONFLICT (table_name) DO NOTHING;
@@ -0,0 +1,8 @@
+-- delete and update_movie_rating look movies up by title
+CREATE INDEX IF NOT EXISTS movies_title_idx ON movies (title);
+
+-- validate_session_key and logout look users up by session_key. Keys are
+-- only ever compared for equality, and a hash index stays small however
+-- long the keys are. It cannot be unique because every logged out user
+-- shares the same placeholder key.
+CREATE INDEX IF NOT EXISTS system_users_session_key_idx ON system_users USING hash (session_key);
@@ -0,0 +1,8 @@
+-- Signed login tokens (auth_mode: token) that were logged out before they
+-- expired. Workers keep this list in memory and read the table only when
+-- their change listener (re)connects, so a revocation survives restarts and
+-- missed notifications. expires_at is unix time; rows past it can go.
+CREATE TABLE IF NOT EXISTS revoked_tokens(
+  jti        TEXT NOT NULL PRIMARY KEY,
+  expires_at BIGINT NOT NULL
+);
@@ -0,0 +1,23 @@
+-- /movies/search (see bechdel_db.search_sql). Title prefixes use a btree
+-- over lower(title); text_pattern_ops lets LIKE 'abc%' use it whatever the
+-- database collation. Whole words and word prefixes use a full-text index.
+CREATE INDEX IF NOT EXISTS movies_title_prefix_idx ON movies (lower(title) text_pattern_ops);
+CREATE INDEX IF NOT EXISTS movies_title_words_idx ON movies USING gin (to_tsvector('simple', title));
+
+-- Year and rating filters, and keyset pages sorted by either, read these in
+-- (value, id) order
+CREATE INDEX IF NOT EXISTS movies_year_id_idx ON movies (year, id);
+CREATE INDEX IF NOT EXISTS movies_rating_id_idx ON movies (rating, id);
+
+-- Substring matches (ILIKE '%abc%') need a trigram index. pg_trgm ships
+-- with the contrib package, which not every server has; without it the
+-- search still works, by scanning the table.
+DO $$
+BEGIN
+  IF EXISTS (SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm') THEN
+    CREATE EXTENSION IF NOT EXISTS pg_trgm;
+    CREATE INDEX IF NOT EXISTS movies_title_trgm_idx ON movies USING gin (title gin_trgm_ops);
+  END IF;
+EXCEPTION WHEN insufficient_privilege THEN
+  RAISE NOTICE 'pg_trgm could not be installed; substring search will scan the table';
+END $$;
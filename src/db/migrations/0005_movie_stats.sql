@@ -0,0 +1,61 @@
+-- Movie counts by year and rating, served by /stats. Triggers keep it in
+-- step with movies inside the writing transaction, so reading it never
+-- scans movies. They fire once per statement and read the changed rows
+-- from transition tables, so a COPY or a batch of thousands of rows costs
+-- one upsert of the affected (year, rating) cells.
+CREATE TABLE IF NOT EXISTS movie_stats(
+  year    INTEGER NOT NULL,
+  rating  INTEGER NOT NULL,
+  movies  INTEGER NOT NULL,
+  PRIMARY KEY (year, rating)
+);
+
+-- Cells are upserted in key order so concurrent writers lock them in the
+-- same order and cannot deadlock; cells that drop to zero are removed
+CREATE OR REPLACE FUNCTION movie_stats_apply() RETURNS trigger AS $$
+BEGIN
+  IF TG_OP = 'INSERT' THEN
+    INSERT INTO movie_stats(year, rating, movies)
+      SELECT year, rating, count(*) FROM new_rows GROUP BY year, rating ORDER BY year, rating
+      ON CONFLICT (year, rating) DO UPDATE SET movies = movie_stats.movies + EXCLUDED.movies;
+  ELSIF TG_OP = 'DELETE' THEN
+    INSERT INTO movie_stats(year, rating, movies)
+      SELECT year, rating, -count(*) FROM old_rows GROUP BY year, rating ORDER BY year, rating
+      ON CONFLICT (year, rating) DO UPDATE SET movies = movie_stats.movies + EXCLUDED.movies;
+  ELSE
+    INSERT INTO movie_stats(year, rating, movies)
+      SELECT year, rating, sum(change) FROM (SELECT year, rating, 1 AS change FROM new_rows
+                                             UNION ALL
+                                             SELECT year, rating, -1 FROM old_rows) AS changes
+      GROUP BY year, rating HAVING sum(change) <> 0 ORDER BY year, rating
+      ON CONFLICT (year, rating) DO UPDATE SET movies = movie_stats.movies + EXCLUDED.movies;
+  END IF;
+  DELETE FROM movie_stats WHERE movies = 0;
+  RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION movie_stats_clear() RETURNS trigger AS $$
+BEGIN
+  DELETE FROM movie_stats;
+  RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS movie_stats_insert ON movies;
+DROP TRIGGER IF EXISTS movie_stats_delete ON movies;
+DROP TRIGGER IF EXISTS movie_stats_update ON movies;
+DROP TRIGGER IF EXISTS movie_stats_truncate ON movies;
+CREATE TRIGGER movie_stats_insert AFTER INSERT ON movies
+  REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION movie_stats_apply();
+CREATE TRIGGER movie_stats_delete AFTER DELETE ON movies
+  REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION movie_stats_apply();
+CREATE TRIGGER movie_stats_update AFTER UPDATE ON movies
+  REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION movie_stats_apply();
+CREATE TRIGGER movie_stats_truncate AFTER TRUNCATE ON movies
+  FOR EACH STATEMENT EXECUTE FUNCTION movie_stats_clear();
+
+-- Counts for the movies already in the table
+DELETE FROM movie_stats;
+INSERT INTO movie_stats(year, rating, movies)
+  SELECT year, rating, count(*) FROM movies GROUP BY year, rating;
@@ -0,0 +1,22 @@
+-- A database built from the schema.sql that predates the migrations kept its
+-- own movies table when 0001 ran (CREATE TABLE IF NOT EXISTS skips it), so
+-- its id has no identity and its imdbid no default and create() fails. Each
+-- step runs only when the column still lacks them, moving the new sequence
+-- past the rows already there; a database built by 0001 is left as it is.
+DO $$
+BEGIN
+  IF NOT EXISTS (SELECT 1 FROM pg_attribute
+                  WHERE attrelid = 'movies'::regclass AND attname = 'id' AND attidentity <> '') THEN
+    ALTER TABLE movies ALTER COLUMN id ADD GENERATED BY DEFAULT AS IDENTITY;
+    PERFORM setval(pg_get_serial_sequence('movies', 'id'), coalesce(max(id), 0) + 1, false) FROM movies;
+  END IF;
+
+  IF NOT EXISTS (SELECT 1 FROM pg_attrdef
+                  WHERE adrelid = 'movies'::regclass
+                    AND adnum = (SELECT attnum FROM pg_attribute
+                                  WHERE attrelid = 'movies'::regclass AND attname = 'imdbid')) THEN
+    ALTER TABLE movies ALTER COLUMN imdbid SET DEFAULT nextval('movies_imdbid_seq');
+    PERFORM setval('movies_imdbid_seq', coalesce(max(imdbid), 0) + 1, false) FROM movies;
+  END IF;
+END
+$$;
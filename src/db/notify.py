@@ -0,0 +1,165 @@
+import json
+import os
+import secrets
+import select
+import threading
+import psycopg2
+import psycopg2.extensions
+from .swen344_db_utils import connect
+
+MOVIES_CHANNEL = 'movies_changed'
+SESSIONS_CHANNEL = 'sessions_revoked'
+# Postgres rejects NOTIFY payloads of 8000 bytes or more
+MAX_PAYLOAD = 7900
+
+# Identifies this process in its own notifications so it can skip them
+origin = secrets.token_hex(8)
+
+def _new_origin():
+    # Forked workers must not skip each other's notifications
+    global origin
+    origin = secrets.token_hex(8)
+
+os.register_at_fork(after_in_child=_new_origin)
+
+NOTIFY_SQL = 'SELECT pg_notify(%s, %s)'
+
+def _payload(message, shrink):
+    message = dict(message, origin=origin)
+    payload = json.dumps(message)
+    if len(payload) > MAX_PAYLOAD:
+        payload = json.dumps(shrink(message))
+    return payload
+
+def movies_changed_args(ids=None, version=None):
+    """Returns the (channel, payload) parameters of NOTIFY_SQL for a movies change"""
+    if version is not None:
+        version = [version[0], version[1].isoformat()]
+    message = {'ids': None if ids is None else list(ids), 'version': version}
+    return MOVIES_CHANNEL, _payload(message, lambda message: dict(message, ids=None))
+
+def sessions_revoked_args(digests=None):
+    """Returns the (channel, payload) parameters of NOTIFY_SQL for revoked session keys"""
+    message = {'digests': None if digests is None else list(digests)}
+    return SESSIONS_CHANNEL, _payload(message, lambda message: dict(message, digests=None))
+
+def tokens_revoked_args(entries):
+    """Returns the (channel, payload) parameters of NOTIFY_SQL for revoked signed tokens"""
+    message = {'tokens': [list(entry) for entry in entries]}
+    return SESSIONS_CHANNEL, _payload(message, lambda message: dict(message, tokens=None))
+
+def notify_movies_changed(cur, ids=None, version=None):
+    """
+    Queues a NOTIFY telling other workers which movies changed. It is sent
+    when the surrounding transaction commits and dropped if it rolls back.
+    Params:
+        cur : cursor of the transaction making the change
+        ids : ids of the movies that changed (None for all movies)
+        version : the (version, modified_at) the change produced, if known
+    Returns:
+        None
+    """
+    cur.execute(NOTIFY_SQL, movies_changed_args(ids, version))
+
+def notify_sessions_revoked(cur, digests=None):
+    """
+    Queues a NOTIFY telling other workers to forget cached session keys
+    Params:
+        cur : cursor of the transaction that revoked the sessions
+        digests : sha256 hex digests of the revoked keys (None for every session);
+                  the keys themselves never leave the database connection
+    Returns:
+        None
+    """
+    cur.execute(NOTIFY_SQL, sessions_revoked_args(digests))
+
+def notify_tokens_revoked(cur, entries):
+    """
+    Queues a NOTIFY telling other workers to deny signed tokens
+    Params:
+        cur : cursor of the transaction that recorded the revocation
+        entries : (jti, exp) pairs of the revoked tokens
+    Returns:
+        None
+    """
+    cur.execute(NOTIFY_SQL, tokens_revoked_args(entries))
+
+
+class ChangeListener(threading.Thread):
+    """
+    Background thread that LISTENs for changes made by other workers
+    Params:
+        handlers : {channel: handler}; each handler is called with the decoded
+                   message, or with None when anything on that channel may have
+                   been missed and everything cached from it is suspect
+        connect_fn : opens the dedicated (unpooled) connection used for LISTEN
+        poll_interval : seconds between checks for a stop request
+        retry_interval : seconds to wait before reconnecting after a failure
+    """
+    def __init__(self, handlers, connect_fn=connect, poll_interval=1.0, retry_interval=1.0):
+        super().__init__(name='change-listener', daemon=True)
+        self.handlers = handlers
+        self.connect_fn = connect_fn
+        self.poll_interval = poll_interval
+        self.retry_interval = retry_interval
+        self.healthy = threading.Event()
+        self._stopping = threading.Event()
+        self._conn = None
+
+    def run(self):
+        while not self._stopping.is_set():
+            try:
+                self._listen()
+            except (psycopg2.Error, OSError):
+                pass
+            finally:
+                self.healthy.clear()
+                self._close()
+            self._stopping.wait(self.retry_interval)
+
+    def stop(self):
+        """Asks the thread to exit and waits for it"""
+        self._stopping.set()
+        if self.is_alive():
+            self.join(self.poll_interval * 2)
+
+    def _listen(self):
+        self._conn = self.connect_fn()
+        self._conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        cur = self._conn.cursor()
+        for channel in self.handlers:
+            cur.execute('LISTEN %s' % channel)
+        # Anything cached before LISTEN took effect (or while we were
+        # disconnected) may have missed a notification
+        for handler in self.handlers.values():
+            handler(None)
+        self.healthy.set()
+
+        while not self._stopping.is_set():
+            if select.select([self._conn], [], [], self.poll_interval) == ([], [], []):
+                continue
+            self._conn.poll()
+            notifies, self._conn.notifies = self._conn.notifies, []
+            for notify in notifies:
+                self._dispatch(notify.channel, notify.payload)
+
+    def _dispatch(self, channel, payload):
+        handler = self.handlers.get(channel)
+        if handler is None:
+            return
+        try:
+            message = json.loads(payload)
+        except ValueError:
+            handler(None)
+            return
+        if message.get('origin') == origin:
+            return
+        handler(message)
+
+    def _close(self):
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except psycopg2.Error:
+                pass
+            self._conn = None
@@ -1,16 +1,11 @@
+-- Drops everything so rebuild_tables() can recreate the schema from
+-- scratch. The tables themselves are defined by the numbered files in
+-- src/db/migrations, applied in order by migrate.py.
 DROP TABLE IF EXISTS movies;
+DROP TABLE IF EXISTS movie_stats;
+DROP FUNCTION IF EXISTS movie_stats_apply(), movie_stats_clear();
+DROP SEQUENCE IF EXISTS movies_imdbid_seq;
 DROP TABLE IF EXISTS system_users;
-
-CREATE TABLE movies(
-  id      INTEGER PRIMARY KEY,
-  imdbid  INTEGER NOT NULL,
-  rating  INTEGER NOT NULL,
-  title   TEXT NOT NULL,
-  year    INTEGER NOT NULL
-);
-
-CREATE TABLE system_users(
-  username    TEXT NOT NULL PRIMARY KEY,
-  passw       VARCHAR(550) NOT NULL,
-  session_key TEXT
-);
\ No newline at end of file
+DROP TABLE IF EXISTS table_versions;
+DROP TABLE IF EXISTS revoked_tokens;
+DROP TABLE IF EXISTS schema_migrations;
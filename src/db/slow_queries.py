@@ -0,0 +1,193 @@
+import collections
+import logging
+import os
+import queue
+import random
+import threading
+import time
+import psycopg2
+import psycopg2.errors
+import psycopg2.extensions
+from .config import get_settings, on_reload
+
+# Statements slower than slow_query_ms are logged and kept, newest last, in
+# a ring buffer of slow_query_log_size entries that /admin/slow_queries
+# serves. Parameters are never stored, only their types and lengths.
+#
+# A sample (slow_query_explain_sample) of them is explained so the plan that
+# made them slow is kept with the entry. That happens on a background thread
+# with its own connection, in a transaction that is always rolled back, so
+# the request that ran the statement does not wait for it.
+#
+# Only plain SELECTs are run again, under EXPLAIN (ANALYZE, BUFFERS), and
+# then in a READ ONLY transaction: one that turns out to draw a sequence
+# value, call setval() or lock rows (FOR UPDATE) is refused by the server
+# and explained without ANALYZE instead. Writes only get the planner's
+# estimate, because running them again would take the original's row locks
+# (table_versions included) for up to slow_query_explain_timeout seconds and
+# repeat the sequence changes a rollback cannot undo. slow_query_explain_writes
+# runs them under ANALYZE too, for a test database where that is acceptable.
+
+log = logging.getLogger('bechdel.slow_queries')
+
+# Only these statements can be explained; COPY, DDL, PREPARE and the like cannot
+EXPLAINABLE = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH', 'VALUES', 'TABLE')
+# and only these are run again by EXPLAIN ANALYZE (a WITH may hold a write)
+READ_ONLY = ('SELECT', 'VALUES', 'TABLE')
+EXPLAIN_QUEUE_SIZE = 16
+
+_entries = None
+_jobs = None
+_explainer = None
+_lock = threading.Lock()
+
+
+def entries():
+    """The ring buffer of slow statements, sized from the settings on first use"""
+    global _entries
+    if _entries is None:
+        with _lock:
+            if _entries is None:
+                _entries = collections.deque(maxlen=max(1, get_settings().slow_query_log_size))
+    return _entries
+
+def recent():
+    """Copies of the kept entries, newest first"""
+    return [dict(entry) for entry in reversed(list(entries()))]
+
+def clear():
+    entries().clear()
+
+def _redact_value(value):
+    if value is None:
+        return 'NULL'
+    if isinstance(value, (str, bytes)):
+        return '<%s:%d>' % (type(value).__name__, len(value))
+    if isinstance(value, (list, tuple)):
+        return '<array:%d>' % len(value)
+    return '<%s>' % type(value).__name__
+
+def redact(args):
+    """
+    Describes a statement's parameters without their values
+    Params:
+        args : the sequence or mapping given to execute()
+    Returns:
+        The same shape with each value replaced by its type ('<str:12>', '<int>', 'NULL')
+    """
+    if args is None:
+        return None
+    if isinstance(args, dict):
+        return {name: _redact_value(value) for name, value in args.items()}
+    return [_redact_value(value) for value in args]
+
+def _text(sql):
+    return sql.decode() if isinstance(sql, bytes) else str(sql)
+
+def _first_word(sql):
+    words = _text(sql).split(None, 1)
+    return words[0].upper() if words else ''
+
+def explainable(sql):
+    return _first_word(sql) in EXPLAINABLE
+
+def _explain(cur, sql, args, analyze):
+    """The plan of one statement, as lines of text"""
+    cur.execute('SET LOCAL statement_timeout = %s', (int(get_settings().slow_query_explain_timeout * 1000),))
+    if analyze:
+        cur.execute('EXPLAIN (ANALYZE, BUFFERS) ' + _text(sql), args)
+    else:
+        cur.execute('EXPLAIN ' + _text(sql), args)
+    return '\n'.join(row[0] for row in cur.fetchall())
+
+def record(sql, args, seconds, rows, label, explain=True):
+    """
+    Keeps and logs one slow statement, and queues it for EXPLAIN when it is sampled
+    Params:
+        sql : the statement text with its %s placeholders
+        args : its parameters; only handed to the explainer, never stored
+        seconds : how long it took
+        rows : rows it returned or changed (None if it failed)
+        label : its metrics label (see swen344_db_utils.query_label)
+        explain : False for statements that cannot be run again on their own (executemany, COPY)
+    """
+    settings = get_settings()
+    entry = {
+        'at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'query': label,
+        'sql': _text(sql),
+        'params': redact(args),
+        'ms': round(seconds * 1000, 3),
+        'rows': rows,
+        'explain': 'skipped',
+        'plan': None,
+    }
+    if explain and explainable(sql) and random.random() < settings.slow_query_explain_sample:
+        entry['explain'] = 'pending'
+        try:
+            _explain_queue().put_nowait((entry, sql, args))
+        except queue.Full:
+            entry['explain'] = 'skipped'
+    entries().append(entry)
+    log.warning('slow query %s: %.1f ms, %s rows: %s params=%s',
+                label, entry['ms'], rows, ' '.join(entry['sql'].split()), entry['params'])
+
+def _explain_queue():
+    """The explainer's work queue; the thread is started on first use"""
+    global _jobs, _explainer
+    if _explainer is None:
+        with _lock:
+            if _explainer is None:
+                _jobs = queue.Queue(EXPLAIN_QUEUE_SIZE)
+                _explainer = threading.Thread(target=_explain_loop, args=(_jobs,), name='slow-query-explain', daemon=True)
+                _explainer.start()
+    return _jobs
+
+def _explain_loop(jobs):
+    from .swen344_db_utils import connect  # imported here: swen344_db_utils imports this module
+    conn = None
+    while True:
+        entry, sql, args = jobs.get()
+        try:
+            if conn is None or conn.closed:
+                conn = connect()
+            # A plain cursor: the explainer's own statements are not timed or logged
+            cur = conn.cursor(cursor_factory=psycopg2.extensions.cursor)
+            if get_settings().slow_query_explain_writes:
+                entry['plan'] = _explain(cur, sql, args, analyze=True)
+            elif _first_word(sql) in READ_ONLY:
+                try:
+                    cur.execute('SET TRANSACTION READ ONLY')
+                    entry['plan'] = _explain(cur, sql, args, analyze=True)
+                except psycopg2.errors.ReadOnlySqlTransaction:
+                    conn.rollback()
+                    entry['plan'] = _explain(cur, sql, args, analyze=False)
+            else:
+                entry['plan'] = _explain(cur, sql, args, analyze=False)
+            entry['explain'] = 'done'
+        except (psycopg2.Error, TypeError, ValueError) as error:
+            entry['explain'] = 'failed: %s' % str(error).strip().splitlines()[0]
+        finally:
+            if conn is not None and not conn.closed:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    conn.close()
+
+def _reset(settings):
+    """Resizes the ring buffer after a reload, keeping the newest entries"""
+    global _entries
+    with _lock:
+        if _entries is not None and _entries.maxlen != max(1, settings.slow_query_log_size):
+            _entries = collections.deque(_entries, maxlen=max(1, settings.slow_query_log_size))
+
+on_reload(_reset)
+
+def _after_fork():
+    # The explainer thread and its connection stay with the parent
+    global _jobs, _explainer, _lock
+    _jobs = None
+    _explainer = None
+    _lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_after_fork)
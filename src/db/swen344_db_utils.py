@@ -1,48 +1,451 @@
 import psycopg2
-import yaml
+import psycopg2.extensions
+import psycopg2.pool
+import itertools
 import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from .config import get_settings, on_reload
+from . import metrics, slow_queries
 
-def connect():
-    config = {}
-    yml_path = os.path.join(os.path.dirname(__file__), '../../config/db.yml')
-    with open(yml_path, 'r') as file:
-        config = yaml.load(file, Loader=yaml.FullLoader)
-    return psycopg2.connect(dbname=config['database'],
-                            user=config['user'],
-                            password=config['password'],
-                            host=config['host'],
-                            port=config['port'])
+
+# Round trips to the server made by each thread, so a request handler can
+# report how many it needed (see round_trips)
+_round_trips = threading.local()
+
+def round_trips():
+    """Round trips this thread has made to the server since reset_round_trips()"""
+    return getattr(_round_trips, 'count', 0)
+
+def reset_round_trips():
+    _round_trips.count = 0
+
+def _count_round_trip():
+    _round_trips.count = getattr(_round_trips, 'count', 0) + 1
+
+
+# Statements are labelled in the metrics by the name of a prepared statement,
+# or by their verb and first table ("select movies"), which keeps the label
+# set small however many different texts the code sends
+_QUERY_VERB = re.compile(r'\s*(\w+)(?:\s+(\w+))?')
+_QUERY_TABLE = re.compile(r'\b(?:FROM|INTO|UPDATE|JOIN)\s+(\w+)', re.IGNORECASE)
+_query_labels = {}
+MAX_QUERY_LABELS = 1000
+
+def query_label(sql):
+    """The metrics label of a statement (see above)"""
+    label = _query_labels.get(sql)
+    if label is not None:
+        return label
+    text = sql.decode() if isinstance(sql, bytes) else str(sql)
+    verb = _QUERY_VERB.match(text)
+    if verb is None:
+        label = 'other'
+    elif verb.group(1).upper() in ('EXECUTE', 'PREPARE') and verb.group(2):
+        label = verb.group(2) if verb.group(1).upper() == 'EXECUTE' else 'prepare ' + verb.group(2)
+    else:
+        table = _QUERY_TABLE.search(text)
+        label = verb.group(1).lower() + (' ' + table.group(1) if table else '')
+    if len(_query_labels) < MAX_QUERY_LABELS:
+        _query_labels[sql] = label
+    return label
+
+
+class InstrumentedCursor(psycopg2.extensions.cursor):
+    """
+    Cursor that counts every round trip it makes (statements, and fetches of
+    a server-side cursor) and records each statement's time and row count
+    """
+    def execute(self, query, vars=None):
+        return self._timed(query, vars, True, super().execute, query, vars)
+
+    def executemany(self, query, vars_list):
+        return self._timed(query, vars_list, False, super().executemany, query, vars_list)
+
+    def copy_expert(self, sql, file, size=8192):
+        return self._timed(sql, None, False, super().copy_expert, sql, file, size)
+
+    def fetchmany(self, size=None):
+        rows = super().fetchmany(size) if size is not None else super().fetchmany()
+        if self.name is not None:
+            _count_round_trip()
+            metrics.QUERY_ROWS.inc(self.label, amount=len(rows))
+        return rows
+
+    def _timed(self, sql, params, explain, run, *args):
+        """
+        Runs one statement, recording its time, rows and errors, and handing it to
+        the slow query log when it took longer than slow_query_ms
+        """
+        _count_round_trip()
+        self.label = query_label(sql)
+        started = time.perf_counter()
+        failed = True
+        try:
+            result = run(*args)
+            failed = False
+            return result
+        except psycopg2.Error:
+            metrics.QUERY_ERRORS.inc(self.label)
+            raise
+        finally:
+            seconds = time.perf_counter() - started
+            metrics.QUERY_SECONDS.observe(seconds, self.label)
+            rows = None if failed else self.rowcount
+            if rows is not None and rows > 0:
+                metrics.QUERY_ROWS.inc(self.label, amount=rows)
+            threshold = get_settings().slow_query_ms
+            if threshold > 0 and seconds * 1000 >= threshold:
+                # A prepared statement is logged (and explained) as its SQL, not as EXECUTE name
+                slow_queries.record(_statements.get(self.label, sql), params, seconds, rows, self.label, explain)
+
+
+class Connection(psycopg2.extensions.connection):
+    """
+    psycopg2 connection that remembers which statements it has prepared on the
+    server and counts its round trips and query times (see InstrumentedCursor;
+    commits and rollbacks count as round trips too)
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+        self.cursor_factory = InstrumentedCursor
+
+    def commit(self):
+        if self.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            _count_round_trip()
+        return super().commit()
+
+    def rollback(self):
+        if self.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            _count_round_trip()
+        return super().rollback()
+
+def connect(settings=None):
+    settings = settings or get_settings()
+    return psycopg2.connect(dbname=settings.database,
+                            user=settings.user,
+                            password=settings.password,
+                            host=settings.host,
+                            port=settings.port,
+                            connection_factory=Connection)
+
+
+class PoolTimeout(psycopg2.pool.PoolError):
+    """Raised when no connection could be checked out before the timeout ran out"""
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of psycopg2 connections
+    Params:
+        connect_fn : callable that opens a brand new connection
+        minconn : connections opened up front and kept around
+        maxconn : hard cap on open connections (idle + checked out)
+        timeout : seconds getconn() waits for a free connection
+        check_idle : connections idle for longer than this are pinged before reuse
+    """
+    def __init__(self, connect_fn, minconn=1, maxconn=10, timeout=30.0, check_idle=30.0):
+        if minconn < 0 or maxconn < 1 or minconn > maxconn:
+            raise psycopg2.pool.PoolError('invalid pool size: min=%s max=%s' % (minconn, maxconn))
+        self._connect = connect_fn
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.check_idle = check_idle
+        self._cond = threading.Condition()
+        self._idle = []  # (conn, last_used) pairs, most recently used last
+        self._size = 0
+        self._closed = False
+        for _ in range(minconn):
+            self._idle.append((self._connect(), time.monotonic()))
+            self._size += 1
+
+    @property
+    def size(self):
+        """Number of connections currently open, idle or checked out"""
+        return self._size
+
+    @property
+    def idle(self):
+        """Number of connections waiting in the pool"""
+        return len(self._idle)
+
+    def getconn(self, timeout=None):
+        """
+        Checks a healthy connection out of the pool, opening a new one if the pool is not full
+        Params:
+            timeout : overrides the pool's checkout timeout (seconds)
+        Returns:
+            An open psycopg2 connection with no transaction in progress
+        Raises:
+            PoolTimeout if every connection stays checked out for the whole timeout
+        """
+        deadline = time.monotonic() + (self.timeout if timeout is None else timeout)
+        while True:
+            conn = None
+            with self._cond:
+                while True:
+                    if self._closed:
+                        raise psycopg2.pool.PoolError('connection pool is closed')
+                    if self._idle:
+                        conn, last_used = self._idle.pop()
+                        break
+                    if self._size < self.maxconn:
+                        self._size += 1
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise PoolTimeout('no connection available within %ss (max %s)'
+                                          % (self.timeout if timeout is None else timeout, self.maxconn))
+                    self._cond.wait(remaining)
+
+            if conn is None:
+                try:
+                    return self._connect()
+                except Exception:
+                    self._forget()
+                    raise
+
+            if self._is_healthy(conn, last_used):
+                return conn
+            self._close_quietly(conn)
+            self._forget()
+
+    def putconn(self, conn, discard=False):
+        """
+        Returns a connection to the pool, rolling back anything left uncommitted
+        Params:
+            conn : connection previously handed out by getconn()
+            discard : close the connection instead of keeping it (e.g. it is known to be broken)
+        """
+        if not discard and not conn.closed:
+            status = conn.get_transaction_status()
+            if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                discard = True
+            elif status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    discard = True
+
+        with self._cond:
+            if discard or conn.closed or self._closed:
+                self._close_quietly(conn)
+                self._size -= 1
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def closeall(self):
+        """Closes every idle connection and refuses further checkouts"""
+        with self._cond:
+            self._closed = True
+            for conn, _ in self._idle:
+                self._close_quietly(conn)
+            self._size -= len(self._idle)
+            self._idle = []
+            self._cond.notify_all()
+
+    def _is_healthy(self, conn, last_used):
+        if conn.closed:
+            return False
+        if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            return False
+        if time.monotonic() - last_used < self.check_idle:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute('SELECT 1')
+            cur.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _forget(self):
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    @staticmethod
+    def _close_quietly(conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """Returns the process-wide connection pool, creating it on first use"""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                settings = get_settings()
+                _pool = ConnectionPool(connect,
+                                       minconn=settings.pool_min,
+                                       maxconn=settings.pool_max,
+                                       timeout=settings.pool_timeout,
+                                       check_idle=settings.pool_check_idle)
+    return _pool
+
+def close_pool():
+    """Closes the process-wide pool; the next query opens a fresh one"""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+
+_inherited = []
+
+def _reset_after_fork():
+    """
+    Gives a forked child its own pool. The parent's connections share their
+    sockets with the parent, so they are kept referenced (never closed or
+    garbage collected, which would send a terminate message on the shared
+    socket) and simply left unused.
+    """
+    global _pool, _pool_lock
+    if _pool is not None:
+        _inherited.append(_pool)
+    _pool = None
+    _pool_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+def _pool_metrics():
+    pool = _pool
+    if pool is None:
+        return []
+    return [('bechdel_db_pool_connections', 'gauge', 'Open connections of the pool, by state',
+             [({'state': 'idle'}, pool.idle), ({'state': 'in_use'}, pool.size - pool.idle)]),
+            ('bechdel_db_pool_max_connections', 'gauge', 'Most connections the pool will open', [({}, pool.maxconn)])]
+
+metrics.add_collector(_pool_metrics)
+
+# New credentials only reach the database through new connections, so a
+# reload retires the current pool. Checked-out connections are closed as
+# they come back.
+on_reload(lambda settings: close_pool())
+
+@contextmanager
+def pooled_connection(timeout=None):
+    """
+    Checks a connection out of the pool for the duration of a with block.
+    Uncommitted work is rolled back when the block exits, and connections that
+    died mid-query are closed instead of going back into the pool.
+    """
+    pool = get_pool()
+    started = time.perf_counter()
+    try:
+        conn = pool.getconn(timeout)
+    except PoolTimeout:
+        metrics.POOL_TIMEOUTS.inc()
+        raise
+    finally:
+        metrics.POOL_WAIT_SECONDS.observe(time.perf_counter() - started)
+    broken = False
+    try:
+        yield conn
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        broken = True
+        raise
+    finally:
+        pool.putconn(conn, discard=broken)
 
 def exec_sql_file(path):
     full_path = os.path.join(os.path.dirname(__file__), f'../../{path}')
-    conn = connect()
-    cur = conn.cursor()
-    with open(full_path, 'r') as file:
-        cur.execute(file.read())
-    conn.commit()
-    conn.close()
+    with pooled_connection() as conn:
+        cur = conn.cursor()
+        with open(full_path, 'r') as file:
+            cur.execute(file.read())
+        conn.commit()
 
 def exec_get_one(sql, args={}):
-    conn = connect()
-    cur = conn.cursor()
-    cur.execute(sql, args)
-    one = cur.fetchone()
-    conn.close()
-    return one
+    with pooled_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(sql, args)
+        one = cur.fetchone()
+        conn.commit()
+        return one
 
 def exec_get_all(sql, args={}):
-    conn = connect()
-    cur = conn.cursor()
-    cur.execute(sql, args)
-    # https://www.psycopg.org/docs/cursor.html#cursor.fetchall
-    list_of_tuples = cur.fetchall()
-    conn.close()
-    return list_of_tuples
+    with pooled_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(sql, args)
+        # https://www.psycopg.org/docs/cursor.html#cursor.fetchall
+        list_of_tuples = cur.fetchall()
+        conn.commit()
+        return list_of_tuples
 
 def exec_commit(sql, args={}):
-    conn = connect()
-    cur = conn.cursor()
-    result = cur.execute(sql, args)
-    conn.commit()
-    conn.close()
-    return result
\ No newline at end of file
+    with pooled_connection() as conn:
+        cur = conn.cursor()
+        result = cur.execute(sql, args)
+        conn.commit()
+        return result
+
+# Hot statements are prepared on the server the first time a connection runs
+# them and executed by name after that, so Postgres parses and plans them once
+# per connection rather than on every call. Prepared statements outlive
+# transactions (a rollback does not drop them) and die with the connection.
+_statements = {}
+_PLACEHOLDER = re.compile(r'%s')
+
+def prepared_statement(name, sql):
+    """
+    Registers a statement to be prepared once per connection
+    Params:
+        name : server-side statement name, unique across the code base
+        sql : the statement, with %s placeholders like any other query
+    Returns:
+        name, for use with execute_prepared()
+    """
+    _statements[name] = sql
+    return name
+
+def statement_sql(name):
+    """The SQL of a registered statement, with its %s placeholders"""
+    return _statements[name]
+
+def execute_prepared(cur, name, args=()):
+    """
+    Runs a registered statement on cur, preparing it on cur's connection first
+    if it has not been yet. With prepare_statements off it runs as plain SQL.
+    """
+    sql = _statements[name]
+    prepared = getattr(cur.connection, 'prepared', None)
+    if prepared is None or not get_settings().prepare_statements:
+        cur.execute(sql, args)
+        return
+    if name not in prepared:
+        numbers = itertools.count(1)
+        cur.execute('PREPARE %s AS %s' % (name, _PLACEHOLDER.sub(lambda match: '$%d' % next(numbers), sql)))
+        prepared.add(name)
+    if args:
+        cur.execute('EXECUTE %s (%s)' % (name, ', '.join(['%s'] * len(args))), args)
+    else:
+        cur.execute('EXECUTE %s' % name)
+
+def exec_prepared_one(name, args=()):
+    with pooled_connection() as conn:
+        cur = conn.cursor()
+        execute_prepared(cur, name, args)
+        one = cur.fetchone()
+        conn.commit()
+        return one
+
+def exec_prepared_all(name, args=()):
+    with pooled_connection() as conn:
+        cur = conn.cursor()
+        execute_prepared(cur, name, args)
+        list_of_tuples = cur.fetchall()
+        conn.commit()
+        return list_of_tuples
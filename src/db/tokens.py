@@ -0,0 +1,109 @@
+import base64
+import hashlib
+import hmac
+import json
+import secrets
+import threading
+import time
+
+PREFIX = 'v1.'
+
+def _encode(raw):
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode('ascii')
+
+def _decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+def _sign(secret, body):
+    return _encode(hmac.new(secret.encode('utf-8'), body.encode('ascii'), hashlib.sha256).digest())
+
+def is_token(value):
+    """Tells signed tokens apart from the hex session keys stored in system_users"""
+    return isinstance(value, str) and value.startswith(PREFIX)
+
+def issue_token(username, secret, ttl, now=None):
+    """
+    Creates a compact HMAC-SHA256 signed token that carries its own username and expiry
+    Params:
+        username : user the token authenticates
+        secret : shared signing secret (every worker must use the same one)
+        ttl : seconds until the token expires
+        now : current unix time, for tests
+    Returns:
+        The token string
+    """
+    if not secret:
+        raise ValueError('signed tokens need a token_secret setting')
+    now = time.time() if now is None else now
+    claims = {'u': username, 'exp': int(now + ttl), 'jti': secrets.token_urlsafe(12)}
+    body = _encode(json.dumps(claims, separators=(',', ':')).encode('utf-8'))
+    return PREFIX + body + '.' + _sign(secret, body)
+
+def verify_token(token, secret, now=None):
+    """
+    Checks a token's signature and expiry using only the CPU
+    Params:
+        token : string produced by issue_token
+        secret : the signing secret
+        now : current unix time, for tests
+    Returns:
+        The claims dictionary (u, exp, jti), or None if the token is not valid
+    """
+    if not secret or not is_token(token):
+        return None
+    try:
+        body, signature = token[len(PREFIX):].split('.')
+        # Tokens are ASCII; anything else a client sends fails to encode (UnicodeEncodeError)
+        signed = hmac.compare_digest(signature.encode('ascii'), _sign(secret, body).encode('ascii'))
+    except ValueError:
+        return None
+    if not signed:
+        return None
+    try:
+        claims = json.loads(_decode(body))
+    except ValueError:
+        return None
+    now = time.time() if now is None else now
+    if not isinstance(claims, dict) or claims.get('exp', 0) <= now:
+        return None
+    return claims
+
+
+class Denylist:
+    """
+    Token ids revoked before they expired. An entry is only needed until its
+    token would have expired anyway, so the list stays as small as the number
+    of recent logouts.
+    """
+    def __init__(self, clock=time.time):
+        self._clock = clock
+        self._expiries = {}  # jti -> exp
+        self._lock = threading.Lock()
+        self._next_purge = 0
+
+    def __contains__(self, jti):
+        with self._lock:
+            exp = self._expiries.get(jti)
+            return exp is not None and exp > self._clock()
+
+    def __len__(self):
+        return len(self._expiries)
+
+    def add(self, jti, exp):
+        """Revokes the token id until exp (unix time)"""
+        with self._lock:
+            self._expiries[jti] = exp
+            self._purge()
+
+    def replace(self, entries):
+        """Swaps the whole list for the given (jti, exp) pairs"""
+        with self._lock:
+            self._expiries = dict(entries)
+            self._purge()
+
+    def _purge(self):
+        now = self._clock()
+        if now < self._next_purge:
+            return
+        self._expiries = {jti: exp for jti, exp in self._expiries.items() if exp > now}
+        self._next_purge = now + 60
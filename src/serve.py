@@ -0,0 +1,225 @@
+import argparse
+import gc
+import os
+import signal
+import socket
+import sys
+import time
+import traceback
+from waitress import wasyncore
+from waitress.server import create_server
+from db.config import get_settings, install_reload_handler
+from db.swen344_db_utils import close_pool
+from db.bechdel_db import stop_cache_listener
+from server import create_app
+
+# Seconds to wait before replacing a worker that died, so a worker that
+# crashes on startup does not turn into a fork loop
+RESPAWN_DELAY = 1.0
+POLL_INTERVAL = 0.2
+LISTEN_BACKLOG = 1024
+
+
+def log(message):
+    print('[serve %d] %s' % (os.getpid(), message), file=sys.stderr, flush=True)
+
+def parse_bind(value):
+    """Splits HOST:PORT (or [IPv6]:PORT) into a (host, port) pair"""
+    host, _, port = value.rpartition(':')
+    if not host or not port.isdigit():
+        raise argparse.ArgumentTypeError('expected HOST:PORT, got %r' % value)
+    return host.strip('[]'), int(port)
+
+def listen(host, port, backlog=LISTEN_BACKLOG):
+    """
+    Opens the listening socket before forking so every worker accepts from it
+    Params:
+        host : address to bind
+        port : TCP port (0 picks a free one)
+        backlog : connections the kernel queues while every worker is busy
+    Returns:
+        The bound, listening socket
+    """
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.setblocking(False)
+    return sock
+
+
+class Worker:
+    """
+    One forked process serving requests on the shared socket with a pool of threads.
+    SIGTERM or SIGINT stops it accepting; requests already received are finished
+    and flushed (up to graceful_timeout) before it exits.
+    Params:
+        app : the WSGI application
+        sock : listening socket inherited from the launcher
+        threads : request threads (size pool_max to match)
+        graceful_timeout : seconds allowed for in-flight requests after a stop signal
+    """
+    def __init__(self, app, sock, threads, graceful_timeout):
+        self.app = app
+        self.sock = sock
+        self.threads = threads
+        self.graceful_timeout = graceful_timeout
+        self.stopping = False
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        install_reload_handler()
+
+        socket_map = {}
+        server = create_server(self.app, map=socket_map, sockets=[self.sock], threads=self.threads)
+        while not self.stopping:
+            wasyncore.loop(timeout=POLL_INTERVAL, map=socket_map, count=1)
+
+        server.accepting = False
+        deadline = time.monotonic() + self.graceful_timeout
+        while self._busy(server, socket_map) and time.monotonic() < deadline:
+            wasyncore.loop(timeout=POLL_INTERVAL, map=socket_map, count=1)
+        server.task_dispatcher.shutdown()
+        wasyncore.close_all(socket_map)
+        stop_cache_listener()
+        close_pool()
+
+    def _stop(self, signum, frame):
+        self.stopping = True
+
+    @staticmethod
+    def _busy(server, socket_map):
+        """True while any connection has a request running or a response left to send"""
+        for channel in list(socket_map.values()):
+            if isinstance(channel, server.channel_class) and (channel.requests or channel.total_outbufs_len):
+                return True
+        return False
+
+
+class Launcher:
+    """
+    Pre-forks workers that share one listening socket, replaces any that die,
+    forwards SIGHUP (settings reload) to them and stops them all on SIGTERM/SIGINT
+    Params:
+        app : the WSGI application, built once before forking
+        sock : the listening socket
+        workers : number of processes
+        threads : request threads per process
+        graceful_timeout : seconds a worker gets to finish its requests before it is killed
+    """
+    def __init__(self, app, sock, workers, threads, graceful_timeout):
+        self.app = app
+        self.sock = sock
+        self.workers = workers
+        self.threads = threads
+        self.graceful_timeout = graceful_timeout
+        self.children = set()
+        self.stopping = False
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        signal.signal(signal.SIGHUP, self._forward)
+        host, port = self.sock.getsockname()[:2]
+        log('listening on %s:%d with %d workers x %d threads' % (host, port, self.workers, self.threads))
+
+        # Objects created so far are shared copy-on-write with every worker;
+        # keep the collector from touching (and so copying) them
+        gc.freeze()
+        for _ in range(self.workers):
+            self._spawn()
+
+        while not self.stopping:
+            if not self._reap():
+                time.sleep(POLL_INTERVAL)
+            elif not self.stopping:
+                time.sleep(RESPAWN_DELAY)
+                while len(self.children) < self.workers and not self.stopping:
+                    self._spawn()
+        self._shutdown()
+
+    def _spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                signal.signal(signal.SIGHUP, signal.SIG_DFL)
+                Worker(self.app, self.sock, self.threads, self.graceful_timeout).run()
+            except BaseException:
+                traceback.print_exc()
+                code = 1
+            finally:
+                # Never return into the launcher's loop or run its cleanup
+                os._exit(code)
+        self.children.add(pid)
+        log('started worker %d' % pid)
+
+    def _reap(self):
+        """Collects exited workers; returns True if any were found"""
+        reaped = False
+        while self.children:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                break
+            self.children.discard(pid)
+            reaped = True
+            if not self.stopping:
+                log('worker %d exited with status %d' % (pid, os.waitstatus_to_exitcode(status)))
+        return reaped
+
+    def _signal_children(self, signum):
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                self.children.discard(pid)
+
+    def _stop(self, signum, frame):
+        self.stopping = True
+
+    def _forward(self, signum, frame):
+        self._signal_children(signum)
+
+    def _shutdown(self):
+        log('stopping %d workers' % len(self.children))
+        self._signal_children(signal.SIGTERM)
+        deadline = time.monotonic() + self.graceful_timeout + 5
+        while self.children and time.monotonic() < deadline:
+            if not self._reap():
+                time.sleep(POLL_INTERVAL)
+        if self.children:
+            log('killing %d workers that did not stop in time' % len(self.children))
+            self._signal_children(signal.SIGKILL)
+            while self.children:
+                pid, _ = os.waitpid(-1, 0)
+                self.children.discard(pid)
+        self.sock.close()
+
+
+def main(argv=None):
+    settings = get_settings()
+    parser = argparse.ArgumentParser(description='Serve the API with pre-forked multi-threaded workers')
+    parser.add_argument('--bind', type=parse_bind, default=(settings.bind_host, settings.bind_port),
+                        help='HOST:PORT to listen on (default bind_host:bind_port from the settings)')
+    parser.add_argument('--workers', type=int, default=settings.workers,
+                        help='worker processes (default the workers setting; 0 means one per CPU)')
+    parser.add_argument('--threads', type=int, default=settings.threads,
+                        help='request threads per worker (default the threads setting)')
+    parser.add_argument('--graceful-timeout', type=float, default=settings.graceful_timeout,
+                        help='seconds in-flight requests get to finish on shutdown')
+    args = parser.parse_args(argv)
+
+    workers = args.workers if args.workers > 0 else os.cpu_count() or 1
+    if args.threads < 1:
+        parser.error('--threads must be at least 1')
+    if args.threads > settings.pool_max:
+        log('warning: %d threads share a pool of %d connections; requests will queue for them'
+            % (args.threads, settings.pool_max))
+
+    sock = listen(*args.bind)
+    Launcher(create_app(), sock, workers, args.threads, args.graceful_timeout).run()
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,49 @@
 from flask import Flask
 from flask_restful import Resource, Api
-from api.bechdel import List_All_Keys, List_Details, Show, Login_User, Logout_User, UserAPI, Register, UpdateRating
+from api.bechdel import start_request_timer, record_request, report_round_trips, List_All_Keys, List_Details, Search, Show, Stats, Login_User, Logout_User, UserAPI, Register, UpdateRating, Cache_Stats, Metrics, Slow_Queries, Profiles, Profile, UserBatch, UpdateRatingBatch
+from api.compress import compress_response
+from api.profiling import ProfilingMiddleware
+from db.config import get_settings, install_reload_handler
+from db.swen344_db_utils import reset_round_trips
 
-app = Flask(__name__)
-api = Api(app)
+def create_app():
+    """
+    Builds the Flask app with every resource registered. It holds no database
+    state, so a launcher can build it once and fork workers that share it.
+    """
+    app = Flask(__name__)
+    api = Api(app)
 
-api.add_resource(List_All_Keys, '/list_all_keys')
-api.add_resource(List_Details, '/list_details')
-api.add_resource(Show, '/show')
-api.add_resource(Login_User, '/login')
-api.add_resource(Logout_User, '/logout')
-api.add_resource(UserAPI, '/user')
-api.add_resource(Register, '/register')
-api.add_resource(UpdateRating, '/update_rating')
+    api.add_resource(List_All_Keys, '/list_all_keys')
+    api.add_resource(List_Details, '/list_details')
+    api.add_resource(Search, '/movies/search')
+    api.add_resource(Show, '/show')
+    api.add_resource(Stats, '/stats')
+    api.add_resource(Login_User, '/login')
+    api.add_resource(Logout_User, '/logout')
+    api.add_resource(UserAPI, '/user')
+    api.add_resource(Register, '/register')
+    api.add_resource(UpdateRating, '/update_rating')
+    api.add_resource(UserBatch, '/user/batch')
+    api.add_resource(UpdateRatingBatch, '/update_rating/batch')
+    api.add_resource(Cache_Stats, '/cache_stats')
+    api.add_resource(Metrics, '/metrics')
+    api.add_resource(Slow_Queries, '/admin/slow_queries')
+    api.add_resource(Profiles, '/admin/profiles')
+    api.add_resource(Profile, '/admin/profiles/<string:profile_id>')
+
+    # after_request hooks run last-registered first: latency includes compression
+    app.before_request(start_request_timer)
+    app.after_request(record_request)
+    app.after_request(compress_response)
+    if get_settings().round_trip_header:
+        app.before_request(reset_round_trips)
+        app.after_request(report_round_trips)
+    app.wsgi_app = ProfilingMiddleware(app.wsgi_app)
+    return app
 
 
 if __name__ == '__main__':
-    app.run(debug=True)
\ No newline at end of file
+    # Development server; use serve.py to run the API in production
+    install_reload_handler()
+    create_app().run(debug=True)
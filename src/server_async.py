@@ -0,0 +1,51 @@
+import argparse
+import resource
+from aiohttp import web
+from api import bechdel_async
+from db.config import get_settings, install_reload_handler
+from db import bechdel_db_async
+
+async def close_database(app):
+    await bechdel_db_async.close_pool()
+
+def create_app():
+    """Builds the aiohttp app serving the same endpoints as server.py"""
+    app = web.Application()
+
+    app.router.add_get('/list_all_keys', bechdel_async.list_all_keys)
+    app.router.add_get('/list_details', bechdel_async.list_details)
+    app.router.add_get('/movies/search', bechdel_async.search)
+    app.router.add_get('/show', bechdel_async.show)
+    app.router.add_get('/stats', bechdel_async.stats)
+    app.router.add_post('/login', bechdel_async.login)
+    app.router.add_post('/logout', bechdel_async.logout)
+    app.router.add_post('/user', bechdel_async.create_movie)
+    app.router.add_delete('/user', bechdel_async.delete_movie)
+    app.router.add_post('/register', bechdel_async.register)
+    app.router.add_post('/update_rating', bechdel_async.update_rating)
+    app.router.add_post('/user/batch', bechdel_async.create_movies)
+    app.router.add_delete('/user/batch', bechdel_async.delete_movies)
+    app.router.add_post('/update_rating/batch', bechdel_async.update_ratings)
+
+    app.on_cleanup.append(close_database)
+    return app
+
+def raise_open_file_limit():
+    """Every keep-alive client holds a socket, so allow as many as the hard limit permits"""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+def main(argv=None):
+    settings = get_settings()
+    parser = argparse.ArgumentParser(description='Serve the API from a single asyncio event loop')
+    parser.add_argument('--host', default=settings.bind_host, help='address to listen on (default bind_host)')
+    parser.add_argument('--port', type=int, default=settings.bind_port, help='port to listen on (default bind_port)')
+    args = parser.parse_args(argv)
+
+    raise_open_file_limit()
+    install_reload_handler()
+    web.run_app(create_app(), host=args.host, port=args.port, backlog=1024, access_log=None)
+
+if __name__ == '__main__':
+    main()
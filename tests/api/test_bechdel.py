@@ -1,6 +1,10 @@
+import base64
+import gzip
 import unittest
 import json
 import hashlib
+import requests
+import threading
 from tests.test_utils import *
 import src.db.bechdel_db as bechdel
 
@@ -9,6 +13,7 @@ class TestBechdel(unittest.TestCase):
     def setUp(self):
         bechdel.rebuild_tables()
         bechdel.build_movie_table()
+        reset_rest_session()
         
 
     #REST1 Test Methods
@@ -50,11 +55,162 @@ class TestBechdel(unittest.TestCase):
         self.assertEqual(result_row, [8892, 4648786, 3, 'Harriet', 2019])
 
 
+    def test_bechdel_list_details_pagination(self):
+        """Following the Link headers of list_details pages returns every movie once"""
+        url = 'http://localhost:5000/list_details?limit=1000'
+        ids = []
+        while url:
+            response = requests.get(url)
+            self.assertEqual(response.status_code, 200)
+            ids.extend(row[0] for row in response.json())
+            next_link = response.links.get('next')
+            url = requests.compat.urljoin(response.url, next_link['url']) if next_link else None
+
+        self.assertEqual(len(ids), 8363)
+        self.assertEqual(ids, sorted(set(ids)))
+
+    def test_bechdel_list_details_bad_limit(self):
+        """Non-numeric paging parameters are rejected"""
+        get_rest_call(self, 'http://localhost:5000/list_details', params={"limit" : "lots"}, expected_code=400)
+
+    def test_bechdel_list_details_stream(self):
+        """Both streaming formats return the same rows as the plain listing"""
+        details = get_rest_call(self, 'http://localhost:5000/list_details')
+
+        streamed = get_rest_call(self, 'http://localhost:5000/list_details', params={"stream" : "json"})
+        self.assertEqual(sorted(streamed), sorted(details))
+
+        response = requests.get('http://localhost:5000/list_details', params={"stream" : "ndjson"}, stream=True)
+        self.assertEqual(response.headers['Content-Type'], 'application/x-ndjson')
+        rows = [json.loads(line) for line in response.iter_lines() if line]
+        self.assertEqual(sorted(rows), sorted(details))
+
+    def test_bechdel_etag_not_modified(self):
+        """A client holding the current ETag gets an empty 304 until the movies change"""
+        first = requests.get('http://localhost:5000/list_all_keys')
+        etag = first.headers['ETag']
+        self.assertTrue(first.headers['Last-Modified'])
+
+        again = requests.get('http://localhost:5000/list_all_keys', headers={'If-None-Match': etag})
+        self.assertEqual(again.status_code, 304)
+        self.assertEqual(again.content, b'')
+
+        since = requests.get('http://localhost:5000/list_details', headers={'If-Modified-Since': first.headers['Last-Modified']})
+        self.assertEqual(since.status_code, 304)
+
+        session_k = bechdel.generate_session_key('blorg', 'saltfatacidheat')[0]
+        bechdel.update_movie_rating('1', 'No such title', session_k)
+        unchanged = requests.get('http://localhost:5000/list_all_keys', headers={'If-None-Match': etag})
+        self.assertEqual(unchanged.status_code, 304)
+
+        bechdel.update_movie_rating('1', 'Speedy', session_k)
+
+        changed = requests.get('http://localhost:5000/list_all_keys', headers={'If-None-Match': etag})
+        self.assertEqual(changed.status_code, 200)
+        self.assertNotEqual(changed.headers['ETag'], etag)
+
+    def test_bechdel_prebuilt_bodies(self):
+        """Repeated reads are served from prebuilt bytes until the table version changes"""
+        url = 'http://localhost:5000/show'
+        first = requests.get(url, params={'id': 8892})
+        hits = get_rest_call(self, 'http://localhost:5000/cache_stats')['bodies']['hits']
+        again = requests.get(url, params={'id': 8892})
+        self.assertEqual(again.content, first.content)
+        self.assertEqual(get_rest_call(self, 'http://localhost:5000/cache_stats')['bodies']['hits'], hits + 1)
+
+        session_k = bechdel.generate_session_key('blorg', 'saltfatacidheat')[0]
+        bechdel.update_movie_rating('1', 'Harriet', session_k)
+        changed = requests.get(url, params={'id': 8892})
+        self.assertNotEqual(changed.headers['ETag'], first.headers['ETag'])
+        self.assertEqual(changed.json(), [[8892, 4648786, 1, 'Harriet', 2019]])
+
+    def test_bechdel_compression(self):
+        """
+        Large reads are gzipped once per table version and keep a gzip-specific ETag;
+        small bodies and clients that do not accept gzip get identity responses
+        """
+        url = 'http://localhost:5000/list_details'
+        plain = requests.get(url, headers={'Accept-Encoding': 'identity'})
+        self.assertNotIn('Content-Encoding', plain.headers)
+        self.assertIn('Accept-Encoding', plain.headers['Vary'])
+
+        zipped = requests.get(url, headers={'Accept-Encoding': 'gzip'}, stream=True)
+        raw = zipped.raw.read()
+        self.assertEqual(zipped.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(zipped.headers['ETag'], plain.headers['ETag'][:-1] + '-gzip"')
+        self.assertLess(len(raw), len(plain.content) / 2)
+        self.assertEqual(gzip.decompress(raw), plain.content)
+
+        hits = get_rest_call(self, 'http://localhost:5000/cache_stats')['compressed']['hits']
+        again = requests.get(url, headers={'Accept-Encoding': 'gzip'}, stream=True)
+        self.assertEqual(again.raw.read(), raw)
+        self.assertEqual(get_rest_call(self, 'http://localhost:5000/cache_stats')['compressed']['hits'], hits + 1)
+
+        revalidated = requests.get(url, headers={'Accept-Encoding': 'gzip', 'If-None-Match': zipped.headers['ETag']})
+        self.assertEqual(revalidated.status_code, 304)
+        self.assertEqual(revalidated.headers['ETag'], zipped.headers['ETag'])
+
+        small = requests.get('http://localhost:5000/show', params={'id': 8892}, headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', small.headers)
+
+    def test_bechdel_list_details_fields(self):
+        """fields= returns only the named columns, in order, on every page and in streams"""
+        titles = get_rest_call(self, 'http://localhost:5000/list_details', params={'fields': 'title,year'})
+        self.assertEqual(len(titles), 8363)
+        self.assertIn(['Harriet', 2019], titles)
+
+        response = requests.get('http://localhost:5000/list_details', params={'fields': 'title', 'limit': 2, 'after_id': 8891})
+        self.assertEqual(len(response.json()), 2)
+        self.assertEqual(response.json()[0], ['Harriet'])
+        self.assertIn('fields=title', response.links['next']['url'])
+
+        streamed = requests.get('http://localhost:5000/list_details', params={'fields': 'id,rating', 'stream': 'ndjson'})
+        self.assertIn('[8892,3]', streamed.text.splitlines())
+
+        get_rest_call(self, 'http://localhost:5000/list_details', params={'fields': 'title,passw'}, expected_code=400)
+
+    def test_bechdel_list_formats(self):
+        """The Accept header selects CSV, NDJSON or columnar JSON, each with its own ETag"""
+        url = 'http://localhost:5000/list_details'
+        params = {'fields': 'id,title', 'limit': 3, 'after_id': 8891}
+        default = requests.get(url, params=params)
+
+        csv_response = requests.get(url, params=params, headers={'Accept': 'text/csv'})
+        self.assertTrue(csv_response.headers['Content-Type'].startswith('text/csv'))
+        lines = csv_response.text.splitlines()
+        self.assertEqual(lines[0], 'id,title')
+        self.assertEqual(lines[1], '8892,Harriet')
+
+        ndjson = requests.get(url, params=params, headers={'Accept': 'application/x-ndjson'})
+        self.assertEqual([json.loads(line) for line in ndjson.text.splitlines()], default.json())
+
+        columns = requests.get(url, params=params, headers={'Accept': 'application/vnd.bechdel.columns+json'})
+        self.assertEqual(columns.json(), {'id': [row[0] for row in default.json()], 'title': [row[1] for row in default.json()]})
+
+        etags = {response.headers['ETag'] for response in (default, csv_response, ndjson, columns)}
+        self.assertEqual(len(etags), 4)
+        self.assertIn('Accept', default.headers['Vary'])
+
+        keys = requests.get('http://localhost:5000/list_all_keys', headers={'Accept': 'text/csv'})
+        self.assertEqual(keys.text.splitlines()[0], 'id,imdbid')
+        self.assertEqual(len(keys.text.splitlines()), 8364)
+
     def test_bechdel_show(self):
         """Tests that show() returns details about a specific row"""
         results = get_rest_call(self, 'http://localhost:5000/show', params={"id" : 8892})
 
         self.assertEqual(results, [[8892, 4648786, 3, 'Harriet', 2019]])
+        self.assertEqual(get_rest_call(self, 'http://localhost:5000/show', params={'id': '08892'}), results)
+
+    def test_bechdel_show_bad_id(self):
+        """A missing or non-numeric id is a 400, not a database error"""
+        self.assertEqual(requests.get('http://localhost:5000/show', params={'id': 'abc'}).status_code, 400)
+        self.assertEqual(requests.get('http://localhost:5000/show').status_code, 400)
+
+    def test_bechdel_show_id_out_of_range(self):
+        """An id too big for the id column finds nothing instead of failing"""
+        self.assertEqual(get_rest_call(self, 'http://localhost:5000/show', params={'id': 2 ** 31}), [])
+        self.assertEqual(get_rest_call(self, 'http://localhost:5000/show', params={'id': 99999999999}), [])
 
 
 
@@ -301,4 +457,135 @@ class TestBechdel(unittest.TestCase):
                 result_row = row[2]   
         self.assertEqual(result_row, 1)
 
-
+    #Concurrent sessions
+    def test_bechdel_concurrent_sessions(self):
+        """
+        Eight users log in, write and log out at the same time against the threaded server
+        Results:
+            Every request is authenticated by the session it carries: logging some users
+            out never logs anybody else out, and nobody ever acts on another user's session
+        """
+        users = ['concurrent%d' % n for n in range(8)]
+        for user in users:
+            bechdel.create_user(user, 'pw' + user)
+
+        barrier = threading.Barrier(len(users))
+        errors = []
+
+        def run(n, user):
+            try:
+                client = requests.Session()
+                login = client.post('http://localhost:5000/login', {"username" : user, "passw" : 'pw' + user}).json()
+                self.assertEqual(login[1], 'Login was successful')
+                barrier.wait()
+
+                created = client.post('http://localhost:5000/user', {"title" : "Concurrent %d" % n, "rating" : "2", "year" : "2021"}).json()
+                self.assertEqual(created[3], "Concurrent %d" % n)
+                barrier.wait()
+
+                if n % 2:
+                    client.post('http://localhost:5000/logout')
+                else:
+                    client.post('http://localhost:5000/update_rating', {"title" : "Concurrent %d" % n, "rating" : "3"})
+                barrier.wait()
+
+                late = client.post('http://localhost:5000/user', {"title" : "Late %d" % n, "rating" : "1", "year" : "2021"}).json()
+                self.assertEqual(late is None, n % 2 == 1)
+            except Exception as e:
+                errors.append(e)
+                barrier.abort()
+
+        threads = [threading.Thread(target=run, args=(n, user)) for n, user in enumerate(users)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+        titles = {row[3]: row[2] for row in get_rest_call(self, 'http://localhost:5000/list_details')}
+        for n in range(len(users)):
+            self.assertEqual(titles["Concurrent %d" % n], 2 if n % 2 else 3)
+            self.assertEqual("Late %d" % n in titles, n % 2 == 0)
+
+    def test_bechdel_batch_endpoints(self):
+        """Batch create, re-rate and delete with one session check per request"""
+        session = requests.Session()
+        key = session.post('http://localhost:5000/login', data={'username': 'blorg', 'passw': 'saltfatacidheat'}).json()[0]
+        items = [{'title': 'Batched %d' % n, 'rating': 1, 'year': 2021} for n in range(20)]
+
+        created = session.post('http://localhost:5000/user/batch', json=items).json()
+        self.assertTrue(created['committed'])
+        ids = [result['movie'][0] for result in created['results']]
+        self.assertEqual(get_rest_call(self, 'http://localhost:5000/show', params={'id': ids[-1]})[0][3], 'Batched 19')
+
+        rated = session.post('http://localhost:5000/update_rating/batch', params={'mode': 'partial'},
+                             json=[{'title': 'Batched 0', 'rating': 3}, {'title': 'Batched 1', 'rating': 'x'}]).json()
+        self.assertEqual([result['status'] for result in rated['results']], ['updated', 'invalid'])
+        self.assertEqual(get_rest_call(self, 'http://localhost:5000/show', params={'id': ids[0]})[0][2], 3)
+
+        deleted = session.delete('http://localhost:5000/user/batch', json=[{'title': item['title']} for item in items]).json()
+        self.assertEqual([result['id'] for result in deleted['results']], ids)
+        self.assertEqual(get_rest_call(self, 'http://localhost:5000/show', params={'id': ids[0]}), [])
+
+        self.assertIsNone(requests.post('http://localhost:5000/user/batch', json=items, headers={'X-Session-Key': 'whoami'}).json())
+        self.assertEqual(session.post('http://localhost:5000/user/batch', json={'title': 'x'}).status_code, 400)
+        self.assertEqual(session.post('http://localhost:5000/user/batch', params={'mode': 'some'}, json=items).status_code, 400)
+        self.assertEqual(key, session.cookies['session_key'])
+
+    def test_bechdel_search(self):
+        """Search filters, sorts and pages through Link headers; bad parameters get 400"""
+        url = 'http://localhost:5000/movies/search'
+        self.assertEqual(get_rest_call(self, url, params={'q': 'Harr', 'year_min': 2019, 'year_max': 2019}),
+                         [[8892, 4648786, 3, 'Harriet', 2019]])
+        words = get_rest_call(self, url, params={'q': 'harriet', 'match': 'words', 'fields': 'title'})
+        self.assertIn(['Harriet'], words)
+
+        expected = [list(row) for row in bechdel.exec_get_all(
+            """SELECT title FROM movies WHERE rating <= 1 ORDER BY title, id""")]
+        titles = []
+        next_url = url + '?rating_max=1&sort=title&limit=500&fields=title'
+        while next_url:
+            response = requests.get(next_url)
+            titles.extend(response.json())
+            link = response.links.get('next')
+            next_url = requests.compat.urljoin(response.url, link['url']) if link else None
+        self.assertEqual(titles, expected)
+
+        csv_page = requests.get(url, params={'q': 'Harriet', 'year_min': 2019, 'fields': 'id,title'},
+                                headers={'Accept': 'text/csv'})
+        self.assertEqual(csv_page.text, 'id,title\n8892,Harriet\n')
+        bool_cursor = base64.urlsafe_b64encode(b'[true,true]').decode('ascii')
+        for params in ({'sort': 'passw'}, {'match': 'regex'}, {'after': 'garbage'}, {'year_min': 'new'},
+                       {'sort': 'year', 'after': bool_cursor}):
+            get_rest_call(self, url, params=params, expected_code=400)
+
+    def test_bechdel_metrics(self):
+        """/metrics reports request latency by route, query timings and cache counters as Prometheus text"""
+        requests.get('http://localhost:5000/show', params={'id': 1})
+        response = requests.get('http://localhost:5000/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.headers['Content-Type'].startswith('text/plain; version=0.0.4'))
+        text = response.text
+        self.assertIn('# TYPE bechdel_http_request_duration_seconds histogram', text)
+        self.assertRegex(text, r'bechdel_http_request_duration_seconds_count\{endpoint="/show",method="GET",status="200"\} [1-9]')
+        self.assertRegex(text, r'bechdel_db_query_duration_seconds_count\{query="show_movie"\} [1-9]')
+        self.assertIn('bechdel_db_pool_wait_seconds_count', text)
+        self.assertIn('bechdel_cache_hit_ratio{cache="bodies"}', text)
+
+    def test_bechdel_stats(self):
+        """/stats agrees with the full listing and changes version with the movies"""
+        details = get_rest_call(self, 'http://localhost:5000/list_details')
+        first = requests.get('http://localhost:5000/stats')
+        stats = first.json()
+        self.assertEqual(stats['movies'], len(details))
+        self.assertEqual(stats['ratings']['3'], len([row for row in details if row[2] == 3]))
+        in_2019 = [row for row in details if row[4] == 2019]
+        self.assertEqual(stats['years']['2019']['movies'], len(in_2019))
+        self.assertEqual(stats['years']['2019']['pass_rate'],
+                         round(len([row for row in in_2019 if row[2] == 3]) / len(in_2019), 4))
+
+        session_k = bechdel.generate_session_key('blorg', 'saltfatacidheat')[0]
+        bechdel.update_movie_rating('0', 'Harriet', session_k)
+        changed = requests.get('http://localhost:5000/stats', headers={'If-None-Match': first.headers['ETag']})
+        self.assertEqual(changed.status_code, 200)
+        self.assertEqual(changed.json()['ratings']['0'], stats['ratings']['0'] + 1)
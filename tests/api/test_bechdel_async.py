@@ -0,0 +1,136 @@
+import asyncio
+import signal
+import subprocess
+import sys
+import time
+import unittest
+import aiohttp
+import requests
+import src.db.bechdel_db as bechdel
+
+PORT = 5059
+URL = 'http://127.0.0.1:%d' % PORT
+SYNC_URL = 'http://localhost:5000'
+
+class TestBechdelAsync(unittest.TestCase):
+    """Runs the asyncio server next to the Flask dev server and compares them"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = subprocess.Popen([sys.executable, 'src/server_async.py', '--port', str(PORT)],
+                                      stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        deadline = time.monotonic() + 15
+        while True:
+            try:
+                requests.get(URL + '/show', params={'id': 0}, timeout=1)
+                break
+            except requests.ConnectionError:
+                if time.monotonic() > deadline or cls.server.poll() is not None:
+                    raise RuntimeError('async server did not start')
+                time.sleep(0.2)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.send_signal(signal.SIGINT)
+        cls.server.wait(10)
+
+    def setUp(self):
+        bechdel.build_movie_table()
+
+    def test_async_reads_match_sync(self):
+        """Every read endpoint answers exactly as the Flask server does"""
+        for path, params in [('/list_all_keys', {}), ('/list_details', {}), ('/show', {'id': 7}), ('/stats', {}),
+                             ('/show', {'id': 99999999999}),
+                             ('/list_details', {'limit': 5, 'after_id': 10}),
+                             ('/list_details', {'stream': 'ndjson'}),
+                             ('/list_details', {'fields': 'title,id', 'limit': 5}),
+                             ('/list_details', {'fields': 'year', 'accept': 'text/csv'}),
+                             ('/movies/search', {'q': 'the', 'sort': '-year', 'limit': 20, 'fields': 'title'})]:
+            # The Flask app compresses, which changes its ETag; compare uncompressed copies
+            headers = {'Accept': params.pop('accept', '*/*')}
+            expected = requests.get(SYNC_URL + path, params=params, headers=dict(headers, **{'Accept-Encoding': 'identity'}))
+            actual = requests.get(URL + path, params=params, headers=headers)
+            self.assertEqual(actual.status_code, 200, path)
+            self.assertEqual(actual.headers['ETag'], expected.headers['ETag'], path)
+            self.assertEqual(actual.headers['Content-Type'], expected.headers['Content-Type'], path)
+            if params.get('stream') or headers['Accept'] != '*/*':
+                self.assertEqual(actual.text, expected.text, path)
+            else:
+                self.assertEqual(actual.json(), expected.json(), path)
+        link = requests.get(URL + '/list_details', params={'limit': 5}).headers['Link']
+        self.assertEqual(link, '</list_details?limit=5&after_id=5>; rel="next"')
+
+    def test_async_validation(self):
+        """Bad input gets the same 400 answers, and current copies get 304"""
+        for path, params in [('/list_details', {'limit': 'x'}), ('/list_details', {'limit': 0}),
+                             ('/list_details', {'stream': 'xml'}), ('/show', {'id': 'abc'}), ('/show', {})]:
+            expected = requests.get(SYNC_URL + path, params=params)
+            actual = requests.get(URL + path, params=params)
+            self.assertEqual(actual.status_code, 400)
+            self.assertEqual(actual.json(), expected.json())
+        self.assertEqual(requests.post(URL + '/login', data={'username': 'blorg'}).status_code, 400)
+
+        etag = requests.get(URL + '/list_all_keys').headers['ETag']
+        response = requests.get(URL + '/list_all_keys', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+
+    def test_async_session_flow(self):
+        """Log in, write through every write endpoint and log out using the session cookie"""
+        session = requests.Session()
+        key, message = session.post(URL + '/login', data={'username': 'blorg', 'passw': 'saltfatacidheat'}).json()
+        self.assertEqual(message, 'Login was successful')
+        self.assertEqual(session.cookies['session_key'], key)
+
+        movie = session.post(URL + '/user', data={'title': 'Async', 'rating': 2, 'year': 2020}).json()
+        self.assertEqual(movie[2:], [2, 'Async', 2020])
+        version = bechdel.movies_version()
+        session.post(URL + '/update_rating', data={'title': 'No such title', 'rating': 3})
+        self.assertEqual(bechdel.movies_version(), version)
+        session.post(URL + '/update_rating', data={'title': 'Async', 'rating': 3})
+        self.assertEqual(requests.get(SYNC_URL + '/show', params={'id': movie[0]}).json()[0][2], 3)
+        session.delete(URL + '/user', params={'title': 'Async'})
+        self.assertEqual(requests.get(SYNC_URL + '/show', params={'id': movie[0]}).json(), [])
+
+        session.post(URL + '/logout')
+        self.assertNotIn('session_key', session.cookies)
+        denied = requests.post(URL + '/user', data={'title': 'Async', 'rating': 2, 'year': 2020},
+                               headers={'X-Session-Key': key})
+        self.assertIsNone(denied.json())
+
+    def test_async_many_keepalive_clients(self):
+        """Hundreds of open keep-alive connections are served by one process and a small pool"""
+        clients = 300
+
+        async def run():
+            connector = aiohttp.TCPConnector(limit=0)
+            async with aiohttp.ClientSession(connector=connector) as client:
+                async def get(n):
+                    async with client.get(URL + '/show', params={'id': n % 50 + 1}) as response:
+                        return response.status
+                first = await asyncio.gather(*(get(n) for n in range(clients)))
+                # The same connections are reused for a second round
+                second = await asyncio.gather(*(get(n) for n in range(clients)))
+                return first + second
+
+        statuses = asyncio.run(run())
+        self.assertEqual(statuses, [200] * clients * 2)
+
+    def test_async_batch(self):
+        """Batch writes give the same per-item reports as the Flask server"""
+        key = requests.post(URL + '/login', data={'username': 'blorg', 'passw': 'saltfatacidheat'}).json()[0]
+        headers = {'X-Session-Key': key}
+        items = [{'title': 'Async batch', 'rating': 1, 'year': 2020}, {'title': 'Broken', 'rating': 1, 'year': 10 ** 10}]
+
+        report = requests.post(URL + '/user/batch', json=items, headers=headers).json()
+        self.assertEqual(report, {'committed': False, 'results': [{'status': 'not_applied'},
+                                                                 {'status': 'failed', 'error': 'integer out of range'}]})
+        report = requests.post(URL + '/user/batch', params={'mode': 'partial'}, json=items, headers=headers).json()
+        self.assertTrue(report['committed'])
+        movie_id = report['results'][0]['movie'][0]
+
+        rated = requests.post(URL + '/update_rating/batch', json=[{'title': 'Async batch', 'rating': 3}], headers=headers).json()
+        self.assertEqual(rated['results'], [{'status': 'updated', 'ids': [movie_id]}])
+        self.assertEqual(requests.get(SYNC_URL + '/show', params={'id': movie_id}).json()[0][2], 3)
+        deleted = requests.delete(URL + '/user/batch', json=[{'title': 'Async batch'}], headers=headers).json()
+        self.assertEqual(deleted['results'], [{'status': 'deleted', 'id': movie_id}])
+        self.assertEqual(requests.post(URL + '/user/batch', data='nope', headers=headers).status_code, 400)
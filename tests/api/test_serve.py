@@ -0,0 +1,141 @@
+import os
+import pstats
+import tempfile
+import signal
+import subprocess
+import sys
+import time
+import unittest
+import requests
+from concurrent.futures import ThreadPoolExecutor
+import src.db.bechdel_db as bechdel
+
+PORT = 5057
+URL = 'http://127.0.0.1:%d' % PORT
+
+def start_launcher(test, workers=2, environ=None):
+    """Starts src/serve.py on PORT and waits until it answers; the test's cleanup kills it"""
+    launcher = subprocess.Popen([sys.executable, 'src/serve.py', '--bind', '127.0.0.1:%d' % PORT,
+                                 '--workers', str(workers), '--threads', '4', '--graceful-timeout', '5'],
+                                stderr=subprocess.DEVNULL, start_new_session=True,
+                                env=dict(os.environ, **(environ or {})))
+    test.addCleanup(stop_launcher, launcher)
+    deadline = time.monotonic() + 15
+    while True:
+        try:
+            requests.get(URL + '/list_all_keys', timeout=1)
+            return launcher
+        except requests.ConnectionError:
+            if time.monotonic() > deadline or launcher.poll() is not None:
+                test.fail('launcher did not start')
+            time.sleep(0.2)
+
+def stop_launcher(launcher):
+    # The launcher leads its own process group, so this also reaches any workers left behind
+    try:
+        os.killpg(launcher.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    launcher.wait()
+
+class TestServe(unittest.TestCase):
+    """Runs the production launcher with two workers next to the dev server"""
+
+    def setUp(self):
+        bechdel.build_movie_table()
+        self.launcher = start_launcher(self)
+
+    def workers(self):
+        with open('/proc/%d/task/%d/children' % (self.launcher.pid, self.launcher.pid)) as file:
+            return [int(pid) for pid in file.read().split()]
+
+    def test_serve_concurrent_requests(self):
+        """Requests are spread over the workers' threads and all succeed"""
+        self.assertEqual(len(self.workers()), 2)
+        with ThreadPoolExecutor(16) as executor:
+            responses = list(executor.map(lambda n: requests.get(URL + '/show', params={'id': 1}), range(64)))
+        self.assertTrue(all(response.status_code == 200 for response in responses))
+        self.assertEqual(responses[0].json(), responses[-1].json())
+        self.assertEqual(len(responses[0].json()), 1)
+
+    def test_serve_replaces_dead_worker(self):
+        """A worker that dies is replaced and the API keeps answering meanwhile"""
+        victim = self.workers()[0]
+        os.kill(victim, signal.SIGKILL)
+        self.assertEqual(200, requests.get(URL + '/list_all_keys').status_code)
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            workers = self.workers()
+            if len(workers) == 2 and victim not in workers:
+                break
+            time.sleep(0.2)
+        self.assertEqual(len(workers), 2)
+        self.assertNotIn(victim, workers)
+
+    def test_serve_graceful_shutdown(self):
+        """SIGTERM stops every worker and the launcher exits cleanly"""
+        workers = self.workers()
+        self.launcher.send_signal(signal.SIGTERM)
+        self.assertEqual(self.launcher.wait(15), 0)
+        for pid in workers:
+            with self.assertRaises(ProcessLookupError):
+                os.kill(pid, 0)
+
+
+class TestServeAdmin(unittest.TestCase):
+    """The /admin endpoints, on a single worker whose settings name blorg as an admin"""
+
+    def setUp(self):
+        bechdel.build_movie_table()
+        bechdel.create_user('notadmin', 'pw')
+        self.profiles = tempfile.TemporaryDirectory()
+        self.addCleanup(self.profiles.cleanup)
+        start_launcher(self, workers=1, environ={'BECHDEL_ADMIN_USERS': 'blorg', 'BECHDEL_SLOW_QUERY_MS': '0.001',
+                                                 'BECHDEL_SLOW_QUERY_EXPLAIN_SAMPLE': '0',
+                                                 'BECHDEL_PROFILE_DIR': self.profiles.name, 'BECHDEL_PROFILE_KEEP': '2'})
+
+    def login(self, username, password):
+        session = requests.Session()
+        session.post(URL + '/login', data={'username': username, 'passw': password})
+        return session
+
+    def test_slow_queries_admin_only(self):
+        """Anonymous callers get 401, other users 403 and admins the log with redacted parameters"""
+        self.assertEqual(401, requests.get(URL + '/admin/slow_queries').status_code)
+        self.assertEqual(403, self.login('notadmin', 'pw').get(URL + '/admin/slow_queries').status_code)
+
+        admin = self.login('blorg', 'saltfatacidheat')
+        admin.get(URL + '/show', params={'id': 4648})
+        response = admin.get(URL + '/admin/slow_queries')
+        self.assertEqual(200, response.status_code)
+        entries = response.json()['entries']
+        shown = [entry for entry in entries if entry['query'] == 'show_movie']
+        self.assertEqual(shown[0]['sql'], 'SELECT * FROM movies WHERE id = %s')
+        self.assertEqual(shown[0]['params'], ['<int>'])
+        self.assertNotIn('saltfatacidheat', response.text)
+
+        self.assertEqual([], admin.delete(URL + '/admin/slow_queries').json()['entries'])
+
+    def test_profile_request(self):
+        """An admin's X-Profile request is profiled end to end and the profile downloads in the pstats format"""
+        self.assertNotIn('X-Profile-Id', self.login('notadmin', 'pw').get(URL + '/show', params={'id': 1},
+                                                                          headers={'X-Profile': '1'}).headers)
+        admin = self.login('blorg', 'saltfatacidheat')
+        ids = [admin.get(URL + '/show', params={'id': movie_id}, headers={'X-Profile': '1'}).headers['X-Profile-Id']
+               for movie_id in (4646, 4647, 4648)]
+        listed = admin.get(URL + '/admin/profiles').json()['profiles']
+        self.assertEqual([profile['id'] for profile in listed], ids[:0:-1])
+        self.assertEqual((listed[0]['path'], listed[0]['status']), ('/show', 200))
+
+        self.assertEqual(404, admin.get(URL + '/admin/profiles/' + ids[0]).status_code)
+        download = admin.get(URL + '/admin/profiles/' + ids[-1])
+        self.assertEqual(200, download.status_code)
+        path = os.path.join(self.profiles.name, 'download.prof')
+        with open(path, 'wb') as file:
+            file.write(download.content)
+        functions = {function for _, _, function in pstats.Stats(path).stats}
+        self.assertIn('dispatch_request', functions)
+        self.assertIn('show', functions)
+        self.assertIn('execute_prepared', functions)
+        self.assertIn('encode_rows', functions)
+        self.assertEqual(403, self.login('notadmin', 'pw').get(URL + '/admin/profiles').status_code)
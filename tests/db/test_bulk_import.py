@@ -0,0 +1,90 @@
+import csv
+import io
+import json
+import os
+import tempfile
+import unittest
+from src.db import bechdel_db
+from src.db.bulk_import import iter_json_array, iter_records, detect_format, main
+from src.db.swen344_db_utils import exec_get_all
+from tests.test_utils import *
+
+MOVIES = [
+    {'id': 1, 'imdbid': '0000001', 'rating': 3, 'title': 'A "quoted", comma title', 'year': 1999},
+    {'id': 2, 'imdbid': '0000002', 'rating': 0, 'title': 'Second [bracketed] {braced}', 'year': 2000},
+    {'id': 3, 'imdbid': '0000003', 'rating': 2, 'title': 'Third\nwith a newline', 'year': 2001},
+]
+
+class TestBulkImport(unittest.TestCase):
+
+    def test_json_array_across_read_boundaries(self):
+        """The streaming JSON parser yields the same elements whatever the read size"""
+        document = json.dumps(MOVIES, indent=2)
+        for read_size in (1, 7, 64, 100000):
+            self.assertEqual(list(iter_json_array(io.StringIO(document), read_size)), MOVIES)
+
+    def test_json_array_rejects_other_documents(self):
+        """Only a top-level array can be streamed"""
+        with self.assertRaises(ValueError):
+            list(iter_json_array(io.StringIO('{"id": 1}')))
+        with self.assertRaises(ValueError):
+            list(iter_json_array(io.StringIO('[{"id": 1}, ')))
+
+    def test_detect_format(self):
+        """The format of a dump is guessed from its extension"""
+        self.assertEqual(detect_format('dump.ndjson'), 'ndjson')
+        self.assertEqual(detect_format('dump.CSV'), 'csv')
+        self.assertEqual(detect_format('bechdel_test_movies.json'), 'json')
+
+    def test_seed_import_reports_rate(self):
+        """build_movie_table loads the seed through COPY and leaves the sequences past it"""
+        bechdel_db.rebuild_tables()
+        with open('src/db/bechdel_test_movies.json', 'r') as json_file:
+            stats = bechdel_db.import_movies(iter_json_array(json_file), chunk_rows=1000)
+        self.assertEqual(stats.rows, 8363)
+        self.assertEqual(stats.chunks, 9)
+        self.assertGreater(stats.rows_per_second, 0)
+        assert_sql_count(self, "SELECT * FROM movies", 8363)
+
+    def test_ndjson_and_csv_round_trip(self):
+        """NDJSON and CSV dumps load the same rows, awkward titles included"""
+        ndjson = ''.join(json.dumps(movie) + '\n' for movie in MOVIES)
+        csv_text = io.StringIO()
+        writer = csv.DictWriter(csv_text, fieldnames=['id', 'imdbid', 'rating', 'title', 'year'])
+        writer.writeheader()
+        writer.writerows(MOVIES)
+
+        expected = [(m['id'], int(m['imdbid']), m['rating'], m['title'], m['year']) for m in MOVIES]
+        for fmt, text in (('ndjson', ndjson), ('csv', csv_text.getvalue())):
+            bechdel_db.rebuild_tables()
+            bechdel_db.import_movies(iter_records(io.StringIO(text, newline=''), fmt), chunk_rows=2)
+            self.assertEqual(exec_get_all("SELECT * FROM movies ORDER BY id"), expected)
+
+    def test_upsert(self):
+        """Upsert mode updates existing ids and inserts new ones instead of failing"""
+        bechdel_db.rebuild_tables()
+        bechdel_db.import_movies(MOVIES[:2])
+        changed = [dict(MOVIES[1], rating=3), MOVIES[2]]
+        stats = bechdel_db.import_movies(changed, upsert=True)
+
+        self.assertEqual(stats.rows, 2)
+        self.assertEqual(exec_get_all("SELECT id, rating FROM movies ORDER BY id"), [(1, 3), (2, 3), (3, 2)])
+
+    def test_upsert_repeated_id_keeps_last_record(self):
+        """When a file repeats an id the last record wins, within a chunk as well as across chunks"""
+        bechdel_db.rebuild_tables()
+        repeated = [dict(MOVIES[0], rating=n % 4) for n in range(199)] + [dict(MOVIES[0], rating=2)]
+        for chunk_rows in (1000, 7):
+            bechdel_db.import_movies(repeated, upsert=True, chunk_rows=chunk_rows)
+            self.assertEqual(exec_get_all("SELECT id, rating FROM movies"), [(1, 2)])
+
+    def test_cli(self):
+        """The command line entry point imports a file"""
+        bechdel_db.rebuild_tables()
+        with tempfile.NamedTemporaryFile('w', suffix='.ndjson', delete=False) as dump:
+            dump.write(''.join(json.dumps(movie) + '\n' for movie in MOVIES))
+        try:
+            main([dump.name])
+        finally:
+            os.unlink(dump.name)
+        assert_sql_count(self, "SELECT * FROM movies", 3)
@@ -0,0 +1,171 @@
+import json
+import os
+import time
+import unittest
+from src.db import config
+from src.db.swen344_db_utils import exec_commit
+from src.db import bechdel_db
+from src.db.cache import LRUCache, MISSING
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_evicts_least_recently_used(self):
+        """A full cache drops the entry that was used longest ago"""
+        cache = LRUCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertIs(cache.get('b'), MISSING)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_entries_expire(self):
+        """Entries older than the ttl are treated as misses"""
+        clock = FakeClock()
+        cache = LRUCache(maxsize=10, ttl=5, clock=clock)
+        cache.set('a', 1)
+        clock.now = 4
+        self.assertEqual(cache.get('a'), 1)
+        clock.now = 6
+        self.assertIs(cache.get('a'), MISSING)
+        self.assertEqual(cache.stats()['expirations'], 1)
+
+    def test_caches_empty_results(self):
+        """An empty result (e.g. show() of a missing id) is cached like any other"""
+        cache = LRUCache()
+        calls = []
+        loader = lambda: calls.append(1) or []
+        self.assertEqual(cache.get_or_load('missing', loader), [])
+        self.assertEqual(cache.get_or_load('missing', loader), [])
+        self.assertEqual(len(calls), 1)
+
+    def test_stale_load_is_not_stored(self):
+        """A value read before an invalidation is not cached after it"""
+        cache = LRUCache()
+        def loader():
+            cache.invalidate('a')
+            return 'old'
+        self.assertEqual(cache.get_or_load('a', loader), 'old')
+        self.assertIs(cache.get('a'), MISSING)
+
+    def test_counters(self):
+        """Hits and misses are counted for tuning"""
+        cache = LRUCache()
+        cache.get('a')
+        cache.set('a', 1)
+        cache.get('a')
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['hit_ratio']), (1, 1, 0.5))
+
+    def test_zero_size_disables(self):
+        """maxsize=0 turns the cache into a pass-through"""
+        cache = LRUCache(maxsize=0)
+        cache.set('a', 1)
+        self.assertIs(cache.get('a'), MISSING)
+
+class TestMovieCache(unittest.TestCase):
+
+    def setUp(self):
+        os.environ['BECHDEL_CACHE_ENABLED'] = '1'
+        config.reload()
+        bechdel_db.rebuild_tables()
+        bechdel_db.build_movie_table()
+        self.session_k = bechdel_db.generate_session_key('blorg', 'saltfatacidheat')[0]
+        self.assertTrue(bechdel_db.start_cache_listener().healthy.wait(5))
+
+    def tearDown(self):
+        bechdel_db.stop_cache_listener()
+        del os.environ['BECHDEL_CACHE_ENABLED']
+        config.reload()
+
+    def wait_for(self, condition, timeout=5):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > deadline:
+                self.fail('condition not met within %ss' % timeout)
+            time.sleep(0.01)
+
+    def test_reads_are_cached(self):
+        """Repeated reads are served from the cache"""
+        bechdel_db.show('8892')
+        bechdel_db.show('8892')
+        bechdel_db.list_all_keys()
+        bechdel_db.list_all_keys()
+        stats = bechdel_db.cache_stats()
+        self.assertEqual(stats['show']['hits'], 1)
+        self.assertEqual(stats['lists']['hits'], 1)
+
+    def test_update_invalidates(self):
+        """update_movie_rating drops the cached row and listings for the movie"""
+        self.assertEqual(bechdel_db.show('8892'), [(8892, 4648786, 3, 'Harriet', 2019)])
+        bechdel_db.list_details()
+        bechdel_db.update_movie_rating('1', 'Harriet', self.session_k)
+        self.assertEqual(bechdel_db.show('8892'), [(8892, 4648786, 1, 'Harriet', 2019)])
+        self.assertIn((8892, 4648786, 1, 'Harriet', 2019), bechdel_db.list_details())
+
+    def test_every_spelling_of_an_id_is_invalidated(self):
+        """'08892', '+8892' and ' 8892' share the cache entry of 8892, so an update drops them all"""
+        for spelling in ('8892', '08892', '+8892', ' 8892'):
+            self.assertEqual(bechdel_db.show(spelling), [(8892, 4648786, 3, 'Harriet', 2019)])
+        self.assertEqual(bechdel_db.cache_stats()['show']['hits'], 3)
+        bechdel_db.update_movie_rating('0', 'Harriet', self.session_k)
+        for spelling in ('8892', '08892', '+8892', ' 8892'):
+            self.assertEqual(bechdel_db.show(spelling), [(8892, 4648786, 0, 'Harriet', 2019)])
+
+    def test_create_and_delete_invalidate(self):
+        """create and delete are visible through the cached listings right away"""
+        before = len(bechdel_db.list_all_keys())
+        bechdel_db.create(3, 'A cached movie', '2021', self.session_k)
+        self.assertEqual(len(bechdel_db.list_all_keys()), before + 1)
+        bechdel_db.delete('A cached movie', self.session_k)
+        self.assertEqual(len(bechdel_db.list_all_keys()), before)
+
+    def test_other_worker_change_invalidates(self):
+        """A change announced by another worker over NOTIFY drops the cached row"""
+        self.assertEqual(bechdel_db.show('8892'), [(8892, 4648786, 3, 'Harriet', 2019)])
+        exec_commit("UPDATE movies SET rating = 1 WHERE id = 8892")
+        exec_commit("SELECT pg_notify('movies_changed', %s)", (json.dumps({'origin': 'another worker', 'ids': [8892]}),))
+        self.wait_for(lambda: bechdel_db.show('8892') == [(8892, 4648786, 1, 'Harriet', 2019)])
+
+    def test_reads_bypass_cache_without_listener(self):
+        """Without the listener nothing is cached, so other workers' writes are never missed"""
+        bechdel_db.stop_cache_listener()
+        bechdel_db.show('8892')
+        bechdel_db.show('8892')
+        self.assertEqual(bechdel_db.cache_stats()['show']['hits'], 0)
+
+    def test_session_validation_cached(self):
+        """A key issued by this worker validates without another database lookup"""
+        self.assertTrue(bechdel_db.validate_session_key(self.session_k))
+        self.assertTrue(bechdel_db.validate_session_key(self.session_k))
+        self.assertEqual(bechdel_db.cache_stats()['sessions']['hits'], 2)
+        self.assertFalse(bechdel_db.validate_session_key('whoami'))
+        self.assertFalse(bechdel_db.validate_session_key('None'))
+
+    def test_logout_evicts_session(self):
+        """A logged out key stops validating immediately"""
+        self.assertTrue(bechdel_db.validate_session_key(self.session_k))
+        bechdel_db.logout(self.session_k)
+        self.assertFalse(bechdel_db.validate_session_key(self.session_k))
+
+    def test_login_again_revokes_previous_key(self):
+        """Logging in again replaces the cached previous key"""
+        new_session_k = bechdel_db.generate_session_key('blorg', 'saltfatacidheat')[0]
+        self.assertFalse(bechdel_db.validate_session_key(self.session_k))
+        self.assertTrue(bechdel_db.validate_session_key(new_session_k))
+
+    def test_other_worker_logout_evicts_session(self):
+        """A logout announced by another worker over NOTIFY evicts the cached key"""
+        self.assertTrue(bechdel_db.validate_session_key(self.session_k))
+        exec_commit("UPDATE system_users SET session_key = 'None' WHERE username = 'blorg'")
+        digest = bechdel_db.session_digest(self.session_k)
+        exec_commit("SELECT pg_notify('sessions_revoked', %s)", (json.dumps({'origin': 'another worker', 'digests': [digest]}),))
+        self.wait_for(lambda: not bechdel_db.validate_session_key(self.session_k))
@@ -0,0 +1,71 @@
+import os
+import tempfile
+import unittest
+from src.db import config
+
+class TestConfig(unittest.TestCase):
+
+    def setUp(self):
+        self.yml = tempfile.NamedTemporaryFile('w', suffix='.yml', delete=False)
+        self.yml.write('host: filehost\ndatabase: filedb\nuser: fileuser\npassword: filepw\nport: 5432\n')
+        self.yml.close()
+
+    def tearDown(self):
+        os.unlink(self.yml.name)
+
+    def test_load_settings_from_file(self):
+        """Values come from the yml file with defaults for anything it leaves out"""
+        settings = config.load_settings(self.yml.name, environ={})
+        self.assertEqual(settings.host, 'filehost')
+        self.assertEqual(settings.port, 5432)
+        self.assertEqual(settings.pool_max, 10)
+
+    def test_environment_overrides_file(self):
+        """BECHDEL_<FIELD> variables win over the file and are converted to the field type"""
+        settings = config.load_settings(self.yml.name, environ={'BECHDEL_HOST': 'envhost', 'BECHDEL_POOL_MAX': '3'})
+        self.assertEqual(settings.host, 'envhost')
+        self.assertEqual(settings.pool_max, 3)
+
+    def test_environment_without_file(self):
+        """Containers can configure everything through the environment"""
+        environ = {'BECHDEL_HOST': 'h', 'BECHDEL_DATABASE': 'd', 'BECHDEL_USER': 'u', 'BECHDEL_PASSWORD': 'p'}
+        settings = config.load_settings('/nonexistent/db.yml', environ=environ)
+        self.assertEqual(settings.database, 'd')
+        with self.assertRaises(ValueError):
+            config.load_settings('/nonexistent/db.yml', environ={})
+
+    def test_admin_users(self):
+        """admin_users may be a comma separated string or a YAML list"""
+        settings = config.load_settings(self.yml.name, environ={'BECHDEL_ADMIN_USERS': 'blorg, alice'})
+        self.assertEqual(settings.admins, {'blorg', 'alice'})
+        with open(self.yml.name, 'a') as yml:
+            yml.write('admin_users: [blorg]\n')
+        self.assertEqual(config.load_settings(self.yml.name, environ={}).admins, {'blorg'})
+        self.assertEqual(config.load_settings('/nonexistent/db.yml', environ={
+            'BECHDEL_HOST': 'h', 'BECHDEL_DATABASE': 'd', 'BECHDEL_USER': 'u', 'BECHDEL_PASSWORD': 'p'}).admins, set())
+
+    def test_token_mode_needs_a_secret(self):
+        """auth_mode token is refused at startup without a token_secret to sign with"""
+        with self.assertRaises(ValueError):
+            config.load_settings(self.yml.name, environ={'BECHDEL_AUTH_MODE': 'token'})
+        with self.assertRaises(ValueError):
+            config.load_settings(self.yml.name, environ={'BECHDEL_AUTH_MODE': 'token', 'BECHDEL_TOKEN_SECRET': ''})
+        settings = config.load_settings(self.yml.name, environ={'BECHDEL_AUTH_MODE': 'token', 'BECHDEL_TOKEN_SECRET': 's'})
+        self.assertEqual(settings.token_secret, 's')
+
+    def test_settings_are_immutable(self):
+        """Settings cannot be changed in place, only replaced by reload()"""
+        settings = config.load_settings(self.yml.name, environ={})
+        with self.assertRaises(Exception):
+            settings.host = 'elsewhere'
+
+    def test_reload_notifies_callbacks(self):
+        """reload() swaps the cached settings and tells registered callbacks"""
+        seen = []
+        config.on_reload(seen.append)
+        try:
+            new_settings = config.reload()
+        finally:
+            config._reload_callbacks.remove(seen.append)
+        self.assertEqual(seen, [new_settings])
+        self.assertIs(config.get_settings(), new_settings)
@@ -1,5 +1,7 @@
+import threading
 import unittest
 from src.db.bechdel_db import *
+from src.db.migrate import applied_migrations, available_migrations
 from src.db.swen344_db_utils import connect
 from tests.test_utils import *
 
@@ -16,6 +18,61 @@ class TestDBSchema(unittest.TestCase):
         rebuild_tables()
         assert_sql_count(self, "SELECT * FROM movies", 0)
 
+    def test_rebuild_applies_all_migrations(self):
+        """A rebuilt database has every migration recorded and nothing left to apply"""
+        rebuild_tables()
+        applied = [row[0] for row in applied_migrations()]
+        self.assertEqual(applied, [migration[0] for migration in available_migrations()])
+        self.assertEqual(migrate(), [])
+
+    def test_lookup_indexes_exist(self):
+        """title and session_key lookups are backed by indexes"""
+        rebuild_tables()
+        indexes = [row[0] for row in exec_get_all("""SELECT indexname FROM pg_indexes
+                                                      WHERE tablename IN ('movies', 'system_users')""")]
+        self.assertIn('movies_title_idx', indexes)
+        self.assertIn('system_users_session_key_idx', indexes)
+
+    def test_migrate_live_database(self):
+        """A pending migration is applied to a populated database without losing rows"""
+        rebuild_tables()
+        build_movie_table()
+        exec_commit("""DROP INDEX movies_title_idx""")
+        exec_commit("""DELETE FROM schema_migrations WHERE version = 2""")
+
+        self.assertEqual(migrate(), [(2, 'lookup_indexes')])
+        assert_sql_count(self, """SELECT * FROM pg_indexes WHERE indexname = 'movies_title_idx'""", 1)
+        assert_sql_count(self, "SELECT * FROM movies", 8363)
+
+    def test_migrate_old_schema(self):
+        """A database built from the schema.sql that predates the migrations can still create movies after migrating"""
+        rebuild_tables()
+        exec_sql_file('src/db/schema.sql')
+        exec_commit("""CREATE TABLE movies(
+                         id      INTEGER PRIMARY KEY,
+                         imdbid  INTEGER NOT NULL,
+                         rating  INTEGER NOT NULL,
+                         title   TEXT NOT NULL,
+                         year    INTEGER NOT NULL
+                       )""")
+        exec_commit("""CREATE TABLE system_users(
+                         username    TEXT NOT NULL PRIMARY KEY,
+                         passw       VARCHAR(550) NOT NULL,
+                         session_key TEXT
+                       )""")
+        exec_commit("""INSERT INTO movies VALUES (8892, 4648786, 3, 'Harriet', 2019), (12, 40, 1, 'Old', 1990)""")
+        exec_commit("""INSERT INTO system_users VALUES ('blorg', %s, NULL)""",
+                    (hashlib.sha512(b'saltfatacidheat').hexdigest(),))
+
+        self.assertEqual([migration[0] for migration in migrate()],
+                         [migration[0] for migration in available_migrations()])
+        self.assertEqual(migrate(), [])
+        session_k = generate_session_key('blorg', 'saltfatacidheat')[0]
+        new_movie = create(2, 'Adopted', 2020, session_k)
+        self.assertEqual(new_movie[0], 8893)
+        self.assertEqual(new_movie[1], 4648787)
+        assert_sql_count(self, "SELECT * FROM movie_stats WHERE year = 2020", 1)
+
     def test_seed_data_works(self):
         """Attempt to insert the seed data"""
         rebuild_tables()
@@ -66,6 +123,36 @@ class TestDBSchema(unittest.TestCase):
 
         self.assertEqual(result_row, (8892, 4648786, 3, 'Harriet', 2019), "Entry does not exist")
     
+    def test_list_details_keyset_pages(self):
+        """Walking list_details one page at a time visits every movie exactly once, in id order"""
+        rebuild_tables()
+        build_movie_table()
+
+        seen = []
+        after_id = None
+        while True:
+            page = list_details(1000, after_id)
+            if len(page) == 0:
+                break
+            self.assertLessEqual(len(page), 1000)
+            seen.extend(row[0] for row in page)
+            after_id = page[-1][0]
+
+        self.assertEqual(len(seen), 8363)
+        self.assertEqual(seen, sorted(set(seen)))
+
+    def test_iter_details_batches(self):
+        """iter_details streams the whole table in batches no bigger than batch_size"""
+        rebuild_tables()
+        build_movie_table()
+
+        batches = list(iter_details(batch_size=500))
+        self.assertTrue(all(len(batch) <= 500 for batch in batches))
+        self.assertEqual(sum(len(batch) for batch in batches), 8363)
+
+        after_harriet = next(iter_details(after_id=8892, batch_size=10))
+        self.assertTrue(all(row[0] > 8892 for row in after_harriet))
+
     def test_show(self):
         """Tests that show() returns details about a specific row"""
         rebuild_tables()
@@ -161,6 +248,33 @@ class TestDBSchema(unittest.TestCase):
         results = exec_get_all("""SELECT COUNT(*) FROM movies WHERE title = 'A really really cool new movie'""")
         self.assertEqual(results, [(0,)])
 
+    def test_create_allocates_ids_in_database(self):
+        """create() takes id and imdbid from the sequences, past the seeded rows, and returns the new row"""
+        rebuild_tables()
+        build_movie_table()
+        session_k = generate_session_key('blorg', 'saltfatacidheat')[0]
+        highest = exec_get_one("""SELECT max(id), max(imdbid) FROM movies""")
+
+        new_movie = create(3, 'A sequenced movie', '2021', session_k)
+        self.assertEqual(new_movie, (highest[0] + 1, highest[1] + 1, 3, 'A sequenced movie', 2021))
+
+    def test_concurrent_creates_get_unique_ids(self):
+        """Movies created at the same time never share an id or imdbid"""
+        rebuild_tables()
+        build_movie_table()
+        session_k = generate_session_key('blorg', 'saltfatacidheat')[0]
+
+        results = []
+        threads = [threading.Thread(target=lambda n=n: results.append(create(2, 'Concurrent %d' % n, '2021', session_k)))
+                   for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len({movie[0] for movie in results}), 8)
+        self.assertEqual(len({movie[1] for movie in results}), 8)
+
     def test_update_movie_rating(self):
         """Attempts to update the movie rating"""
         rebuild_tables()
@@ -195,4 +309,178 @@ class TestDBSchema(unittest.TestCase):
         """Logout and verify that session key is gone"""
         logout(session_k)
         results = exec_get_all("""SELECT session_key FROM system_users WHERE username = 'blorg'""")
-        self.assertEqual(results, [('None',)])
\ No newline at end of file
+        self.assertEqual(results, [('None',)])
+
+    def test_create_batch(self):
+        """A batch of movies is created in one transaction, results in item order"""
+        rebuild_tables()
+        build_movie_table()
+        session_k = generate_session_key('blorg', 'saltfatacidheat')[0]
+        self.assertIsNone(create_batch([{'title': 'Batch', 'rating': 1, 'year': 2020}], 'whoami'))
+
+        items = [{'title': 'Batch %d' % n, 'rating': n % 4, 'year': 2000 + n} for n in range(50)]
+        report = create_batch(items, session_k)
+        self.assertTrue(report['committed'])
+        movies = [result['movie'] for result in report['results']]
+        self.assertEqual([movie[2:] for movie in movies], [[n % 4, 'Batch %d' % n, 2000 + n] for n in range(50)])
+        self.assertEqual([movie[0] for movie in movies], sorted(movie[0] for movie in movies))
+        assert_sql_count(self, "SELECT * FROM movies WHERE title LIKE 'Batch %'", 50)
+
+    def test_batch_atomic_and_partial(self):
+        """One bad item rolls an atomic batch back; a partial batch keeps the rest"""
+        rebuild_tables()
+        build_movie_table()
+        session_k = generate_session_key('blorg', 'saltfatacidheat')[0]
+        # The year passes validation but not the INTEGER column
+        items = [{'title': 'Kept', 'rating': 1, 'year': 2020},
+                 {'title': 'Too late', 'rating': 1, 'year': 10 ** 10},
+                 {'title': 'No rating', 'year': 2020}]
+
+        report = create_batch(items, session_k)
+        self.assertFalse(report['committed'])
+        self.assertEqual([result['status'] for result in report['results']], ['not_applied', 'not_applied', 'invalid'])
+        report = create_batch(items[:2], session_k)
+        self.assertEqual([result['status'] for result in report['results']], ['not_applied', 'failed'])
+        self.assertIn('out of range', report['results'][1]['error'])
+        assert_sql_count(self, "SELECT * FROM movies WHERE title = 'Kept'", 0)
+
+        report = create_batch(items, session_k, atomic=False)
+        self.assertTrue(report['committed'])
+        self.assertEqual([result['status'] for result in report['results']], ['created', 'failed', 'invalid'])
+        assert_sql_count(self, "SELECT * FROM movies WHERE title = 'Kept'", 1)
+
+    def test_update_rating_and_delete_batch(self):
+        """Ratings and deletions report each item, including titles that match nothing"""
+        rebuild_tables()
+        build_movie_table()
+        session_k = generate_session_key('blorg', 'saltfatacidheat')[0]
+        create_batch([{'title': 'Twice', 'rating': 0, 'year': 2001}, {'title': 'Twice', 'rating': 0, 'year': 2002}], session_k)
+
+        report = update_rating_batch([{'title': 'Twice', 'rating': 2}, {'title': 'Nope', 'rating': 1},
+                                      {'title': 'Greed', 'rating': 1}, {'title': 'Twice', 'rating': 3}], session_k)
+        self.assertEqual([result['status'] for result in report['results']], ['updated', 'not_found', 'updated', 'updated'])
+        self.assertEqual(len(report['results'][0]['ids']), 2)
+        self.assertEqual(exec_get_all("""SELECT DISTINCT rating FROM movies WHERE title = 'Twice'"""), [(3,)])
+
+        newest = exec_get_one("""SELECT max(id) FROM movies WHERE title = 'Twice'""")[0]
+        report = delete_batch([{'title': 'Twice'}, {'title': 'Nope'}, {'title': 'Twice'}, {'title': 'Twice'}], session_k)
+        self.assertEqual([result['status'] for result in report['results']], ['deleted', 'not_found', 'deleted', 'not_found'])
+        self.assertEqual(report['results'][0]['id'], newest)
+        assert_sql_count(self, "SELECT * FROM movies WHERE title = 'Twice'", 0)
+
+    def explain(self, **query):
+        """The plan of a search query, with sequential scans priced out so any usable index is chosen"""
+        sql, args = search_sql(**query)
+        with pooled_connection() as conn:
+            cur = conn.cursor()
+            cur.execute('SET LOCAL enable_seqscan = off')
+            cur.execute('EXPLAIN ' + sql, args)
+            plan = '\n'.join(row[0] for row in cur.fetchall())
+            conn.rollback()
+        return plan
+
+    def test_search_plans_use_indexes(self):
+        """Every kind of title match, filter and keyset sort is answered from an index"""
+        rebuild_tables()
+        build_movie_table()
+        exec_commit('ANALYZE movies')
+        self.assertIn('movies_title_prefix_idx', self.explain(q='harr'))
+        self.assertIn('movies_title_words_idx', self.explain(q='harriet tub', match='words'))
+        self.assertIn('movies_year_id_idx', self.explain(year_min=1990, year_max=1999, sort='year', after=(1991, 20)))
+        self.assertIn('movies_rating_id_idx', self.explain(rating_min=2, sort='rating', descending=True))
+        if exec_get_one("""SELECT 1 FROM pg_indexes WHERE indexname = 'movies_title_trgm_idx'"""):
+            self.assertIn('movies_title_trgm_idx', self.explain(q='arri', match='substring'))
+
+    def test_search(self):
+        """Title matches and filters combine, and keyset pages cover every match once"""
+        rebuild_tables()
+        build_movie_table()
+        rows, after = search(q='harriet')
+        self.assertEqual([row[3] for row in rows], ['Harriet the Spy', 'Harriet the Spy: Blog Wars', 'Harriet'])
+        self.assertIsNone(after)
+        self.assertIn((8892, 'Harriet'), search(q='arrie', match='substring', fields=('id', 'title'))[0])
+        # LIKE wildcards in q only match themselves
+        self.assertEqual(search(q='0%', match='substring', fields=('title',))[0], [('Wool 100%',)])
+
+        expected = exec_get_all("""SELECT title, year FROM movies WHERE year BETWEEN 2000 AND 2005 AND rating = 3
+                                   ORDER BY year DESC, id DESC""")
+        pages = []
+        after = None
+        while True:
+            rows, after = search(limit=50, year_min=2000, year_max=2005, rating_min=3, rating_max=3,
+                                 sort='year', descending=True, after=after, fields=('title', 'year'))
+            pages.extend(rows)
+            if after is None:
+                break
+        self.assertEqual(pages, expected)
+
+        with self.assertRaises(ValueError):
+            search(sort='passw')
+        with self.assertRaises(ValueError):
+            search(sort='title', after=(2000, 1))
+        for sort in ('id', 'year', 'rating'):
+            with self.assertRaises(ValueError):
+                search(sort=sort, after=(True, True))
+
+    def assert_stats_current(self):
+        expected = exec_get_all("""SELECT year, rating, count(*) FROM movies GROUP BY year, rating ORDER BY year, rating""")
+        self.assertEqual(movie_stats(), expected)
+
+    def test_movie_stats_follow_every_write(self):
+        """The year x rating summary matches a full scan after loads, writes, batches and upserts"""
+        rebuild_tables()
+        build_movie_table()
+        self.assert_stats_current()
+        session_k = generate_session_key('blorg', 'saltfatacidheat')[0]
+
+        create(2, 'Stats movie', 1850, session_k)
+        self.assertIn((1850, 2, 1), movie_stats())
+        update_movie_rating(3, 'Stats movie', session_k)
+        self.assertIn((1850, 3, 1), movie_stats())
+        self.assertNotIn((1850, 2, 1), movie_stats())
+        delete('Stats movie', session_k)
+        self.assertFalse([row for row in movie_stats() if row[0] == 1850])
+
+        create_batch([{'title': 'Stats %d' % n, 'rating': n % 4, 'year': 1990 + n % 3} for n in range(40)], session_k)
+        update_rating_batch([{'title': 'Greed', 'rating': 0}, {'title': 'Stats 1', 'rating': 3}], session_k)
+        delete_batch([{'title': 'Stats %d' % n} for n in range(0, 40, 2)], session_k)
+        self.assert_stats_current()
+
+        import_movies([{'id': 8892, 'imdbid': 4648786, 'rating': 0, 'title': 'Harriet', 'year': 1851},
+                       {'id': 99999, 'imdbid': 99999, 'rating': 1, 'title': 'Imported', 'year': 1851}], upsert=True)
+        self.assertIn((1851, 0, 1), movie_stats())
+        self.assert_stats_current()
+        exec_commit('TRUNCATE movies')
+        self.assertEqual(exec_get_all('SELECT * FROM movie_stats'), [])
+
+    def test_migrate_builds_movie_stats(self):
+        """Applying the summary migration to a populated database counts the movies already there"""
+        rebuild_tables()
+        build_movie_table()
+        exec_commit("""DROP TABLE movie_stats""")
+        exec_commit("""DELETE FROM schema_migrations WHERE version = 5""")
+        self.assertEqual(migrate(), [(5, 'movie_stats')])
+        self.assert_stats_current()
+
+    def test_input_is_never_sql(self):
+        """Quotes and SQL in user input are treated as data by every query"""
+        rebuild_tables()
+        build_movie_table()
+        self.assertEqual(generate_session_key("blorg' --", 'anything'), (0, 'Login invalid'))
+        self.assertEqual(generate_session_key("x' OR '1'='1", "x' OR '1'='1"), (0, 'Login invalid'))
+        session_k = generate_session_key('blorg', 'saltfatacidheat')[0]
+        self.assertFalse(validate_session_key("x' OR '1'='1"))
+
+        title = "Schindler's List; DROP TABLE movies; --"
+        create(1, title, 1993, session_k)
+        update_movie_rating(3, title, session_k)
+        self.assertEqual(exec_get_all("""SELECT rating FROM movies WHERE title = %s""", (title,)), [(3,)])
+        delete(title, session_k)
+        assert_sql_count(self, "SELECT * FROM movies", 8363)
+        self.assertIsNone(delete(title, session_k))
+
+        with self.assertRaises(ValueError):
+            show('1 OR 1 = 1')
+        self.assertEqual(show('8892'), [(8892, 4648786, 3, 'Harriet', 2019)])
+        logout("x' OR '1'='1")
+        self.assertTrue(validate_session_key(session_k))
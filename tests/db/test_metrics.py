@@ -0,0 +1,52 @@
+import threading
+import unittest
+from src.db import metrics
+from src.db.swen344_db_utils import exec_get_all, query_label
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        metrics.reset()
+
+    def test_histogram_buckets_are_cumulative(self):
+        """Observations land in the first bucket at least as large, and every bucket counts those below it"""
+        histogram = metrics.Histogram('test_seconds', 'Test histogram', ('kind',), buckets=(0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 3.0):
+            histogram.observe(value, 'a')
+        text = metrics.render()
+        self.assertIn('test_seconds_bucket{kind="a",le="0.1"} 2', text)
+        self.assertIn('test_seconds_bucket{kind="a",le="1.0"} 3', text)
+        self.assertIn('test_seconds_bucket{kind="a",le="+Inf"} 4', text)
+        self.assertIn('test_seconds_sum{kind="a"} 3.65', text)
+        self.assertIn('test_seconds_count{kind="a"} 4', text)
+        self.assertIn('# TYPE test_seconds histogram', text)
+
+    def test_threads_are_added_up(self):
+        """Each thread counts into its own shard and a scrape sees the sum"""
+        counter = metrics.Counter('test_events_total', 'Test counter', ('name',))
+        def record():
+            for _ in range(1000):
+                counter.inc('x"y')
+        threads = [threading.Thread(target=record) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertIn('test_events_total{name="x\\"y"} 4000', metrics.render())
+
+    def test_queries_are_timed_and_counted(self):
+        """The database helpers record each statement under its label with its row count"""
+        exec_get_all('SELECT id FROM movies WHERE id < 0')
+        exec_get_all('SELECT generate_series(1, 3)')
+        text = metrics.render()
+        self.assertIn('bechdel_db_query_duration_seconds_count{query="select movies"} 1', text)
+        self.assertIn('bechdel_db_query_rows_total{query="select"} 3', text)
+        self.assertNotIn('bechdel_db_query_rows_total{query="select movies"}', text)
+        self.assertIn('bechdel_db_pool_wait_seconds_count 2', text)
+
+    def test_query_labels(self):
+        self.assertEqual(query_label('EXECUTE show_movie (%s)'), 'show_movie')
+        self.assertEqual(query_label('PREPARE show_movie AS SELECT 1'), 'prepare show_movie')
+        self.assertEqual(query_label("""UPDATE movies SET rating = %s WHERE title = %s"""), 'update movies')
+        self.assertEqual(query_label("""SELECT u.x FROM (SELECT 1) AS s JOIN system_users u ON true"""),
+                         'select system_users')
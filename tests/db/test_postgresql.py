@@ -1,5 +1,8 @@
+import os
 import unittest
-from src.db.swen344_db_utils import connect
+from src.db import config
+from src.db.swen344_db_utils import connect, exec_get_one, ConnectionPool, PoolTimeout, pooled_connection, \
+    prepared_statement, execute_prepared, round_trips, reset_round_trips
 
 class TestPostgreSQL(unittest.TestCase):
 
@@ -8,4 +11,116 @@ class TestPostgreSQL(unittest.TestCase):
         cur = conn.cursor()
         cur.execute('SELECT VERSION()')
         self.assertTrue(cur.fetchone()[0].startswith('PostgreSQL'))
-        conn.close()
\ No newline at end of file
+        conn.close()
+
+    def test_pool_reuses_connections(self):
+        """A connection handed back to the pool is the one handed out next"""
+        pool = ConnectionPool(connect, minconn=1, maxconn=2)
+        conn = pool.getconn()
+        pool.putconn(conn)
+        self.assertIs(pool.getconn(), conn)
+        self.assertEqual(pool.size, 1)
+        pool.putconn(conn)
+        pool.closeall()
+
+    def test_pool_checkout_times_out(self):
+        """Checking out of a full pool waits for the timeout and then gives up"""
+        pool = ConnectionPool(connect, minconn=0, maxconn=1, timeout=0.1)
+        conn = pool.getconn()
+        with self.assertRaises(PoolTimeout):
+            pool.getconn()
+        pool.putconn(conn)
+        pool.closeall()
+
+    def test_pool_recycles_broken_connections(self):
+        """A connection that died while idle is replaced on checkout"""
+        pool = ConnectionPool(connect, minconn=1, maxconn=1, check_idle=0)
+        conn = pool.getconn()
+        pool.putconn(conn)
+        conn.close()
+        replacement = pool.getconn()
+        self.assertIsNot(replacement, conn)
+        self.assertFalse(replacement.closed)
+        pool.putconn(replacement)
+        pool.closeall()
+
+    def test_pool_rolls_back_uncommitted_work(self):
+        """Leaving a with block without committing leaves no open transaction behind"""
+        with pooled_connection() as conn:
+            cur = conn.cursor()
+            cur.execute('SELECT 1')
+        self.assertEqual(conn.get_transaction_status(), 0)
+
+    def test_pool_after_fork(self):
+        """
+        A forked child opens its own connections, and the parent's pooled
+        connections keep working after the child exits
+        """
+        from src.db import swen344_db_utils
+        exec_get_one('SELECT 1')
+        parent_pool = swen344_db_utils.get_pool()
+        parent_backend = exec_get_one('SELECT pg_backend_pid()')[0]
+
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                if swen344_db_utils.get_pool() is not parent_pool and \
+                        exec_get_one('SELECT pg_backend_pid()')[0] != parent_backend:
+                    code = 0
+            finally:
+                os._exit(code)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(os.waitstatus_to_exitcode(status), 0)
+        self.assertIs(swen344_db_utils.get_pool(), parent_pool)
+        self.assertEqual(exec_get_one('SELECT pg_backend_pid()')[0], parent_backend)
+
+    def test_prepared_statements_once_per_connection(self):
+        """A registered statement is prepared on first use and then run by name on the same connection"""
+        name = prepared_statement('test_add_one', 'SELECT %s::INTEGER + 1')
+        conn = connect()
+        cur = conn.cursor()
+        for n in range(3):
+            execute_prepared(cur, name, (n,))
+            self.assertEqual(cur.fetchone(), (n + 1,))
+        conn.rollback()
+        execute_prepared(cur, name, (10,))
+        self.assertEqual(cur.fetchone(), (11,))
+        cur.execute("""SELECT count(*) FROM pg_prepared_statements WHERE name = 'test_add_one'""")
+        self.assertEqual(cur.fetchone(), (1,))
+        self.assertEqual(conn.prepared, {'test_add_one'})
+        conn.close()
+
+    def test_round_trips_are_counted_per_thread(self):
+        """Statements, commits of open transactions and server-side cursor fetches each count one round trip"""
+        conn = connect()
+        reset_round_trips()
+        cur = conn.cursor()
+        cur.execute('SELECT 1')
+        conn.commit()
+        conn.commit()  # nothing open, so nothing is sent
+        self.assertEqual(round_trips(), 2)
+        named = conn.cursor('test_round_trips')
+        named.execute('SELECT generate_series(1, 10)')
+        self.assertEqual(len(named.fetchmany(5)), 5)
+        self.assertEqual(round_trips(), 4)
+        conn.rollback()
+        self.assertEqual(round_trips(), 5)
+        conn.close()
+
+    def test_prepared_statements_can_be_turned_off(self):
+        """With prepare_statements off the same statement runs as plain SQL"""
+        os.environ['BECHDEL_PREPARE_STATEMENTS'] = '0'
+        config.reload()
+        try:
+            name = prepared_statement('test_add_two', 'SELECT %s::INTEGER + 2')
+            conn = connect()
+            cur = conn.cursor()
+            execute_prepared(cur, name, (1,))
+            self.assertEqual(cur.fetchone(), (3,))
+            cur.execute('SELECT count(*) FROM pg_prepared_statements')
+            self.assertEqual(cur.fetchone(), (0,))
+            conn.close()
+        finally:
+            del os.environ['BECHDEL_PREPARE_STATEMENTS']
+            config.reload()
@@ -0,0 +1,91 @@
+import os
+import time
+import unittest
+from src.db import config, slow_queries
+from src.db.swen344_db_utils import exec_get_one, exec_get_all, pooled_connection
+
+class TestSlowQueries(unittest.TestCase):
+
+    def setUp(self):
+        os.environ['BECHDEL_SLOW_QUERY_MS'] = '20'
+        os.environ['BECHDEL_SLOW_QUERY_EXPLAIN_SAMPLE'] = '1'
+        config.reload()
+        slow_queries.clear()
+
+    def tearDown(self):
+        del os.environ['BECHDEL_SLOW_QUERY_MS']
+        del os.environ['BECHDEL_SLOW_QUERY_EXPLAIN_SAMPLE']
+        config.reload()
+
+    def wait_for_plan(self, entry, timeout=10):
+        deadline = time.monotonic() + timeout
+        while slow_queries.recent()[0]['explain'] == 'pending' and time.monotonic() < deadline:
+            time.sleep(0.05)
+        return slow_queries.recent()[0]
+
+    def test_slow_statement_is_logged_redacted_and_explained(self):
+        """Only statements over the threshold are kept; their parameters are redacted and their plan captured"""
+        exec_get_one('SELECT %s::TEXT', ('fast',))
+        self.assertEqual(slow_queries.recent(), [])
+
+        exec_get_one('SELECT pg_sleep(0.05), %s::TEXT, %s::INTEGER', ('secret title', 7))
+        entry = slow_queries.recent()[0]
+        self.assertGreaterEqual(entry['ms'], 50)
+        self.assertEqual(entry['params'], ['<str:12>', '<int>'])
+        self.assertNotIn('secret', str(entry))
+        entry = self.wait_for_plan(entry)
+        self.assertEqual(entry['explain'], 'done')
+        self.assertIn('Execution Time', entry['plan'])
+
+    def imdbid_sequence(self):
+        return exec_get_one("""SELECT last_value FROM movies_imdbid_seq""")[0]
+
+    def test_writes_are_explained_without_running(self):
+        """A write only gets the planner's estimate: it is not run again, so it draws no sequence values"""
+        with pooled_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("""INSERT INTO movies(rating, title, year) SELECT 1, %s, 2000 FROM pg_sleep(0.05)""", ('slowpoke',))
+            conn.rollback()
+        drawn = self.imdbid_sequence()
+        entry = self.wait_for_plan(slow_queries.recent()[0])
+        self.assertEqual(entry['explain'], 'done')
+        self.assertIn('Insert on movies', entry['plan'])
+        self.assertNotIn('Execution Time', entry['plan'])
+        self.assertEqual(self.imdbid_sequence(), drawn)
+
+    def test_selects_with_side_effects_are_not_run_again(self):
+        """A SELECT that draws a sequence value is refused by the read only transaction and explained without ANALYZE"""
+        exec_get_one("""SELECT nextval('movies_imdbid_seq') FROM pg_sleep(0.05)""")
+        drawn = self.imdbid_sequence()
+        entry = self.wait_for_plan(slow_queries.recent()[0])
+        self.assertEqual(entry['explain'], 'done')
+        self.assertNotIn('Execution Time', entry['plan'])
+        self.assertEqual(self.imdbid_sequence(), drawn)
+
+    def test_explained_writes_are_rolled_back(self):
+        """With slow_query_explain_writes on, EXPLAIN ANALYZE runs a write again and the explainer never commits it"""
+        os.environ['BECHDEL_SLOW_QUERY_EXPLAIN_WRITES'] = '1'
+        try:
+            config.reload()
+            with pooled_connection() as conn:
+                cur = conn.cursor()
+                cur.execute("""INSERT INTO system_users (username, passw) SELECT %s, 'x' FROM pg_sleep(0.05)""", ('slowpoke',))
+                conn.rollback()
+            entry = self.wait_for_plan(slow_queries.recent()[0])
+        finally:
+            del os.environ['BECHDEL_SLOW_QUERY_EXPLAIN_WRITES']
+        self.assertEqual(entry['explain'], 'done')
+        self.assertIn('Insert on system_users', entry['plan'])
+        self.assertIn('Execution Time', entry['plan'])
+        self.assertEqual(exec_get_all("""SELECT 1 FROM system_users WHERE username = 'slowpoke'"""), [])
+
+    def test_ring_buffer_is_bounded(self):
+        """Only the newest slow_query_log_size entries are kept"""
+        os.environ['BECHDEL_SLOW_QUERY_LOG_SIZE'] = '2'
+        try:
+            config.reload()
+            for n in range(3):
+                exec_get_one('SELECT pg_sleep(0.03), %s', (n,))
+            self.assertEqual(len(slow_queries.recent()), 2)
+        finally:
+            del os.environ['BECHDEL_SLOW_QUERY_LOG_SIZE']
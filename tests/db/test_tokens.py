@@ -0,0 +1,80 @@
+import os
+import unittest
+from src.db import config
+from src.db import bechdel_db
+from src.db.swen344_db_utils import exec_get_all
+from src.db.tokens import Denylist, is_token, issue_token, verify_token
+
+SECRET = 'not-a-real-secret'
+
+class TestTokens(unittest.TestCase):
+
+    def test_round_trip(self):
+        """A token verifies with the secret it was signed with and carries its claims"""
+        token = issue_token('blorg', SECRET, ttl=60, now=1000)
+        self.assertTrue(is_token(token))
+        claims = verify_token(token, SECRET, now=1001)
+        self.assertEqual((claims['u'], claims['exp']), ('blorg', 1060))
+
+    def test_rejects_expired_tampered_and_foreign_tokens(self):
+        """Expired tokens, altered tokens and tokens signed with another secret are refused"""
+        token = issue_token('blorg', SECRET, ttl=60, now=1000)
+        self.assertIsNone(verify_token(token, SECRET, now=1060))
+        self.assertIsNone(verify_token(token, 'another secret', now=1001))
+        body, signature = token.rsplit('.', 1)
+        self.assertIsNone(verify_token(body + '.' + signature[::-1], SECRET, now=1001))
+        self.assertIsNone(verify_token('v1.garbage', SECRET, now=1001))
+        self.assertIsNone(verify_token('v1.g\u00e4rbage.' + signature, SECRET, now=1001))
+        self.assertIsNone(verify_token(body + '.' + signature[:-1] + '\u00e4', SECRET, now=1001))
+        self.assertFalse(is_token('ab' * 512))
+
+    def test_needs_a_secret(self):
+        """Tokens cannot be issued without a signing secret"""
+        with self.assertRaises(ValueError):
+            issue_token('blorg', '', ttl=60)
+
+    def test_denylist_forgets_expired_entries(self):
+        """Revoked ids are only kept until the token would have expired anyway"""
+        now = [1000]
+        denylist = Denylist(clock=lambda: now[0])
+        denylist.add('a', 1100)
+        self.assertIn('a', denylist)
+        now[0] = 1200
+        self.assertNotIn('a', denylist)
+        denylist.add('b', 1300)
+        self.assertEqual(len(denylist), 1)
+
+class TestTokenAuthMode(unittest.TestCase):
+
+    def setUp(self):
+        os.environ['BECHDEL_AUTH_MODE'] = 'token'
+        os.environ['BECHDEL_TOKEN_SECRET'] = SECRET
+        config.reload()
+        bechdel_db.rebuild_tables()
+        bechdel_db.build_movie_table()
+
+    def tearDown(self):
+        bechdel_db.stop_cache_listener()
+        del os.environ['BECHDEL_AUTH_MODE']
+        del os.environ['BECHDEL_TOKEN_SECRET']
+        config.reload()
+
+    def test_login_issues_token_without_writing(self):
+        """In token mode /login hands out a signed token and system_users is untouched"""
+        token, message = bechdel_db.generate_session_key('blorg', 'saltfatacidheat')
+        self.assertEqual(message, 'Login was successful')
+        self.assertTrue(is_token(token))
+        self.assertEqual(exec_get_all("""SELECT session_key FROM system_users WHERE username = 'blorg'"""), [(None,)])
+        self.assertTrue(bechdel_db.validate_session_key(token))
+        self.assertIsNotNone(bechdel_db.create(3, 'A token movie', '2021', token))
+
+    def test_logout_revokes_token(self):
+        """A logged out token is denied here and recorded for other workers"""
+        token = bechdel_db.generate_session_key('blorg', 'saltfatacidheat')[0]
+        bechdel_db.logout(token)
+        self.assertFalse(bechdel_db.validate_session_key(token))
+        self.assertEqual(len(exec_get_all("""SELECT jti FROM revoked_tokens""")), 1)
+
+        bechdel_db.denylist().replace(())
+        bechdel_db._load_denylist()
+        self.assertFalse(bechdel_db.validate_session_key(token))
@@ -1,6 +1,15 @@
 import requests
 from src.db.swen344_db_utils import connect, exec_sql_file
 
+# The API authenticates each request from its session cookie, so the REST
+# helpers share one client session the way a browser would
+rest_session = requests.Session()
+
+def reset_rest_session():
+    """Starts over with a client that has no cookies (nobody logged in)"""
+    global rest_session
+    rest_session = requests.Session()
+
 def insert_test_data():
     exec_sql_file('tests/test_data.sql')
 
@@ -13,19 +22,19 @@ def assert_sql_count(test, sql, n,
     conn.close()
 
 def get_rest_call(test, url, params = {}, expected_code = 200):
-    response = requests.get(url, params)
+    response = rest_session.get(url, params=params)
     test.assertEqual(expected_code, response.status_code,
                      f'Response code to {url} not {expected_code}')
     return response.json()
 
 def post_rest_call(test, url, params = {}, expected_code = 200):
-    response = requests.post(url, params)
+    response = rest_session.post(url, params)
     test.assertEqual(expected_code, response.status_code,
                      f'Response code to {url} not {expected_code}')
     return response.json()
 
 def delete_rest_call(test, url, params = {}, expected_code = 200):
-    response = requests.delete(url, params=params)
+    response = rest_session.delete(url, params=params)
     test.assertEqual(expected_code, response.status_code,
                      f'Response code to {url} not {expected_code}')
     return response.json()
\ No newline at end of file